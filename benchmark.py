@@ -0,0 +1,294 @@
+import os
+import io
+import json
+import time
+import wave
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from config import Config
+
+MOCK_ANALYSIS = json.dumps({
+    "problems": [
+        {
+            "problem_number": "1",
+            "problem_text": "x² - 5x + 6 = 0 を解きなさい",
+            "problem_type": "二次方程式",
+            "difficulty": "基礎"
+        }
+    ]
+}, ensure_ascii=False)
+
+MOCK_LESSON = json.dumps({
+    "problems": json.loads(MOCK_ANALYSIS)["problems"],
+    "intro": "お兄ちゃん、一緒に解いていこうね！",
+    "steps": [
+        {"title": "問題を確認", "narration": "x² - 5x + 6 = 0 だよ。", "expression": "x^2 - 5x + 6 = 0"},
+        {"title": "因数を探す", "narration": "かけて6、たして-5になる2つの数を探すよ。", "expression": "(-2) * (-3) = 6"},
+        {"title": "因数分解", "narration": "-2と-3だから (x - 2)(x - 3) = 0 になるね。", "expression": "(x - 2)(x - 3) = 0"},
+        {"title": "答え", "narration": "x = 2 または x = 3 が答えだよ！", "expression": "x = 2, 3"}
+    ],
+    "graph_expression": "y = x^2 - 5x + 6",
+    "summary": "代入して確かめたらバッチリだね♪"
+}, ensure_ascii=False)
+
+MOCK_EXPLANATION = """お兄ちゃん、一緒に解いていこうね！
+
+ステップ1: 問題を確認しよう。x² - 5x + 6 = 0 だよ。
+
+ステップ2: かけて6、たして-5になる2つの数を探すよ。
+
+ステップ3: -2と-3だから (x - 2)(x - 3) = 0 になるね。
+
+ステップ4: x = 2 または x = 3 が答えだよ！
+
+ステップ5: 代入して確かめたらバッチリだね♪"""
+
+class MockLMStudioHandler(BaseHTTPRequestHandler):
+    """OpenAI互換 /v1/chat/completions のモック（遅延とトークン速度を設定可能）"""
+    
+    latency = 0.2  # 最初のトークンまでの秒数
+    token_rate = 50.0  # 1秒あたりのトークン数
+    structured_output = True  # response_format (json_schema) に対応するか
+    models = ["gemma-3-12b-it", "japanese-starling-chatv-7b"]
+    error_status = None  # 設定するとすべての補完をこのステータスで失敗させる（障害の再現用）
+    served = 0  # 受け付けた補完リクエスト数
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def do_GET(self):
+        if self.path.rstrip('/') == "/v1/models":
+            body = json.dumps({"data": [{"id": model} for model in self.models]}).encode()
+            self._send(200, body, "application/json")
+        else:
+            self._send(404, b"", "text/plain")
+    
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        type(self).served += 1
+        if self.error_status:
+            self._send(self.error_status, b'{"error": "mock failure"}', "application/json")
+            return
+        content = request.get("messages", [{}])[-1].get("content", "")
+        has_image = isinstance(content, list) and any(part.get("type") == "image_url" for part in content)
+        if request.get("response_format"):
+            if not self.structured_output:
+                self._send(400, b'{"error": "response_format is not supported"}', "application/json")
+                return
+            text = MOCK_LESSON
+        else:
+            text = MOCK_ANALYSIS if has_image else MOCK_EXPLANATION
+        
+        # 1文字1トークンとみなす
+        max_tokens = request.get("max_tokens", -1)
+        if max_tokens and max_tokens > 0:
+            text = text[:max_tokens]
+        tokens = list(text)
+        
+        time.sleep(self.latency)
+        if request.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            try:
+                for token in tokens:
+                    time.sleep(1.0 / self.token_rate)
+                    chunk = {"choices": [{"delta": {"content": token}, "finish_reason": None}]}
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            return
+        
+        time.sleep(len(tokens) / self.token_rate)
+        body = json.dumps({
+            "choices": [{"message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)}
+        }, ensure_ascii=False).encode()
+        self._send(200, body, "application/json")
+    
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class MockVoicevoxHandler(BaseHTTPRequestHandler):
+    """VOICEVOX /audio_query, /synthesis のモック"""
+    
+    query_latency = 0.05
+    realtime_factor = 0.1  # 合成時間 / 音声長
+    seconds_per_char = 0.12
+    sample_rate = 24000
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def do_POST(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        
+        if url.path == "/audio_query":
+            time.sleep(self.query_latency)
+            text = params.get("text", [""])[0]
+            query = {"text_length": len(text), "speedScale": 1.0, "pitchScale": 0.0,
+                     "intonationScale": 1.0, "volumeScale": 1.0, "outputSamplingRate": self.sample_rate}
+            self._send(200, json.dumps(query).encode(), "application/json")
+        elif url.path == "/synthesis":
+            query = json.loads(body or b"{}")
+            duration = query.get("text_length", 10) * self.seconds_per_char / max(query.get("speedScale", 1.0), 0.1)
+            time.sleep(duration * self.realtime_factor)
+            self._send(200, self._silence(duration), "audio/wav")
+        else:
+            self._send(404, b"", "text/plain")
+    
+    def _silence(self, duration):
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(self.sample_rate)
+            wav.writeframes(b"\x00\x00" * int(duration * self.sample_rate))
+        return buffer.getvalue()
+    
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_mock_server(handler_class, **attributes):
+    """モックサーバーを空きポートで起動して (server, base_url) を返す"""
+    handler = type(handler_class.__name__, (handler_class,), attributes)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def create_fixture_pdf(path, image_path):
+    """テキストページと画像だけのページを持つPDFを作成"""
+    import fitz
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((72, 72), "Problem 1: x^2 - 5x + 6 = 0", fontsize=18)
+    page = doc.new_page()
+    page.insert_image(page.rect, filename=image_path)
+    doc.save(path)
+    doc.close()
+    return path
+
+def summarize(timings, elapsed):
+    """呼び出し単位と段階（metrics.span）ごとの p50/p95 と件数をまとめる"""
+    from metrics import registry
+    rows = []
+    for name, values in timings.items():
+        rows.append({
+            'stage': name,
+            'count': len(values),
+            'p50_ms': float(np.percentile(values, 50)) * 1000,
+            'p95_ms': float(np.percentile(values, 95)) * 1000,
+            'total_s': float(sum(values)),
+        })
+    for row in registry.stage_summary():
+        rows.append({
+            'stage': row['stage'],
+            'count': row['count'],
+            'p50_ms': row['p50'] * 1000,
+            'p95_ms': row['p95'] * 1000,
+            'total_s': row['total'],
+        })
+    jobs = len(timings.get("process_homework_image", []))
+    return {'stages': rows, 'elapsed_s': elapsed,
+            'jobs_per_min': jobs / elapsed * 60 if elapsed > 0 else 0.0}
+
+def run_benchmark(images, pdfs, iterations=3, llm_latency=0.2, token_rate=50.0,
+                  tts_latency=0.05, tts_rtf=0.1, structured_output=True, lm_servers=1):
+    """モックサーバーに向けて宿題処理・授業・Pkaisetuを計測"""
+    lm_mocks = [start_mock_server(MockLMStudioHandler, latency=llm_latency, token_rate=token_rate,
+                                  structured_output=structured_output) for _ in range(lm_servers)]
+    tts_server, tts_url = start_mock_server(MockVoicevoxHandler, query_latency=tts_latency,
+                                            realtime_factor=tts_rtf)
+    
+    Config.LMSTUDIO_URLS = [f"{lm_url}/v1/chat/completions" for _, lm_url in lm_mocks]
+    Config.VOICEVOX_URL = tts_url
+    Config.QUEST_IP = "127.0.0.1"
+    Config.SLIDE_INTERVAL = 0.0
+    Config.DISCORD_TOKEN = ""
+    
+    import cv2
+    from main import VRSenseiSystem
+    system = VRSenseiSystem()
+    timings = {}
+    
+    def add(name, seconds):
+        timings.setdefault(name, []).append(seconds)
+    
+    start = time.perf_counter()
+    try:
+        for _ in range(iterations):
+            for path in list(images) + list(pdfs):
+                system.genshori_phase = "waiting"
+                t0 = time.perf_counter()
+                system.process_homework_image(path)
+                add("process_homework_image", time.perf_counter() - t0)
+                
+                t0 = time.perf_counter()
+                system.start_teaching()
+                system.lesson_player.wait()
+                add("start_teaching", time.perf_counter() - t0)
+            
+            for path in images:
+                frame = cv2.imread(path)
+                t0 = time.perf_counter()
+                system.handle_pkaisetu(frame)
+                add("handle_pkaisetu", time.perf_counter() - t0)
+    finally:
+        system.genshori_phase = "waiting"
+        for lm_server, _ in lm_mocks:
+            lm_server.shutdown()
+        tts_server.shutdown()
+    
+    return summarize(timings, time.perf_counter() - start)
+
+def print_report(report):
+    print(f"{'stage':<26}{'count':>7}{'p50(ms)':>12}{'p95(ms)':>12}{'total(s)':>11}")
+    for row in sorted(report['stages'], key=lambda r: -r['total_s']):
+        print(f"{row['stage']:<26}{row['count']:>7}{row['p50_ms']:>12.1f}{row['p95_ms']:>12.1f}{row['total_s']:>11.2f}")
+    print(f"elapsed: {report['elapsed_s']:.2f}s, throughput: {report['jobs_per_min']:.2f} jobs/min")
+
+def main():
+    parser = argparse.ArgumentParser(description="LM Studio/VOICEVOXのモックを使ったエンドツーエンド計測")
+    parser.add_argument("--image", action="append", help="宿題画像（複数指定可）")
+    parser.add_argument("--pdf", action="append", help="宿題PDF（省略時は自動生成）")
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="最初のトークンまでの秒数")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="1秒あたりのトークン数")
+    parser.add_argument("--tts-latency", type=float, default=0.05)
+    parser.add_argument("--tts-rtf", type=float, default=0.1, help="音声合成の実時間比")
+    parser.add_argument("--no-structured-output", action="store_true",
+                        help="モックを構造化出力に未対応にする（2回呼び出しの計測）")
+    parser.add_argument("--lm-servers", type=int, default=1, help="LM Studioモックの台数（振り分けの計測）")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+    
+    Config.create_directories()
+    images = args.image or ["./image.png"]
+    pdfs = args.pdf or [create_fixture_pdf(os.path.join(Config.TMP_DIR, "benchmark_fixture.pdf"), images[0])]
+    
+    report = run_benchmark(images, pdfs, args.iterations, args.llm_latency, args.token_rate,
+                           args.tts_latency, args.tts_rtf, not args.no_structured_output, args.lm_servers)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+import threading
+
+class CancelledError(Exception):
+    """キャンセルされた処理から抜けるための例外"""
+
+class CancelToken:
+    """処理の中断要求を伝えるトークン（親がキャンセルされると子もキャンセル扱い）"""
+    
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.event = threading.Event()
+        self.reason = ""
+    
+    def cancel(self, reason=""):
+        self.reason = reason
+        self.event.set()
+    
+    @property
+    def cancelled(self):
+        return self.event.is_set() or (self.parent is not None and self.parent.cancelled)
+    
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise CancelledError(self.reason or (self.parent.reason if self.parent else ""))
+    
+    def child(self):
+        return CancelToken(self)
+
+def check(token):
+    """token が None でなくキャンセル済みなら CancelledError"""
+    if token is not None:
+        token.raise_if_cancelled()
@@ -11,12 +11,34 @@ class Config:
     
     # API設定
     LMSTUDIO_URL = os.getenv("LMSTUDIO_URL", "http://rinnas.f5.si:1234/v1/chat/completions")
+    # 複数サーバーに振り分ける場合はカンマ区切り（空なら LMSTUDIO_URL のみ）
+    LMSTUDIO_URLS = [url.strip() for url in os.getenv("LMSTUDIO_URLS", "").split(",") if url.strip()]
+    LMSTUDIO_MODEL_ROUTES = {}  # モデル名 -> そのモデルを使うサーバーURLのリスト（未指定は /v1/models で判定）
+    LLM_CONNECT_TIMEOUT = 5.0  # 秒。つながらなければ別サーバーへ
+    LLM_HEALTH_INTERVAL = 10.0  # /v1/models で死活確認する間隔（秒）
+    LLM_HEALTH_TIMEOUT = 3.0
     VOICEVOX_URL = os.getenv("VOICEVOX_URL", "http://localhost:50021")
     VOICEVOX_SPEAKER_ID = int(os.getenv("VOICEVOX_SPEAKER_ID", "58"))  # 関西弁
     
     # Discord設定
     DISCORD_TOKEN = os.getenv("DISCORD_TOKEN", "")
     DISCORD_CHANNEL_ID = int(os.getenv("DISCORD_CHANNEL_ID", "0"))
+    DISCORD_MAX_ATTACHMENTS = 10  # 1メッセージで取り込む添付の上限
+    INGEST_WORKERS = 4  # 添付のデコード・縮小・OCRの並列数
+    UPLOAD_MAX_BYTES = 10 * 1024 * 1024
+    UPLOAD_MAX_SIZE = (1920, 1080)  # これより大きい画像は縮小して保存
+    DISCORD_STATUS_INTERVAL = 2.0  # 進捗で返信を書き換える最短間隔（秒）
+    DISCORD_PREVIEW_SIZE = (480, 270)  # 1枚目のスライドのプレビュー
+    DISCORD_PREVIEW_QUALITY = 70
+    
+    # ユーザーごとのレート制限と公平キュー
+    USER_JOB_RATE = 1 / 60  # 1秒あたりに溜まる宿題受付数（1分に1件）
+    USER_JOB_BURST = 3  # 続けて送れる件数
+    USER_MAX_QUEUED = 3  # 1人が順番待ちにできる件数
+    USER_WEIGHTS = {}  # Discordユーザー名 -> 重み（大きいほど優先。既定1.0）
+    JOB_QUEUE_POLL = 0.5  # 受付可能になったかを確認する間隔（秒）
+    LESSON_IDLE_TIMEOUT = 300  # 準備できた授業が始まらないまま、これだけ経ったら次の宿題に譲る（秒）
+    CACHE_MIN_SOURCE_CHARS = 10  # これより短い読み取り結果では履歴の授業を使い回さない
     
     # ディレクトリ設定
     TMP_DIR = "./tmp"
@@ -27,22 +49,126 @@ class Config:
     # OCR設定
     OCR_CONFIDENCE_THRESHOLD = 0.5
     OCR_LANGUAGES = ['ja', 'en']
+    OCR_REGION_CACHE = True  # 静止シーンでは文字領域検出を使い回す
+    OCR_SCENE_PIXEL_DELTA = 25  # シーン変化とみなす縮小画像の輝度差
+    OCR_SCENE_CHANGE_RATIO = 0.005  # 変化画素がこの割合を超えたら再検出
+    OCR_ROI_MARGIN = 0.15  # カメラROIの余白（フレームサイズ比）
+    OCR_ROI_REFRESH_FRAMES = 30  # このフレーム数ごとに全体を再検出
+    OCR_BATCH_SIZE = 8  # 一括認識のバッチサイズ
+    OCR_BATCH_SIZE_STEP = 64  # このピクセル単位でサイズの近い画像をまとめる
+    OCR_BATCH_WORKERS = min(4, os.cpu_count() or 1)  # Tesseract並列プロセス数
+    OCR_ENGINE_MODE = os.getenv("OCR_ENGINE_MODE", "auto")  # auto, race, easyocr, tesseract
+    OCR_ENGINE_MIN_SAMPLES = 3  # 自動選択前に各エンジンを試す回数
+    OCR_ENGINE_EWMA_ALPHA = 0.3  # 速度・信頼度の移動平均係数
+    
+    # トリガー語検出設定
+    TRIGGER_ANALYSIS_WIDTH = 320  # 差分解析用の縮小幅
+    TRIGGER_MOTION_DELTA = 20  # 変化とみなす輝度差
+    TRIGGER_MOTION_RATIO = 0.002  # これを超える変化は手の動きとみなす
+    TRIGGER_SETTLE_FRAMES = 3  # 静止してから判定するまでのフレーム数
+    TRIGGER_MIN_INK_AREA = 30  # 書き込みとみなす最小面積（縮小画像）
+    TRIGGER_CROP_MARGIN = 20  # 書き込み領域の余白（縮小画像）
+    TRIGGER_MATCH_RATIO = 0.8  # 誤認識を許容する類似度
     
     # 音声設定
     AUDIO_QUALITY = 90
     SPEECH_SPEED = 1.0
+    SLIDE_INTERVAL = 3.0  # スライドごとの説明時間（秒）
+    SPEECH_SPEED_DEFAULT = 1.0  # VOICEVOX speedScale
+    SPEECH_SPEED_STEP = 0.25
+    SPEECH_SPEED_MIN = 0.5
+    SPEECH_SPEED_MAX = 2.0
     
     # 画像設定
     IMAGE_QUALITY = 90
     SLIDE_DPI = 150
+    SLIDE_RENDER_WORKERS = min(4, os.cpu_count() or 1)  # スライド描画の並列プロセス数
     
     # AI設定
     DEFAULT_TEMPERATURE = 0.7
-    MAX_TOKENS = 2048
+    MAX_TOKENS = 2048  # 用途を指定しない呼び出しの上限
+    # 用途ごとの生成トークン上限（長すぎる生成は待ち時間も読み上げ時間も延ばす）
+    TOKEN_BUDGETS = {
+        "lesson": 1536,  # 構造化出力の授業全体（JSONの記号を含む）
+        "problems": 512,  # 問題の構造化JSON
+        "explanation": 1024,  # 2回呼び出し時の解説（5ステップ分）
+        "pkaisetu_analysis": 384,  # Pkaisetu周辺の問題特定
+        "pkaisetu": 384,  # Pkaisetuで読み上げる解説
+        "step": 256,  # 先読みするステップ解説
+    }
+    SPOKEN_PURPOSES = ("explanation", "pkaisetu", "step")  # そのまま読み上げる用途（文字数で打ち切る）
+    SPOKEN_STOP_SEQUENCES = ["---", "###", "\n\n\n", "（注"]  # 読み上げに不要な補足が始まったら止める
+    SPOKEN_STOP_PURPOSES = ("pkaisetu", "step")  # 停止文字列を使う自由文（見出しで区切る解説は対象外）
+    CHARS_PER_TOKEN = 1.0  # 日本語1トークンあたりの文字数の目安
+    NARRATION_MAX_CHARS = 120  # スライド1枚の読み上げ文の上限
+    VLM_MAX_IMAGE_SIDE = 896  # gemma-3の入力解像度
+    VLM_JPEG_QUALITY = 85
+    VLM_PAYLOAD_CACHE_SIZE = 32
+    LESSON_MODEL = "gemma-3-12b-it"
+    LESSON_SINGLE_CALL = os.getenv("LESSON_SINGLE_CALL", "1") != "0"  # 問題解析と解説を1回の構造化出力で生成
+    TTS_WORKERS = 2  # 授業の読み上げを先に合成する並列数
+    
+    # LM Studioのモデル常駐スケジューラ（VLMとLLMの入れ替えを減らす）
+    MODEL_SCHEDULER_POLICY = os.getenv("MODEL_SCHEDULER_POLICY", "resident_first")  # resident_first または fifo
+    MODEL_MAX_BATCH = 8  # 他モデルが待っていても常駐モデルを続けて流す上限（これを超えたら切り替え）
+    MODEL_PARALLEL = 1  # 常駐モデルへの同時リクエスト数
+    
+    # カメラ設定
+    CAMERA_SOURCE = os.getenv("CAMERA_SOURCE", "0")  # カメラ番号または録画ファイル(.vrf)
+    CAMERA_REPLAY_REALTIME = os.getenv("CAMERA_REPLAY_REALTIME", "1") == "1"
+    CAMERA_RECORD_PATH = os.getenv("CAMERA_RECORD_PATH", "")  # 指定するとカメラ映像を録画
+    
+    # ログ設定
+    LOG_FILE = "./tmp/system.log"
+    LOG_MAX_BYTES = 5 * 1024 * 1024
+    LOG_BACKUP_COUNT = 3
+    GUI_LOG_MAX_LINES = 1000  # 画面に残す行数
+    GUI_LOG_INTERVAL_MS = 100  # 画面反映の間隔
+    GUI_LOG_BATCH_SIZE = 500  # 1回で反映する最大件数
+    GUI_LOG_QUEUE_SIZE = 10000
+    
+    # 一時ファイル管理設定
+    STORAGE_QUOTAS = {  # カテゴリごとの上限（バイト）
+        "discord": 500 * 1024 * 1024,
+        "voice": 200 * 1024 * 1024,
+        "pkaisetu": 100 * 1024 * 1024,
+        "slide": 100 * 1024 * 1024,
+    }
+    STORAGE_MAX_AGE = {  # カテゴリごとの保存期間（秒）
+        "discord": 7 * 24 * 3600,
+        "voice": 600,
+        "pkaisetu": 600,
+        "slide": 3600,
+    }
+    STORAGE_MIN_AGE = 60  # 作成・使用からこの秒数は削除しない
+    STORAGE_JANITOR_INTERVAL = 60
+    STORAGE_RAM_DIR = os.getenv("STORAGE_RAM_DIR", "")  # 例: /dev/shm/vr_sensei（空ならディスクのみ）
+    STORAGE_RAM_CATEGORIES = ("voice", "pkaisetu")  # RAM領域に置く短命なファイル
+    
+    # Pkaisetu先読み設定
+    PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1") != "0"
+    PREFETCH_MATCH_RATIO = 0.7  # フレームの文字と授業の問題の一致度
+    PREFETCH_IDLE_POLL = 0.2  # 他の処理が終わるのを待つ間隔（秒）
+    
+    # 授業履歴設定
+    HISTORY_DB = os.getenv("HISTORY_DB", "./history.db")
+    HISTORY_MAX_LESSONS = 1000  # これを超えた古い授業はスライドごと削除
+    HISTORY_LIST_SIZE = 50  # 管理画面に表示する件数
+    
+    # 管理画面ダッシュボード設定
+    DASHBOARD_INTERVAL_MS = 1000
+    DASHBOARD_RATE_WINDOW = 5.0  # FPS・送信量を平均する秒数
+    DASHBOARD_CPU_WARN = 90.0  # これを超えたら赤表示（%）
+    DASHBOARD_RAM_WARN = 90.0
+    
+    # メトリクス設定
+    METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))  # 0で無効
     
     # Pkaisetu設定
     PKAISETU_COOLDOWN = 5.0  # 秒
     PKAISETU_TIMEOUT = 30.0  # 秒
+    PKAISETU_CONTEXT_LINES = 3  # Pkaisetuの前後何行までVLMに渡すか
+    PKAISETU_CROP_MARGIN = 40  # 切り出し余白（ピクセル）
     
     @classmethod
     def create_directories(cls):
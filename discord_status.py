@@ -0,0 +1,56 @@
+import io
+import time
+import asyncio
+import threading
+import discord
+from config import Config
+from metrics import registry
+
+class DiscordStatus:
+    """Discordの返信1件を処理の進み具合に合わせて書き換える
+    
+    編集は interval 秒以上あけ、その間に届いた更新は次の1回の編集にまとめる（Discordのレート制限対策）。
+    """
+    
+    def __init__(self, message, loop, interval=None, log=print):
+        self.message = message  # 書き換える返信
+        self.loop = loop  # Botのイベントループ
+        self.interval = interval or Config.DISCORD_STATUS_INTERVAL
+        self.log = log
+        
+        self.lock = threading.Lock()
+        self.lines = [message.content] if message.content else []
+        self.preview = None  # まだ送っていないプレビュー画像（JPEGのバイト列）
+        self.scheduled = False
+        self.last_edit = 0.0
+    
+    def update(self, line, preview=None):
+        """進捗を1行追加（どのスレッドからでも呼べる）"""
+        with self.lock:
+            self.lines.append(line)
+            if preview:
+                self.preview = preview
+            if self.scheduled:
+                return
+            self.scheduled = True
+        asyncio.run_coroutine_threadsafe(self._flush(), self.loop)
+    
+    async def _flush(self):
+        wait = self.last_edit + self.interval - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        with self.lock:
+            # 2000文字を超える分は古い行から省く
+            content = "\n".join(self.lines)[-2000:]
+            preview, self.preview = self.preview, None
+            self.scheduled = False
+        self.last_edit = time.monotonic()
+        
+        kwargs = {"content": content}
+        if preview:
+            kwargs["attachments"] = [discord.File(io.BytesIO(preview), filename="preview.jpg")]
+        try:
+            await self.message.edit(**kwargs)
+            registry.inc("discord_status_edits")
+        except discord.HTTPException as e:
+            self.log(f"Discord進捗更新エラー: {e}")
@@ -0,0 +1,116 @@
+import threading
+import time
+import requests
+from config import Config
+from metrics import registry
+from model_scheduler import ModelScheduler
+
+class EndpointError(Exception):
+    """サーバー側の障害（接続失敗・5xx）。別のサーバーで再試行してよい"""
+
+def base_url(url):
+    """チャット補完のURLからサーバーのベースURLを取り出す"""
+    url = url.rstrip('/')
+    for suffix in ("/v1/chat/completions", "/v1"):
+        if url.endswith(suffix):
+            return url[:-len(suffix)]
+    return url
+
+class Endpoint:
+    """OpenAI互換サーバー1台（実行中のリクエスト数・稼働状態・提供モデル）"""
+    
+    def __init__(self, url, log=print):
+        self.url = url
+        self.base = base_url(url)
+        self.outstanding = 0  # 待ち＋実行中のリクエスト数
+        self.healthy = True
+        self.models = None  # /v1/models の結果（未取得はNone）
+        self.failed_at = 0.0
+        # サーバーごとに常駐モデルが違うので入れ替え制御もサーバーごと
+        self.scheduler = ModelScheduler(log=log)
+    
+    def serves(self, model):
+        routes = Config.LMSTUDIO_MODEL_ROUTES.get(model)
+        if routes:
+            return self.url in routes or self.base in routes
+        return self.models is None or model in self.models
+    
+    def __repr__(self):
+        return f"Endpoint({self.base}, outstanding={self.outstanding}, healthy={self.healthy})"
+
+class EndpointPool:
+    """複数のLLMサーバーへモデルごとに振り分け（実行中リクエストが最少のサーバー優先、障害時は別サーバーへ）"""
+    
+    def __init__(self, urls, log=print):
+        self.endpoints = [Endpoint(url, log) for url in dict.fromkeys(urls)]
+        self.log = log
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+    
+    def acquire(self, model, exclude=()):
+        """model を処理できるサーバーを1台選んで予約（無ければNone）。使い終わったら release()"""
+        with self.lock:
+            candidates = [e for e in self.endpoints if e not in exclude and e.serves(model)]
+            healthy = [e for e in candidates if e.healthy]
+            if healthy:
+                candidates = healthy
+            elif candidates:
+                # 全滅しているときは一番前に落ちたサーバーから試し直す
+                candidates = [min(candidates, key=lambda e: e.failed_at)]
+            if not candidates:
+                return None
+            # 同数なら目的のモデルが常駐しているサーバーを選ぶ
+            endpoint = min(candidates, key=lambda e: (e.outstanding, e.scheduler.resident != model))
+            endpoint.outstanding += 1
+            registry.set_gauge("llm_outstanding", endpoint.outstanding, endpoint=endpoint.base)
+            return endpoint
+    
+    def release(self, endpoint):
+        with self.lock:
+            endpoint.outstanding -= 1
+            registry.set_gauge("llm_outstanding", endpoint.outstanding, endpoint=endpoint.base)
+    
+    def mark_failed(self, endpoint, error):
+        with self.lock:
+            was_healthy = endpoint.healthy
+            endpoint.healthy = False
+            endpoint.failed_at = time.monotonic()
+        registry.inc("llm_failovers", endpoint=endpoint.base)
+        if was_healthy:
+            self.log(f"LLMサーバー障害: {endpoint.base} ({error})")
+    
+    def check_health(self):
+        """各サーバーの /v1/models を確認して稼働状態と提供モデルを更新"""
+        for endpoint in self.endpoints:
+            try:
+                response = requests.get(f"{endpoint.base}/v1/models", timeout=Config.LLM_HEALTH_TIMEOUT)
+                response.raise_for_status()
+                models = {model["id"] for model in response.json().get("data", [])}
+            except Exception as e:
+                if endpoint.healthy:
+                    self.mark_failed(endpoint, e)
+                continue
+            with self.lock:
+                recovered = not endpoint.healthy
+                endpoint.healthy = True
+                # モデル一覧が空のサーバー（JIT読み込み等）は何でも受け付けるとみなす
+                endpoint.models = models or None
+            if recovered:
+                self.log(f"LLMサーバー復帰: {endpoint.base}")
+        return [endpoint for endpoint in self.endpoints if endpoint.healthy]
+    
+    def start_health_checks(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._health_loop, daemon=True)
+        self.thread.start()
+    
+    def stop_health_checks(self):
+        self.stop_event.set()
+    
+    def _health_loop(self):
+        while not self.stop_event.is_set():
+            self.check_health()
+            self.stop_event.wait(Config.LLM_HEALTH_INTERVAL)
@@ -0,0 +1,239 @@
+import time
+import struct
+import argparse
+import cv2
+import numpy as np
+
+# 録画ファイル形式: ヘッダ + [タイムスタンプ, JPEG長, ラベル長, ラベル, JPEG] の繰り返し
+MAGIC = b"VRFR\x01"
+RECORD_HEADER = struct.Struct("<dIH")
+
+class FrameRecorder:
+    """カメラフレームをタイムスタンプ付きで1ファイルに録画"""
+    
+    def __init__(self, path, quality=85):
+        self.path = path
+        self.quality = quality
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.count = 0
+    
+    def write(self, frame, label="", timestamp=None):
+        """フレームを追記（labelは期待するトリガー名をカンマ区切り）"""
+        result, encoded = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.quality])
+        if not result:
+            return False
+        data = encoded.tobytes()
+        label_bytes = label.encode('utf-8')
+        self.file.write(RECORD_HEADER.pack(timestamp if timestamp is not None else time.time(),
+                                           len(data), len(label_bytes)))
+        self.file.write(label_bytes)
+        self.file.write(data)
+        self.count += 1
+        return True
+    
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def iter_records(path):
+    """録画ファイルから (timestamp, label, jpegバイト列) を順に読む"""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"録画ファイルではありません: {path}")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, data_len, label_len = RECORD_HEADER.unpack(header)
+            label = f.read(label_len).decode('utf-8')
+            yield timestamp, label, f.read(data_len)
+
+class ReplaySource:
+    """cv2.VideoCapture(0) の代わりに録画ファイルを再生するソース"""
+    
+    def __init__(self, path, realtime=True):
+        self.path = path
+        self.realtime = realtime
+        self.records = iter_records(path)
+        self.start_time = None
+        self.first_timestamp = None
+        self.exhausted = False
+        self.label = ""  # 直前に返したフレームのラベル
+        self.timestamp = None
+    
+    def isOpened(self):
+        return not self.exhausted
+    
+    def read(self):
+        try:
+            timestamp, label, data = next(self.records)
+        except StopIteration:
+            self.exhausted = True
+            return False, None
+        
+        # 実時間再生では録画時の間隔に合わせて待つ
+        if self.realtime:
+            if self.start_time is None:
+                self.start_time = time.perf_counter()
+                self.first_timestamp = timestamp
+            delay = (timestamp - self.first_timestamp) - (time.perf_counter() - self.start_time)
+            if delay > 0:
+                time.sleep(delay)
+        
+        self.label = label
+        self.timestamp = timestamp
+        frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return frame is not None, frame
+    
+    def release(self):
+        self.exhausted = True
+        self.records.close()
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return float(np.percentile(values, q))
+
+def replay_report(path, detect, realtime=False, window=10):
+    """録画を再生して検出遅延・ヒット/ミス・スループットを集計
+    
+    detect: fn(frame) -> トリガー名の集合
+    window: ラベル付きフレームから何フレーム以内の検出をヒットとみなすか
+    """
+    source = ReplaySource(path, realtime=realtime)
+    latencies = []
+    pending = []  # [期待トリガー名, 残りフレーム数]
+    hits, misses, false_positives = 0, 0, 0
+    detections = []
+    
+    start = time.perf_counter()
+    index = 0
+    while True:
+        ret, frame = source.read()
+        if not ret:
+            if source.exhausted:
+                break
+            continue
+        
+        for name in filter(None, source.label.split(',')):
+            pending.append([name.strip(), window])
+        
+        t0 = time.perf_counter()
+        found = detect(frame)
+        latencies.append(time.perf_counter() - t0)
+        
+        for name in found:
+            detections.append((index, name))
+            match = next((p for p in pending if p[0] == name), None)
+            if match:
+                pending.remove(match)
+                hits += 1
+            else:
+                false_positives += 1
+        
+        for p in pending:
+            p[1] -= 1
+        misses += sum(1 for p in pending if p[1] < 0)
+        pending = [p for p in pending if p[1] >= 0]
+        index += 1
+    
+    misses += len(pending)
+    elapsed = time.perf_counter() - start
+    return {
+        'frames': index,
+        'elapsed': elapsed,
+        'throughput_fps': index / elapsed if elapsed > 0 else 0.0,
+        'latency_p50_ms': percentile(latencies, 50) * 1000,
+        'latency_p95_ms': percentile(latencies, 95) * 1000,
+        'latency_max_ms': max(latencies) * 1000 if latencies else 0.0,
+        'hits': hits,
+        'misses': misses,
+        'false_positives': false_positives,
+        'detections': detections,
+    }
+
+def record_camera(path, seconds, camera_index=0):
+    """Webカメラから指定秒数だけ録画"""
+    camera = cv2.VideoCapture(camera_index)
+    recorder = FrameRecorder(path)
+    end = time.time() + seconds
+    try:
+        while time.time() < end:
+            ret, frame = camera.read()
+            if ret:
+                recorder.write(frame)
+    finally:
+        camera.release()
+        recorder.close()
+    return recorder.count
+
+def relabel(src, dst, labels):
+    """フレーム番号にラベルを付けた録画を書き出す（labels: {番号: 'pkaisetu'}）"""
+    recorder = FrameRecorder(dst)
+    try:
+        for index, (timestamp, label, data) in enumerate(iter_records(src)):
+            frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            recorder.write(frame, labels.get(index, label), timestamp)
+    finally:
+        recorder.close()
+    return recorder.count
+
+def main():
+    parser = argparse.ArgumentParser(description="カメラフレームの録画・再生ベンチマーク")
+    sub = parser.add_subparsers(dest="command", required=True)
+    
+    rec = sub.add_parser("record", help="Webカメラを録画")
+    rec.add_argument("path")
+    rec.add_argument("--seconds", type=float, default=30.0)
+    rec.add_argument("--camera", type=int, default=0)
+    
+    lab = sub.add_parser("label", help="フレーム番号に期待トリガーを付ける (例: 120:pkaisetu)")
+    lab.add_argument("src")
+    lab.add_argument("dst")
+    lab.add_argument("labels", nargs="+")
+    
+    rep = sub.add_parser("replay", help="録画を再生して検出性能を計測")
+    rep.add_argument("path")
+    rep.add_argument("--realtime", action="store_true", help="録画時と同じ間隔で再生")
+    rep.add_argument("--mode", choices=["detector", "full"], default="detector",
+                     help="detector: 軽量検出器, full: 毎フレームのフルOCR")
+    rep.add_argument("--window", type=int, default=10)
+    
+    args = parser.parse_args()
+    
+    if args.command == "record":
+        count = record_camera(args.path, args.seconds, args.camera)
+        print(f"{count}フレーム録画: {args.path}")
+    
+    elif args.command == "label":
+        labels = {}
+        for item in args.labels:
+            index, name = item.split(":", 1)
+            labels[int(index)] = name
+        count = relabel(args.src, args.dst, labels)
+        print(f"{count}フレーム書き出し: {args.dst}")
+    
+    elif args.command == "replay":
+        from yomitoku_wrapper import YomitokuWrapper
+        from trigger_detector import TriggerDetector, match_keywords
+        
+        ocr = YomitokuWrapper()
+        if args.mode == "detector":
+            detect = TriggerDetector(ocr).detect
+        else:
+            detect = lambda frame: match_keywords(ocr.predict_frame(frame))
+        
+        report = replay_report(args.path, detect, realtime=args.realtime, window=args.window)
+        for key, value in report.items():
+            if key == "detections":
+                for index, name in value:
+                    print(f"  frame {index}: {name}")
+            elif isinstance(value, float):
+                print(f"{key}: {value:.2f}")
+            else:
+                print(f"{key}: {value}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from config import Config
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS lessons (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user TEXT NOT NULL,
+    created REAL NOT NULL,
+    file_path TEXT,
+    problem_hash TEXT,
+    problem_text TEXT,
+    problems_json TEXT,
+    explanation TEXT,
+    slides TEXT,
+    lesson TEXT,
+    source_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_lessons_user ON lessons (user, created);
+CREATE INDEX IF NOT EXISTS idx_lessons_created ON lessons (created);
+CREATE INDEX IF NOT EXISTS idx_lessons_problem_hash ON lessons (problem_hash);
+CREATE INDEX IF NOT EXISTS idx_lessons_source_hash ON lessons (source_hash);
+"""
+
+COLUMNS = ("id", "user", "created", "file_path", "problem_hash", "problem_text",
+           "problems_json", "explanation", "slides", "lesson", "source_hash")
+
+def problem_hash(problem_text):
+    """表記ゆれ（全角半角・空白）を無視した問題文のハッシュ"""
+    normalized = ''.join(unicodedata.normalize('NFKC', problem_text or "").split())
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+class HistoryStore:
+    """アップロード・抽出した問題・解説・スライドをSQLiteに保存する授業履歴"""
+    
+    def __init__(self, path=None, slides_dir=None, max_lessons=None):
+        self.path = path or Config.HISTORY_DB
+        self.slides_dir = slides_dir or Config.SLIDES_DIR
+        self.max_lessons = max_lessons or Config.HISTORY_MAX_LESSONS
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.executescript(SCHEMA)
+            self.conn.commit()
+    
+    def add_upload(self, user, file_path):
+        """アップロードを記録して授業IDを返す"""
+        with self.lock:
+            cursor = self.conn.execute("INSERT INTO lessons (user, created, file_path) VALUES (?, ?, ?)",
+                                       (user, time.time(), file_path))
+            self.conn.commit()
+            lesson_id = cursor.lastrowid
+        self._prune()
+        return lesson_id
+    
+    def record_problems(self, lesson_id, problems_json, problem_text):
+        with self.lock:
+            self.conn.execute("UPDATE lessons SET problems_json = ?, problem_text = ?, problem_hash = ? WHERE id = ?",
+                              (problems_json, problem_text, problem_hash(problem_text), lesson_id))
+            self.conn.commit()
+    
+    def record_source(self, lesson_id, source_text):
+        """OCRで読み取った文字を記録（同じ宿題の再アップロードを見分ける）"""
+        with self.lock:
+            self.conn.execute("UPDATE lessons SET source_hash = ? WHERE id = ?",
+                              (problem_hash(source_text), lesson_id))
+            self.conn.commit()
+    
+    def record_lesson(self, lesson_id, explanation, slides, lesson):
+        """解説とスライドを保存（スライドは授業ごとのディレクトリに複製）
+        
+        slides は {'path', 'narration', 'step_index'} のリスト、lesson は Lesson.to_dict()
+        """
+        kept = self._keep_slides(lesson_id, slides)
+        with self.lock:
+            self.conn.execute("UPDATE lessons SET explanation = ?, slides = ?, lesson = ? WHERE id = ?",
+                              (explanation, json.dumps(kept, ensure_ascii=False),
+                               json.dumps(lesson, ensure_ascii=False), lesson_id))
+            self.conn.commit()
+        return kept
+    
+    def get(self, lesson_id):
+        return self._one("SELECT * FROM lessons WHERE id = ?", (lesson_id,))
+    
+    def latest(self, user=None, completed=True):
+        """最新の授業（completed=Trueなら解説まで出来たもの）"""
+        condition = "explanation IS NOT NULL" if completed else "1"
+        if user is None:
+            return self._one(f"SELECT * FROM lessons WHERE {condition} ORDER BY id DESC LIMIT 1")
+        return self._one(f"SELECT * FROM lessons WHERE user = ? AND {condition} ORDER BY id DESC LIMIT 1", (user,))
+    
+    def recent(self, limit=50):
+        return self._all("SELECT * FROM lessons ORDER BY id DESC LIMIT ?", (limit,))
+    
+    def by_user(self, user, limit=50):
+        return self._all("SELECT * FROM lessons WHERE user = ? ORDER BY created DESC LIMIT ?", (user, limit))
+    
+    def between(self, start, end):
+        """作成時刻（UNIX秒）が start 以上 end 未満の授業"""
+        return self._all("SELECT * FROM lessons WHERE created >= ? AND created < ? ORDER BY created",
+                         (start, end))
+    
+    def by_problem(self, problem_text=None, hash_value=None):
+        """同じ問題を扱った授業（新しい順）"""
+        hash_value = hash_value or problem_hash(problem_text)
+        return self._all("SELECT * FROM lessons WHERE problem_hash = ? ORDER BY id DESC", (hash_value,))
+    
+    def by_source(self, source_text):
+        """同じ文字が読み取れた、解説まで出来ている最新の授業（無ければNone）"""
+        return self._one("SELECT * FROM lessons WHERE source_hash = ? AND explanation IS NOT NULL "
+                         "ORDER BY id DESC LIMIT 1", (problem_hash(source_text),))
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+    
+    def _one(self, sql, params=()):
+        rows = self._all(sql, params)
+        return rows[0] if rows else None
+    
+    def _all(self, sql, params=()):
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [self._to_dict(row) for row in rows]
+    
+    @staticmethod
+    def _to_dict(row):
+        lesson = {column: row[column] for column in COLUMNS}
+        lesson['slides'] = json.loads(lesson['slides']) if lesson['slides'] else []
+        lesson['lesson'] = json.loads(lesson['lesson']) if lesson['lesson'] else None
+        return lesson
+    
+    def _lesson_dir(self, lesson_id):
+        return os.path.join(self.slides_dir, f"lesson_{lesson_id}")
+    
+    def _keep_slides(self, lesson_id, slides):
+        """一時ディレクトリで上書きされるスライドを授業ごとに保存"""
+        lesson_dir = self._lesson_dir(lesson_id)
+        os.makedirs(lesson_dir, exist_ok=True)
+        kept = []
+        for index, slide in enumerate(slides):
+            path = slide.get('path') if slide else None
+            if not path or not os.path.exists(path):
+                continue
+            destination = os.path.join(lesson_dir, f"{index:02d}_{os.path.basename(path)}")
+            shutil.copyfile(path, destination)
+            kept.append(dict(slide, path=destination))
+        return kept
+    
+    def _prune(self):
+        """件数上限を超えた古い授業とそのスライドを削除"""
+        with self.lock:
+            rows = self.conn.execute("SELECT id FROM lessons ORDER BY id DESC LIMIT -1 OFFSET ?",
+                                     (self.max_lessons,)).fetchall()
+            if not rows:
+                return
+            ids = [row["id"] for row in rows]
+            self.conn.executemany("DELETE FROM lessons WHERE id = ?", [(i,) for i in ids])
+            self.conn.commit()
+        for lesson_id in ids:
+            shutil.rmtree(self._lesson_dir(lesson_id), ignore_errors=True)
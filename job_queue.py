@@ -0,0 +1,136 @@
+import itertools
+import threading
+import time
+from collections import deque
+from config import Config
+from metrics import registry
+
+class TokenBucket:
+    """rate 個/秒で溜まり、最大 burst 個まで持てるトークン"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def take(self, amount=1):
+        self._refill()
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+    
+    def refund(self, amount=1):
+        self._refill()
+        self.tokens = min(self.burst, self.tokens + amount)
+    
+    def retry_after(self, amount=1):
+        """amount 個溜まるまでの秒数"""
+        self._refill()
+        return max(0.0, (amount - self.tokens) / self.rate) if self.rate > 0 else float("inf")
+
+class FairJobQueue:
+    """ユーザーごとのレート制限と重み付き公平キュー（自己クロック型WFQ）で宿題処理を1件ずつ流す
+    
+    各ジョブに「開始 = max(仮想時刻, そのユーザーの前のジョブの終了)、終了 = 開始 + コスト / 重み」の
+    タグを付け、終了タグが一番小さいジョブから実行する。連投したユーザーのジョブは後ろに伸びるだけで、
+    他のユーザーの順番は変わらない。キャッシュから出せる授業は別枠で先に流す。
+    """
+    
+    def __init__(self, claim, release, log=print):
+        # claim() -> 次のジョブのために処理の枠を確保できればTrue（確認と確保を一度に行う）
+        # release() -> ジョブが枠を使い終えずに戻ったときに返す
+        self.claim = claim
+        self.release = release
+        self.log = log
+        self.condition = threading.Condition()
+        self.buckets = {}  # ユーザー -> TokenBucket
+        self.queues = {}  # ユーザー -> deque[(終了タグ, 通し番号, ジョブ)]
+        self.last_finish = {}  # ユーザー -> 最後に積んだジョブの終了タグ
+        self.virtual_time = 0.0
+        self.priority = deque()  # キャッシュから出せる授業（待たせない）
+        self.sequence = itertools.count()
+        self.thread = None
+    
+    def admit(self, user):
+        """レート制限内なら (True, 0)、超えていれば (False, 待つべき秒数)"""
+        with self.condition:
+            bucket = self.buckets.get(user)
+            if bucket is None:
+                bucket = self.buckets[user] = TokenBucket(Config.USER_JOB_RATE, Config.USER_JOB_BURST)
+            if bucket.take():
+                return True, 0.0
+            registry.inc("job_rate_limited")
+            return False, bucket.retry_after()
+    
+    def refund(self, user):
+        """admit で使った分を返す（キャッシュで済んだとき等）"""
+        with self.condition:
+            if user in self.buckets:
+                self.buckets[user].refund()
+    
+    def submit(self, user, job, cost=1.0):
+        """ジョブを積んで順番（1始まり）を返す。そのユーザーの待ちが上限ならNone"""
+        with self.condition:
+            queue = self.queues.setdefault(user, deque())
+            if len(queue) >= Config.USER_MAX_QUEUED:
+                return None
+            weight = Config.USER_WEIGHTS.get(user, 1.0)
+            start = max(self.virtual_time, self.last_finish.get(user, 0.0))
+            finish = self.last_finish[user] = start + cost / weight
+            queue.append((finish, next(self.sequence), job))
+            position = len(self.priority) + sum(1 for jobs in self.queues.values()
+                                                for tag, _, _ in jobs if tag <= finish)
+            self.condition.notify_all()
+        return position
+    
+    def submit_priority(self, job):
+        """キャッシュから出せる授業は公平キューより先に流す"""
+        with self.condition:
+            self.priority.append(job)
+            self.condition.notify_all()
+    
+    @property
+    def depth(self):
+        with self.condition:
+            return len(self.priority) + sum(len(jobs) for jobs in self.queues.values())
+    
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def _pop(self):
+        """次のジョブ（condition を持った状態で呼ぶ）"""
+        if self.priority:
+            return self.priority.popleft()
+        waiting = [user for user, jobs in self.queues.items() if jobs]
+        if not waiting:
+            return None
+        user = min(waiting, key=lambda u: self.queues[u][0][:2])
+        finish, _, job = self.queues[user].popleft()
+        self.virtual_time = finish
+        return job
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                # ジョブがあり、前の授業が終わって枠を確保できるまで待つ
+                # （確認してから始めるまでの間に他の処理に枠を取られないよう、確保してから取り出す）
+                while not (self.depth and self.claim()):
+                    self.condition.wait(Config.JOB_QUEUE_POLL)
+                job = self._pop()
+                registry.set_gauge("job_queue_depth", self.depth)
+            try:
+                job()
+            except Exception as e:
+                self.log(f"ジョブ実行エラー: {e}")
+            finally:
+                self.release()
@@ -0,0 +1,198 @@
+import re
+import json
+from dataclasses import dataclass, field, asdict
+from config import Config
+from utils import parse_json_response, compile_expression, trim_to_sentence, strip_markdown
+
+MAX_STEPS = 5
+STEP_KEYWORDS = ('ステップ', 'Step', '手順', '①', '②', '③', '④', '⑤')
+
+# 1回の生成で問題・ステップ・読み上げ文・グラフ式をまとめて返させるためのスキーマ
+LESSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "problems": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "problem_number": {"type": "string"},
+                    "problem_text": {"type": "string"},
+                    "problem_type": {"type": "string"},
+                    "difficulty": {"type": "string"}
+                },
+                "required": ["problem_number", "problem_text", "problem_type", "difficulty"]
+            }
+        },
+        "intro": {"type": "string"},
+        "steps": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "title": {"type": "string"},
+                    "narration": {"type": "string"},
+                    "expression": {"type": "string"}
+                },
+                "required": ["title", "narration", "expression"]
+            }
+        },
+        "graph_expression": {"type": "string"},
+        "summary": {"type": "string"}
+    },
+    "required": ["problems", "intro", "steps", "graph_expression", "summary"]
+}
+
+def response_format():
+    """OpenAI互換APIの response_format（LM Studioの構造化出力）"""
+    return {"type": "json_schema", "json_schema": {"name": "lesson", "strict": True, "schema": LESSON_SCHEMA}}
+
+def is_valid_lesson(data):
+    """最低限の形（問題とステップが1つ以上）を満たすか"""
+    if not isinstance(data, dict):
+        return False
+    problems = data.get("problems")
+    steps = data.get("steps")
+    return bool(problems) and isinstance(problems, list) and bool(steps) and isinstance(steps, list) \
+        and all(isinstance(step, dict) and step.get("narration") for step in steps)
+
+@dataclass
+class Problem:
+    number: str = ""
+    text: str = ""
+    type: str = ""
+    difficulty: str = ""
+
+@dataclass
+class Step:
+    title: str
+    narration: str
+    expression: str = ""
+
+@dataclass
+class SlideSpec:
+    """スライド1枚分（描画の種類とパラメータ、読み上げ文）"""
+    kind: str  # title, step, graph, celebration
+    params: dict
+    narration: str
+    step_index: int = -1  # kind == "step" のときのステップ番号（0始まり）
+
+@dataclass
+class Lesson:
+    """1回の宿題処理で作る授業（問題 → ステップ → 読み上げ文・式・グラフ）"""
+    problems: list = field(default_factory=list)
+    intro: str = ""
+    steps: list = field(default_factory=list)
+    graph_expression: str = ""
+    summary: str = ""
+    
+    @property
+    def problem_text(self):
+        return self.problems[0].text if self.problems else ""
+    
+    def slide_plan(self):
+        """スライドの並びと各スライドの読み上げ文"""
+        problem = self.problems[0] if self.problems else Problem()
+        plan = [SlideSpec("title", {'problem_text': problem.text or "数学問題",
+                                    'steps': [step.title for step in self.steps],
+                                    'title': f"{problem.type}の解き方" if problem.type else "問題の解き方"},
+                          self.intro or "お兄ちゃん、一緒に勉強しよう！")]
+        for i, step in enumerate(self.steps):
+            content = step.title if not step.expression else f"{step.title}\n{step.expression}"
+            plan.append(SlideSpec("step", {'step_number': i + 1, 'step_content': content,
+                                           'total_steps': len(self.steps)},
+                                  step.narration, i))
+        if self.graph_expression:
+            plan.append(SlideSpec("graph", {'equation': self.graph_expression},
+                                  "グラフでも確かめてみよう！x軸と交わるところが答えだよ。"))
+        plan.append(SlideSpec("celebration", {}, self.summary or "よくできました！"))
+        return plan
+    
+    def problems_json(self):
+        """analyze_problems と同じ形の問題JSON"""
+        return json.dumps({"problems": [{"problem_number": p.number, "problem_text": p.text,
+                                         "problem_type": p.type, "difficulty": p.difficulty}
+                                        for p in self.problems]}, ensure_ascii=False)
+    
+    def explanation_text(self):
+        """読み上げ文を段落でつないだ解説文（履歴表示用）"""
+        parts = [self.intro] + [f"ステップ{i}: {step.title}\n{step.narration}"
+                                for i, step in enumerate(self.steps, 1)] + [self.summary]
+        return "\n\n".join(part.strip() for part in parts if part and part.strip())
+    
+    def to_dict(self):
+        return asdict(self)
+    
+    @classmethod
+    def from_dict(cls, data):
+        """to_dict() の逆（履歴から復元）"""
+        return cls(problems=[Problem(**problem) for problem in data.get("problems", [])],
+                   intro=data.get("intro", ""),
+                   steps=[Step(**step) for step in data.get("steps", [])],
+                   graph_expression=data.get("graph_expression", ""),
+                   summary=data.get("summary", ""))
+    
+    @classmethod
+    def from_structured(cls, data):
+        """LESSON_SCHEMA に従った構造化出力から作成"""
+        steps = [Step(str(step.get("title", "")).strip(), _narration(step.get("narration", "")),
+                      str(step.get("expression", "")).strip())
+                 for step in data.get("steps", [])[:MAX_STEPS]]
+        graph = str(data.get("graph_expression", "")).strip()
+        return cls(problems=_parse_problems(data),
+                   intro=_narration(data.get("intro", "")),
+                   steps=steps,
+                   graph_expression=graph if compile_expression(graph) else "",
+                   summary=_narration(data.get("summary", "")))
+    
+    @classmethod
+    def from_texts(cls, problems_json, explanation):
+        """2回呼び出し（問題JSON＋自由文の解説）から一度だけ解析して作成"""
+        problems = _parse_problems(parse_json_response(problems_json) or {})
+        # 履歴の古い解説には見出し記号が残っていることがある
+        paragraphs = [p.strip() for p in strip_markdown(explanation).split('\n\n') if p.strip()]
+        
+        step_indexes = [i for i, p in enumerate(paragraphs) if any(k in p for k in STEP_KEYWORDS)]
+        if step_indexes:
+            first, last = step_indexes[0], step_indexes[-1]
+        else:
+            # 見出しが無ければ最初と最後以外の段落をステップとみなす
+            first, last = (1, len(paragraphs) - 2) if len(paragraphs) > 2 else (0, len(paragraphs) - 1)
+        intro = _narration("\n".join(paragraphs[:first]))
+        body = paragraphs[first:last + 1]
+        summary = _narration("\n".join(paragraphs[last + 1:]))
+        
+        groups = [[paragraph] for paragraph in body]
+        if len(groups) > MAX_STEPS:
+            # 多すぎる分は最後のステップにまとめる（読み上げは段落ごとに収めて、まとめた分も削らない）
+            groups = groups[:MAX_STEPS - 1] + [body[MAX_STEPS - 1:]]
+        steps = [Step(_step_title(group[0]), "\n".join(_narration(paragraph) for paragraph in group),
+                      _first_equation("\n".join(group))) for group in groups]
+        
+        problem_text = problems[0].text if problems else ""
+        graph = _first_equation(problem_text)
+        return cls(problems=problems, intro=intro, steps=steps,
+                   graph_expression=graph if compile_expression(graph) else "",
+                   summary=summary)
+
+def _parse_problems(data):
+    problems = data.get("problems") if isinstance(data, dict) else None
+    return [Problem(str(p.get("problem_number", "")), str(p.get("problem_text", "")),
+                    str(p.get("problem_type", "")), str(p.get("difficulty", "")))
+            for p in (problems or []) if isinstance(p, dict)]
+
+def _narration(text):
+    """スライド1枚で読み上げる長さに収める"""
+    return trim_to_sentence(str(text).strip(), Config.NARRATION_MAX_CHARS)
+
+def _step_title(paragraph):
+    """「ステップ1: 〜。」の見出し部分（最初の文を短く）"""
+    line = paragraph.split('\n')[0]
+    line = re.sub(r'^(ステップ|Step|手順)\s*\d+\s*[:：.]?\s*', '', line).lstrip('①②③④⑤ ')
+    sentence = re.split(r'[。！？!?]', line)[0]
+    return sentence[:30] or line[:30]
+
+def _first_equation(text):
+    """文中の「〜 = 〜」を1つ取り出す（日本語の前後は除く）"""
+    match = re.search(r'[0-9A-Za-z²³^()+\-*/ .]+=[0-9A-Za-z²³^()+\-*/ .]+', text or "")
+    return match.group(0).strip() if match else ""
@@ -0,0 +1,220 @@
+import threading
+import time
+from config import Config
+from cancellation import CancelToken
+
+class LessonPlayer:
+    """スライドのカーソルを持ち、スキップ・リピート・速度変更にすぐ反応する授業再生エンジン"""
+    
+    def __init__(self, show, synthesize, play_audio, stop_audio, log=print, on_finish=None):
+        # show(slide_path, token), synthesize(text, speed, token) -> (音声パス, 秒数) または None,
+        # play_audio(音声パス), stop_audio(), on_finish() は最後のスライドまで再生し終えたとき（stopでは呼ばない）
+        self.show = show
+        self.synthesize = synthesize
+        self.play_audio = play_audio
+        self.stop_audio = stop_audio
+        self.log = log
+        self.on_finish = on_finish
+        
+        self.slides = []
+        self.narrations = []
+        self.cursor = 0
+        self.speed = Config.SPEECH_SPEED_DEFAULT
+        self.condition = threading.Condition()
+        self.command = None  # 再生スレッドへの割り込み（skip, repeat, restart, speed, pause, stop）
+        self.paused = False
+        self.thread = None
+        self.lesson_token = CancelToken()
+        self.utterance_token = CancelToken()  # 合成中の1発話（割り込みでキャンセル）
+    
+    @property
+    def playing(self):
+        return self.thread is not None and self.thread.is_alive()
+    
+    def play(self, slides, narrations, intro=None):
+        """授業を先頭から再生（再生中なら何もしない）"""
+        if self.playing:
+            self.log("授業は再生中です")
+            return False
+        with self.condition:
+            self.slides = list(slides)
+            self.narrations = list(narrations)
+            self.cursor = 0
+            self.command = None
+            self.paused = False
+            self.lesson_token = CancelToken()
+        self.thread = threading.Thread(target=self._run, args=(intro,), daemon=True)
+        self.thread.start()
+        return True
+    
+    def wait(self, timeout=None):
+        """再生終了まで待つ"""
+        if self.thread:
+            self.thread.join(timeout)
+    
+    def skip(self):
+        self._interrupt("skip")
+    
+    def repeat(self):
+        self._interrupt("repeat")
+    
+    def restart(self):
+        self._interrupt("restart")
+    
+    def stop(self):
+        self.lesson_token.cancel("stop")
+        self._interrupt("stop")
+    
+    def pause(self):
+        """今のスライドで一時停止（再生中でなければFalse）"""
+        with self.condition:
+            if not self.playing or self.paused:
+                return False
+            self.paused = True
+        self._interrupt("pause")
+        return True
+    
+    def resume(self):
+        """一時停止したスライドの頭から再開"""
+        with self.condition:
+            self.paused = False
+            self.condition.notify_all()
+    
+    def faster(self):
+        self._set_speed(self.speed + Config.SPEECH_SPEED_STEP)
+    
+    def slower(self):
+        self._set_speed(self.speed - Config.SPEECH_SPEED_STEP)
+    
+    def _set_speed(self, speed):
+        self.speed = min(Config.SPEECH_SPEED_MAX, max(Config.SPEECH_SPEED_MIN, round(speed, 2)))
+        self.log(f"話す速さ: {self.speed:.2f}")
+        # 今のスライドを新しい速さで言い直す
+        self._interrupt("speed")
+    
+    def _interrupt(self, command):
+        with self.condition:
+            if not self.playing:
+                return
+            # 一時停止中は割り込み側（Pkaisetuの回答など）が話しているので音声は止めない
+            silent = self.paused and command not in ("pause", "stop")
+            self.command = command
+            self.condition.notify_all()
+        self.utterance_token.cancel(command)
+        if not silent:
+            self.stop_audio()
+    
+    def _take_command(self):
+        with self.condition:
+            command, self.command = self.command, None
+            return command
+    
+    def _wait(self, seconds):
+        """指定秒数待つ。途中でコマンドが来たらそれを返す"""
+        deadline = time.monotonic() + seconds
+        with self.condition:
+            while self.command is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            command, self.command = self.command, None
+            return command
+    
+    def _say(self, text):
+        """合成して流し、話し終わるまで（またはコマンドが来るまで）待つ"""
+        token = self.utterance_token = self.lesson_token.child()
+        audio = self._synthesize_interruptibly(text, token) if text else None
+        # 合成中に届いたコマンドがあれば古い音声は流さない
+        command = self._take_command()
+        if command is not None or token.cancelled:
+            return command
+        duration = 0
+        if audio:
+            audio_path, duration = audio
+            self.play_audio(audio_path)
+        return self._wait(duration + Config.SLIDE_INTERVAL)
+    
+    def _synthesize_interruptibly(self, text, token):
+        """合成を別スレッドで走らせ、終わるかコマンドが来るまで待つ
+        
+        合成のHTTP呼び出しは途中で止められないので、コマンドが来たら結果を待たずに戻る
+        （残りの合成は token がキャンセル済みなので結果は捨てられる）。
+        """
+        result = []
+        speed = self.speed
+        
+        def run():
+            try:
+                audio = self.synthesize(text, speed, token)
+            except Exception as e:
+                self.log(f"読み上げ合成エラー: {e}")
+                audio = None
+            with self.condition:
+                result.append(audio)
+                self.condition.notify_all()
+        
+        threading.Thread(target=run, daemon=True).start()
+        with self.condition:
+            while not result and self.command is None:
+                self.condition.wait()
+        return result[0] if result else None
+    
+    def _run(self, intro):
+        if intro:
+            command = self._say(intro)
+            if self.paused or command == "pause":
+                command = self._wait_resume(command)
+            if command == "stop":
+                return
+        
+        shown = None
+        while 0 <= self.cursor < len(self.slides):
+            index = self.cursor
+            if shown != index:
+                self.show(self.slides[index], self.lesson_token)
+                shown = index
+            
+            narration = self.narrations[index] if index < len(self.narrations) else ""
+            command = self._say(narration)
+            
+            # pause の直後に届いたコマンドで上書きされていても一時停止を優先
+            if self.paused or command == "pause":
+                if self._wait_resume(command, move_cursor=True) == "stop":
+                    break
+                shown = None  # 割り込み中に別のスライドが出ているので出し直す
+                continue
+            
+            if command == "stop":
+                break
+            elif command == "skip" or command is None:
+                self.cursor = index + 1
+            elif command == "restart":
+                self.cursor = 0
+                shown = None
+            # repeat, speed は同じスライドをもう一度
+        else:
+            if self.on_finish:
+                self.on_finish()
+    
+    def _wait_resume(self, command=None, move_cursor=False):
+        """resume() されるまで待つ。stop が来たら "stop" を返す
+        
+        command は一時停止に気づく前に受け取ったコマンド。待っている間の skip, restart は
+        カーソルだけ動かし（move_cursor=False のイントロ中は無視）、repeat, speed は再開後の
+        スライドにそのまま反映される。
+        """
+        with self.condition:
+            while True:
+                if command == "stop":
+                    return command
+                if move_cursor:
+                    if command == "skip":
+                        self.cursor = min(self.cursor + 1, len(self.slides))
+                    elif command == "restart":
+                        self.cursor = 0
+                if self.command is None:
+                    if not self.paused:
+                        return None
+                    self.condition.wait()
+                command, self.command = self.command, None
@@ -5,8 +5,12 @@ import socket
 import threading
 import time
 import os
+import io
 import json
+import wave
 import queue
+import logging
+from logging.handlers import RotatingFileHandler
 import tkinter as tk
 from tkinter import ttk, scrolledtext
 from PIL import Image, ImageTk
@@ -18,12 +22,30 @@ import subprocess
 import tempfile
 import numpy as np
 import uuid  # 追加
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from config import Config
 from yomitoku_wrapper import YomitokuWrapper
 from nougat_wrapper import NougatWrapper
-from slide import (create_slide_1, create_pkaisetu_slide, create_math_graph_slide, 
-                   create_step_by_step_slide, create_celebration_slide)
-from utils import validate_image_file, resize_image, extract_math_expressions  # 追加
+from trigger_detector import TriggerDetector, TRIGGER_KEYWORDS
+from frame_replay import ReplaySource, FrameRecorder
+from metrics import registry, span, start_metrics_server
+from storage_manager import StorageManager
+from history_store import HistoryStore
+from lesson_player import LessonPlayer
+from cancellation import CancelToken, CancelledError, check
+from pkaisetu_prefetch import PkaisetuPrefetcher
+from endpoint_pool import EndpointPool, EndpointError
+from discord_status import DiscordStatus
+from job_queue import FairJobQueue
+import lesson_model
+from slide import create_pkaisetu_slide, render_slide
+try:
+    import psutil
+except ImportError:
+    psutil = None
+from utils import (extract_math_expressions, encode_image_payload,  # 追加
+                   parse_json_response, trim_to_sentence, strip_markdown, LoadedImage)
 
 class VRSenseiSystem:
     def __init__(self):
@@ -31,10 +53,20 @@ class VRSenseiSystem:
         Config.create_directories()
         self.config = Config()
         
+        # ログ（ワーカーはキューに積み、GUIスレッドがまとめて表示）
+        self.log_queue = queue.Queue(maxsize=self.config.GUI_LOG_QUEUE_SIZE)
+        self.file_logger = logging.getLogger("vr_sensei")
+        if not self.file_logger.handlers:
+            handler = RotatingFileHandler(self.config.LOG_FILE, maxBytes=self.config.LOG_MAX_BYTES,
+                                          backupCount=self.config.LOG_BACKUP_COUNT, encoding='utf-8')
+            handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+            self.file_logger.addHandler(handler)
+            self.file_logger.setLevel(logging.INFO)
+        
         # 設定値を修正
         self.quest_ip = self.config.QUEST_IP
         self.quest_port = self.config.QUEST_PORT
-        self.lmstudio_url = self.config.LMSTUDIO_URL
+        self.endpoint_pool = EndpointPool(self.config.LMSTUDIO_URLS or [self.config.LMSTUDIO_URL], self.log)
         self.voicevox_url = self.config.VOICEVOX_URL
         
         # tmp_dirも設定から取得
@@ -43,19 +75,40 @@ class VRSenseiSystem:
         # 状態管理
         self.genshori_phase = "waiting"  # waiting, processing, teaching, pkaisetu
         self.genshori_lock = threading.Lock()
+        self.teaching_since = 0.0  # 授業の準備ができた（または再生し終えた）時刻
         self.pkaisetu_processing = False
         self.last_pkaisetu_time = 0
         self.pkaisetu_cooldown = 5.0
+        self.job_token = None  # 宿題処理のキャンセル用
+        self.structured_output_supported = None  # LM Studioが response_format を受け付けるか（未確認はNone）
+        self.pkaisetu_token = None  # Pkaisetu処理のキャンセル用
         
         # データ保存
         self.tmp_dir = "./tmp"
         os.makedirs(self.tmp_dir, exist_ok=True)
+        self.current_lesson = None  # lesson_model.Lesson
         self.current_slides = []
-        self.current_explanation = ""
-        self.discord_history = []
+        self.current_narrations = []  # スライドごとの読み上げ文
+        self.current_step_indexes = []  # スライドごとのステップ番号（ステップ以外は-1）
+        self.current_problem = ""
+        self.current_lesson_id = None
+        self.narration_audio = {}  # (読み上げ文, 速さ) -> (音声パス, 秒数)
+        self.slide_pool = None  # スライド描画用プロセスプール（初回に作成）
+        self.tts_pool = ThreadPoolExecutor(max_workers=self.config.TTS_WORKERS)
+        self.ingest_pool = ThreadPoolExecutor(max_workers=self.config.INGEST_WORKERS)  # Discord添付の取り込み
+        self.job_queue = FairJobQueue(self._claim_for_job, self._release_job, self.log)  # Discordからの宿題の順番待ち
+        self.storage = StorageManager(self.tmp_dir)
+        self.history = HistoryStore()
+        self.lesson_player = LessonPlayer(self.send_image_to_vr, self._synthesize_narration,
+                                          self.send_audio_to_unity, self.stop_audio, self.log,
+                                          on_finish=self._lesson_finished)
+        self.prefetcher = PkaisetuPrefetcher(self.generate_step_explanation, self.synthesize,
+                                             self._prefetch_idle, self.storage, self.log)
         
         # カメラとソケット
         self.camera = None
+        self.camera_thread = None
+        self.camera_stop = threading.Event()  # 終了時に監視ループを抜ける
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         
         # Discord Bot
@@ -70,10 +123,13 @@ class VRSenseiSystem:
         self.gui_root = None
         self.status_text = None
         self.log_text = None
+        self.metrics_tree = None
+        self.dashboard_labels = {}
         
         # AI モデル（修正版）
         self.nougat_model = None
         self.yomitoku_model = None
+        self.trigger_detector = None
         self.init_models()
         
         # コマンド認識パターン
@@ -90,8 +146,9 @@ class VRSenseiSystem:
         """AIモデルの初期化（修正版）"""
         try:
             self.log("モデル初期化中...")
-            self.nougat_model = NougatWrapper()
             self.yomitoku_model = YomitokuWrapper()
+            self.nougat_model = NougatWrapper(self.yomitoku_model)
+            self.trigger_detector = TriggerDetector(self.yomitoku_model)
             self.log("モデル初期化完了")
         except Exception as e:
             self.log(f"モデル初期化エラー: {e}")
@@ -111,97 +168,302 @@ class VRSenseiSystem:
                 await self.process_discord_attachment(message)
     
     async def process_discord_attachment(self, message):
-        """Discord添付ファイルの処理"""
+        """Discord添付ファイルの処理（1メッセージの添付は同じ宿題のページとしてまとめて扱う）"""
         try:
-            attachment = message.attachments[0]
-            if not attachment.filename.lower().endswith(('.png', '.jpg', '.jpeg', '.pdf')):
+            attachments = [attachment for attachment in message.attachments
+                           if attachment.filename.lower().endswith(('.png', '.jpg', '.jpeg', '.pdf'))]
+            if not attachments:
                 await message.reply("画像またはPDFファイルを送ってね！")
                 return
+            attachments = attachments[:self.config.DISCORD_MAX_ATTACHMENTS]
             
-            # ファイル保存
-            file_path = os.path.join(self.tmp_dir, f"discord_{uuid.uuid4()}_{attachment.filename}")
-            await attachment.save(file_path)
+            # ダウンロードする前にユーザーごとのレート制限
+            user = str(message.author)
+            allowed, retry_after = self.job_queue.admit(user)
+            if not allowed:
+                await message.reply(f"送るのが早すぎるよ～あと{int(retry_after) + 1}秒待ってから送ってね！")
+                return
             
-            # ファイル検証
-            if not attachment.filename.lower().endswith('.pdf'):
-                is_valid, error_msg = validate_image_file(file_path)
-                if not is_valid:
-                    await message.reply(f"ファイルエラー: {error_msg}")
-                    return
-                
-                # 画像リサイズ
-                resize_image(file_path)
+            # 添付ごとにダウンロード・デコード・検証・縮小を並列に（重い処理はイベントループの外で）
+            results = await asyncio.gather(*(self.ingest_attachment(attachment) for attachment in attachments))
+            pages = [page for page, _ in results if page]
+            errors = [f"{attachment.filename}: {error}" for attachment, (_, error) in zip(attachments, results) if error]
+            if not pages:
+                self.job_queue.refund(user)
+                await message.reply("ファイルエラー: " + " / ".join(errors))
+                return
+            
+            paths = [page['path'] for page in pages]
+            reply = "画像を受け取ったよ！" if len(paths) == 1 else f"{len(paths)}枚まとめて受け取ったよ！"
+            reply += "解説を作ってるから少し待ってね～♪"
+            if errors:
+                reply += "\n読めなかったファイル: " + " / ".join(errors)
+            # この返信を処理の進み具合に合わせて書き換える
+            loop = asyncio.get_running_loop()
+            status = DiscordStatus(await message.reply(reply), loop, log=self.log)
             
-            self.discord_history.append({
-                'file_path': file_path,
-                'timestamp': datetime.now(),
-                'user': str(message.author)
-            })
+            # デコード済みの配列をそのままOCRに渡す
+            text_content = await loop.run_in_executor(self.ingest_pool, self.extract_page_texts, pages)
+            status.update("・文字を読み取ったよ" if text_content.strip() else "・文字は読み取れなかったから画像から考えるね")
             
-            await message.reply("画像を受け取ったよ！解説を作ってるから少し待ってね～♪")
+            # 前に同じ宿題の授業を作っていれば順番待ちせずにそれを使う
+            cached = self.find_cached_lesson(text_content)
+            if cached:
+                self.job_queue.refund(user)
+                self.job_queue.submit_priority(lambda: self.serve_cached_lesson(cached['id'], status.update))
+                return
             
-            # 非同期処理開始
-            threading.Thread(target=self.process_homework_image, args=(file_path,), daemon=True).start()
+            lesson_id = self.history.add_upload(user, paths[0])
+            queued = []  # 順番待ちを知らせたら、始まるときにも知らせる
+            
+            def run_job():
+                if queued:
+                    status.update("・順番が来たよ！解説を作り始めるね")
+                self.process_homework_image(paths, lesson_id, text_content, status.update, claimed=True)
+            
+            # ユーザー間で公平に順番待ち（1件ずつ処理）
+            position = self.job_queue.submit(user, run_job)
+            if position is None:
+                self.job_queue.refund(user)
+                status.update(f"・順番待ちが{self.config.USER_MAX_QUEUED}件たまってるから、終わってからまた送ってね")
+            elif position > 1 or not self._ready_for_job():
+                queued.append(position)
+                status.update(f"・順番待ち: {position}番目")
             
         except Exception as e:
             self.log(f"Discord処理エラー: {e}")
             await message.reply("エラーが発生したよ～ごめんね！")
     
-    def process_homework_image(self, image_path):
-        """宿題画像の処理"""
+    def _ready_for_job(self):
+        """次の宿題をすぐ始められるか（状態は変えない）"""
+        with self.genshori_lock:
+            return self.genshori_phase == "waiting" and not self.pkaisetu_processing
+    
+    def _claim_for_job(self):
+        """順番待ちのジョブ用に処理の枠を確保（準備した授業が始まらずに放置されていれば終わらせて譲る）"""
+        with self.genshori_lock:
+            if self.genshori_phase == "teaching" and not self.lesson_player.playing \
+                    and time.monotonic() - self.teaching_since > self.config.LESSON_IDLE_TIMEOUT:
+                self.genshori_phase = "waiting"
+                self.log("授業が始まらないまま時間が経ったので次の宿題に移ります")
+            if self.genshori_phase != "waiting" or self.pkaisetu_processing:
+                return False
+            self.genshori_phase = "processing"
+            return True
+    
+    def _release_job(self):
+        """ジョブが授業の準備まで進まずに終わったら枠を返す"""
+        with self.genshori_lock:
+            if self.genshori_phase == "processing":
+                self.genshori_phase = "waiting"
+    
+    def _lesson_finished(self):
+        """授業を最後まで再生したら待機に戻し、順番待ちの宿題を流す（「リスタート」でもう一度再生できる）"""
         with self.genshori_lock:
-            if self.genshori_phase != "waiting":
+            if self.genshori_phase == "teaching":
+                self.genshori_phase = "waiting"
+        self.log("授業終了！")
+        self.update_gui_status("待機中")
+    
+    def find_cached_lesson(self, text_content):
+        """読み取った文字が同じで、スライドが残っている過去の授業"""
+        if len(''.join(text_content.split())) < self.config.CACHE_MIN_SOURCE_CHARS:
+            return None
+        lesson = self.history.by_source(text_content)
+        if lesson and lesson['slides'] and all(os.path.exists(slide['path']) for slide in lesson['slides']):
+            registry.inc("cache_requests", cache="lesson", result="hit")
+            return lesson
+        registry.inc("cache_requests", cache="lesson", result="miss")
+        return None
+    
+    def serve_cached_lesson(self, lesson_id, progress=None):
+        """履歴の授業をそのまま準備（LLMを使わない）"""
+        if self.replay_lesson(lesson_id) and progress:
+            progress("・前に作った授業があったからすぐ用意したよ！VRで「おしえて！」と書いてね")
+    
+    async def ingest_attachment(self, attachment):
+        """添付1つを取り込んで ({'path', 'image'}, None) か (None, エラー文) を返す"""
+        if attachment.size > self.config.UPLOAD_MAX_BYTES:
+            return None, "ファイルサイズが大きすぎます"
+        try:
+            with span("download"):
+                data = await attachment.read()
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.ingest_pool, self.prepare_upload, attachment.filename, data)
+        except Exception as e:
+            self.log(f"添付取り込みエラー ({attachment.filename}): {e}")
+            return None, "取り込めませんでした"
+    
+    def prepare_upload(self, filename, data):
+        """受け取ったバイト列を1回だけデコードし、検証・縮小して保存（PDFはそのまま保存）"""
+        if len(data) > self.config.UPLOAD_MAX_BYTES:
+            return None, "ファイルサイズが大きすぎます"
+        file_path = self.storage.new_path("discord", f"_{filename}")
+        if filename.lower().endswith('.pdf'):
+            with open(file_path, 'wb') as f:
+                f.write(data)
+            return {'path': file_path, 'image': None}, None
+        
+        with span("decode"):
+            # 大きなJPEGは保存サイズに近い解像度で縮小デコード
+            image = LoadedImage.from_bytes(data, max_size=self.config.UPLOAD_MAX_SIZE)
+        is_valid, error_msg = image.validate(self.config.UPLOAD_MAX_BYTES)
+        if not is_valid:
+            return None, error_msg
+        
+        with span("resize"):
+            # 縮小不要なら再エンコードせず元のバイト列を保存
+            image.resize(self.config.UPLOAD_MAX_SIZE).save(file_path)
+        return {'path': file_path, 'image': image.array}, None
+    
+    def extract_page_texts(self, pages):
+        """取り込んだページのOCR（ローカルの画像と同じ経路。画像はデコード済み配列を渡す）"""
+        texts = (self.extract_text_from_image(page['path'], page['image']) for page in pages)
+        return "\n\n".join(text for text in texts if text)
+    
+    def process_homework_image(self, image_path, lesson_id=None, text_content=None, progress=None, claimed=False):
+        """宿題画像の処理（複数ページならパスのリスト。text_content は取り込み時のOCR結果）
+        
+        progress(メッセージ, preview=JPEGのバイト列) で途中経過を知らせる（Discordの返信の書き換え）
+        claimed=True なら順番待ちのキューが処理の枠を確保済み
+        """
+        report = progress or (lambda line, preview=None: None)
+        with self.genshori_lock:
+            if not claimed and self.genshori_phase != "waiting":
                 self.log("他の処理中のためスキップ")
+                report("・今は別の授業中だから、終わってからもう一度送ってね")
                 return
             
             self.genshori_phase = "processing"
         
+        job_start = time.perf_counter()
+        pages = [image_path] if isinstance(image_path, str) else list(image_path)
+        for page in pages:
+            self.storage.pin(page)
+        rendered = []  # PDFから作ったVLM用の画像
+        token = self.job_token = CancelToken()
+        self.prefetcher.stop()
         try:
             self.log("宿題画像処理開始")
             self.update_gui_status("画像解析中...")
+            if lesson_id is None:
+                lesson_id = self.history.add_upload("local", pages[0])
             
-            # Step 1: OCR/Nougat処理
-            text_content = self.extract_text_from_image(image_path)
+            # Step 1: OCR/Nougat処理（取り込み時に済んでいれば使い回す）
+            if text_content is None:
+                text_content = "\n\n".join(self.extract_text_from_image(page) for page in pages)
+            if text_content.strip():
+                self.history.record_source(lesson_id, text_content)
             
-            # Step 2: 問題文理解・テキスト化
-            self.update_gui_status("問題文解析中...")
-            structured_problems = self.analyze_problems(text_content, image_path)
+            # VLMは画像しか読めないので、PDFは1ページ目を画像にして渡す（本文はNougatで抽出済み）
+            images = []
+            for page in pages:
+                if page.lower().endswith('.pdf'):
+                    page = self.nougat_model.render_first_page(page, self.storage.new_path("discord", "_page1.jpg"))
+                    if not page:
+                        continue
+                    self.storage.pin(page)
+                    rendered.append(page)
+                images.append(page)
             
-            # Step 3: 解説生成
-            self.update_gui_status("解説生成中...")
-            explanation = self.generate_explanation(structured_problems)
+            # Step 2-3: 問題文理解と解説生成（対応していれば1回の構造化出力で）
+            self.update_gui_status("問題文解析・解説生成中...")
+            lesson = self.generate_lesson(text_content, images[0] if len(images) == 1 else images, token)
+            self.history.record_problems(lesson_id, lesson.problems_json(), lesson.problem_text)
+            check(token)
+            if lesson.problem_text:
+                report(f"・問題を見つけたよ: {lesson.problem_text[:100]}")
             
-            # Step 4: スライド作成
+            # Step 4: スライド作成（読み上げ音声の合成と並行）
             self.update_gui_status("スライド作成中...")
-            slides = self.create_slides(explanation)
+            plan = lesson.slide_plan()
+            narration_jobs = self.prepare_narration(plan, token)
+            # 1枚目ができたらすぐに縮小版を見せる
+            slides = self.create_slides(plan, on_first=lambda path: report(
+                f"・スライドを作ってるよ（全{len(plan)}枚）", preview=self._slide_preview(path)))
+            self._collect_narration(narration_jobs, token)
             
-            self.current_slides = slides
-            self.current_explanation = explanation
+            slides = self.history.record_lesson(lesson_id, lesson.explanation_text(), slides,
+                                                lesson.to_dict()) or slides
+            self._set_current_lesson(lesson, slides, lesson_id)
             
             # Step 5: VR準備完了通知
             self.genshori_phase = "teaching"
+            self.teaching_since = time.monotonic()
+            self.start_prefetch()
             self.update_gui_status("VR準備完了")
             self.log("解説準備完了！VRで「おしえて！」と書いてね")
+            report(f"・準備できたよ！（スライド{len(slides)}枚）VRで「おしえて！」と書いてね")
+            registry.observe("stage_seconds", time.perf_counter() - job_start, stage="homework_job")
+        
+        except CancelledError:
+            self.log("宿題処理を中断しました")
+            report("・途中で止めたよ")
+            self.genshori_phase = "waiting"
+            self.update_gui_status("待機中")
             
         except Exception as e:
             self.log(f"処理エラー: {e}")
+            report("・エラーが発生したよ～ごめんね！")
             self.genshori_phase = "waiting"
             self.update_gui_status("エラー発生")
+        
+        finally:
+            for page in pages + rendered:
+                self.storage.unpin(page)
+                self.storage.touch(page)
     
-    def extract_text_from_image(self, image_path):
-        """画像からテキスト抽出"""
+    def extract_text_from_image(self, image_path, image=None):
+        """画像からテキスト抽出（image はデコード済みの配列があれば渡す）"""
         try:
-            if image_path.lower().endswith('.pdf'):
-                # Nougat for PDF
-                return self.nougat_model.predict(image_path)
-            else:
-                # Yomitoku for images
-                return self.yomitoku_model.predict(image_path)
+            with span("ocr"):
+                if image_path.lower().endswith('.pdf'):
+                    # Nougat for PDF
+                    return self.nougat_model.predict(image_path)
+                else:
+                    # Yomitoku for images（検出結果は静止シーンで再利用）
+                    return self.yomitoku_model.predict_regions(image if image is not None else image_path)
         except Exception as e:
             self.log(f"テキスト抽出エラー: {e}")
             return ""
     
-    def analyze_problems(self, text_content, image_path):
+    def generate_lesson(self, text_content, image_path, token=None):
+        """授業（lesson_model.Lesson）を生成。構造化出力が使えなければ2回の呼び出しに戻す"""
+        if self.config.LESSON_SINGLE_CALL and self.structured_output_supported is not False:
+            data = self.generate_structured_lesson(text_content, image_path, token)
+            if data:
+                return lesson_model.Lesson.from_structured(data)
+            self.log("構造化出力が使えないため2回の呼び出しで生成します")
+        
+        structured_problems = self.analyze_problems(text_content, image_path, token)
+        self.update_gui_status("解説生成中...")
+        explanation = self.generate_explanation(structured_problems, token)
+        return lesson_model.Lesson.from_texts(structured_problems, explanation)
+    
+    def generate_structured_lesson(self, text_content, image_path, token=None):
+        """画像から問題・ステップ・読み上げ文・グラフ式を1回で生成（失敗時はNone）"""
+        prompt = f"""この画像と抽出されたテキストから数学の問題を正確に理解し、妹キャラとして分かりやすい授業を作成してください。
+
+抽出テキスト:
+{text_content}
+
+要求:
+- problems: 問題番号・問題文・問題の種類・難易度
+- intro: 授業の最初のひとこと
+- steps: 最大5ステップ。title は短い見出し、narration は読み上げる解説（途中式も含めて{self.config.NARRATION_MAX_CHARS}文字以内）、expression はそのステップの式
+- graph_expression: グラフにできる式（例: y = x^2 - 5x + 6）。無ければ空文字
+- summary: まとめ
+- 妹口調で親しみやすく、「お兄ちゃん」呼び"""
+
+        content = self.call_vlm(self.config.LESSON_MODEL, prompt, image_path, token=token,
+                                response_format=lesson_model.response_format(), purpose="lesson")
+        lesson = parse_json_response(content)
+        if not lesson_model.is_valid_lesson(lesson):
+            return None
+        self.structured_output_supported = True
+        return lesson
+    
+    def analyze_problems(self, text_content, image_path, token=None):
         """問題文の解析・構造化"""
         prompt = f"""この画像と抽出されたテキストから、数学の問題を正確に理解して構造化してください。
 
@@ -220,9 +482,9 @@ class VRSenseiSystem:
     ]
 }}"""
         
-        return self.call_vlm("gemma-3-12b-it", prompt, image_path)
+        return self.call_vlm("gemma-3-12b-it", prompt, image_path, token=token, purpose="problems")
     
-    def generate_explanation(self, problems_json):
+    def generate_explanation(self, problems_json, token=None):
         """解説生成"""
         prompt = f"""以下の数学問題について、妹キャラとして分かりやすく解説を作成してください。
 
@@ -235,6 +497,8 @@ class VRSenseiSystem:
 - 途中式も含めて
 - 「お兄ちゃん」呼び
 - 励ましの言葉も含める
+- 読み上げるので全体で{self._spoken_chars("explanation")}文字以内
+- 見出し記号（#）や区切り線（---）などのマークダウンは使わず、段落は空行で区切る
 
 解説形式:
 1. 問題の確認
@@ -243,107 +507,163 @@ class VRSenseiSystem:
 4. 答えの確認
 5. まとめ"""
         
-        return self.call_llm("japanese-starling-chatv-7b", prompt)
+        # 指示しても付く見出し等は読み上げないよう除く
+        return strip_markdown(self.call_llm("japanese-starling-chatv-7b", prompt, token, purpose="explanation"))
     
-    def create_slides(self, explanation):
-        """スライド作成（修正版）"""
+    def create_slides(self, plan, on_first=None):
+        """授業のスライドを並列に描画し、描けたものを {'path', 'narration', 'step_index'} で返す
+        
+        on_first(パス) は最初の1枚が描けた時点で呼ぶ（残りの描画を待たない）
+        """
+        first_done = []
+        
+        def rendered_one(path):
+            if path and on_first and not first_done:
+                first_done.append(path)
+                try:
+                    on_first(path)
+                except Exception as e:
+                    self.log(f"スライド通知エラー: {e}")
+            return path
+        
+        with span("slide_render"):
+            paths = [self._slide_path(spec) for spec in plan]
+            try:
+                if self.slide_pool is None:
+                    # Tk・Discord・ワーカースレッドが動いているプロセスはforkせずspawnで起動
+                    self.slide_pool = ProcessPoolExecutor(max_workers=self.config.SLIDE_RENDER_WORKERS,
+                                                          mp_context=multiprocessing.get_context("spawn"))
+                # map の結果は順番どおりに届くので、1枚目は残りを待たずに受け取れる
+                rendered = [rendered_one(path) for path in
+                            self.slide_pool.map(render_slide, [spec.kind for spec in plan],
+                                                [spec.params for spec in plan], paths)]
+            except Exception as e:
+                self.log(f"スライド並列描画エラー（順に描画し直します）: {e}")
+                rendered = [rendered_one(self._render_slide(spec, path)) for spec, path in zip(plan, paths)]
+    
+            return [{'path': path, 'narration': spec.narration, 'step_index': spec.step_index}
+                    for spec, path in zip(plan, rendered) if path]
+    
+    def _slide_preview(self, path):
+        """Discordに載せる低解像度のスライド（JPEGのバイト列）"""
+        image = LoadedImage.open(path, self.config.DISCORD_PREVIEW_SIZE)
+        if not image.ok:
+            return None
+        return image.thumbnail(self.config.DISCORD_PREVIEW_SIZE).encode(".jpg", self.config.DISCORD_PREVIEW_QUALITY)
+    
+    def _slide_path(self, spec):
+        names = {"title": "slide_0.png", "graph": "graph_slide.png", "celebration": "celebration_slide.png"}
+        name = f"step_{spec.step_index + 1}_slide.png" if spec.kind == "step" else names[spec.kind]
+        return os.path.join(self.config.TMP_DIR, name)
+    
+    def _render_slide(self, spec, path):
         try:
-            slides = []
-            
-            # メインスライド作成
-            create_slide_1()
-            main_slide = os.path.join(self.config.TMP_DIR, "slide_0.png")
-            if os.path.exists(main_slide):
-                slides.append(main_slide)
-            
-            # 解説からステップを抽出してスライド作成
-            steps = self._extract_steps_from_explanation(explanation)
-            for i, step in enumerate(steps, 1):
-                create_step_by_step_slide(i, step)
-                step_slide = os.path.join(self.config.TMP_DIR, f"step_{i}_slide.png")
-                if os.path.exists(step_slide):
-                    slides.append(step_slide)
-            
-            # グラフスライド作成（数学問題の場合）
-            if self._is_math_problem(explanation):
-                create_math_graph_slide("x² - 5x + 6 = 0")
-                graph_slide = os.path.join(self.config.TMP_DIR, "graph_slide.png")
-                if os.path.exists(graph_slide):
-                    slides.append(graph_slide)
-            
-            # 完了スライド
-            create_celebration_slide()
-            celebration_slide = os.path.join(self.config.TMP_DIR, "celebration_slide.png")
-            if os.path.exists(celebration_slide):
-                slides.append(celebration_slide)
-            
-            return slides
-            
+            return render_slide(spec.kind, spec.params, path)
         except Exception as e:
-            self.log(f"スライド作成エラー: {e}")
-            return []
-    
-    def _extract_steps_from_explanation(self, explanation):
-        """解説からステップを抽出"""
-        steps = []
-        lines = explanation.split('\n')
-        for line in lines:
-            if any(keyword in line for keyword in ['ステップ', 'Step', '手順', '①', '②', '③', '④', '⑤']):
-                steps.append(line.strip())
-        
-        if not steps:
-            # デフォルトステップ
-            steps = [
-                "問題を確認しよう",
-                "解法を考えよう", 
-                "計算を実行しよう",
-                "答えを確認しよう",
-                "まとめよう"
-            ]
-        
-        return steps[:5]  # 最大5ステップ
-    
-    def _is_math_problem(self, explanation):
-        """数学問題かどうか判定"""
-        math_keywords = ['方程式', '関数', 'グラフ', 'x²', 'x^2', '微分', '積分', '三角関数']
-        return any(keyword in explanation for keyword in math_keywords)
+            self.log(f"スライド作成エラー（{spec.kind}）: {e}")
+            return None
+            
+    def prepare_narration(self, plan, token=None):
+        """各スライドの読み上げ音声の合成を開始（スライド描画と並行して進める）"""
+        self._release_narration()
+        speed = self.lesson_player.speed
+        texts = dict.fromkeys(spec.narration for spec in plan if spec.narration)
+        return [(text, speed, self.tts_pool.submit(self.synthesize, text, speed, token)) for text in texts]
+            
+    def _collect_narration(self, jobs, token=None):
+        """合成できた音声を授業中は消されないよう保持"""
+        for text, speed, future in jobs:
+            audio = future.result()
+            if audio:
+                self.storage.pin(audio[0])
+                self.narration_audio[(text, speed)] = audio
+        check(token)
+            
+    def _release_narration(self):
+        audio, self.narration_audio = self.narration_audio, {}
+        for audio_path, _ in audio.values():
+            self.storage.unpin(audio_path)
+            
+    def _synthesize_narration(self, text, speed, token=None):
+        """先に合成済みの音声があればそれを使う（速さを変えたときは合成し直す）"""
+        audio = self.narration_audio.get((text, speed))
+        if audio and os.path.exists(audio[0]):
+            return audio
+        return self.synthesize(text, speed, token)
+            
+    def _set_current_lesson(self, lesson, slides, lesson_id):
+        self.current_lesson = lesson
+        self.current_slides = [slide['path'] for slide in slides]
+        self.current_narrations = [slide['narration'] for slide in slides]
+        self.current_step_indexes = [slide['step_index'] for slide in slides]
+        self.current_problem = lesson.problem_text
+        self.current_lesson_id = lesson_id
     
     def start_camera_monitoring(self):
         """カメラ監視開始"""
-        self.camera = cv2.VideoCapture(0)
-        threading.Thread(target=self.monitor_camera, daemon=True).start()
+        source = self.config.CAMERA_SOURCE
+        if source.lower().endswith('.vrf'):
+            # 録画ファイルを再生（カメラの無い環境での再現・計測用）
+            self.camera = ReplaySource(source, realtime=self.config.CAMERA_REPLAY_REALTIME)
+        else:
+            self.camera = cv2.VideoCapture(int(source))
+        self.camera_stop.clear()
+        self.camera_thread = threading.Thread(target=self.monitor_camera, daemon=True)
+        self.camera_thread.start()
     
     def monitor_camera(self):
         """カメラ監視ループ"""
-        while True:
-            ret, frame = self.camera.read()
-            if not ret:
-                continue
-            
-            # 「おしえて！」認識
-            if self.genshori_phase == "teaching" and self.detect_oshiete(frame):
-                self.start_teaching()
-            
-            # 「Pkaisetu」認識
-            if not self.pkaisetu_processing and self.detect_pkaisetu(frame):
-                current_time = time.time()
-                if current_time - self.last_pkaisetu_time > self.pkaisetu_cooldown:
-                    self.last_pkaisetu_time = current_time
-                    threading.Thread(target=self.handle_pkaisetu, args=(frame,), daemon=True).start()
-            
-            # その他コマンド認識
-            for cmd, func in self.commands.items():
-                if self.detect_command(frame, cmd):
-                    func()
-            
-            time.sleep(0.1)
+        recorder = FrameRecorder(self.config.CAMERA_RECORD_PATH) if self.config.CAMERA_RECORD_PATH else None
+        try:
+            while not self.camera_stop.is_set():
+                ret, frame = self.camera.read()
+                if not ret:
+                    if getattr(self.camera, 'exhausted', False):
+                        self.log("録画の再生が終了しました")
+                        break
+                    continue
+                
+                registry.mark("camera_frames")
+                if recorder:
+                    recorder.write(frame)
+                
+                # 新しく書かれた文字に軽量検出器が反応したときだけフルOCRで確認
+                if self.trigger_detector is not None:
+                    with span("trigger_detect"):
+                        triggers = self.trigger_detector.detect(frame)
+                else:
+                    # 検出器を作れなかったときは毎フレームすべてのトリガーをフルOCRで確認
+                    triggers = set(TRIGGER_KEYWORDS)
+                if not triggers:
+                    time.sleep(0.1)
+                    continue
+                
+                # 「おしえて！」認識
+                if "oshiete" in triggers and self.genshori_phase == "teaching" and self.detect_oshiete(frame):
+                    self.start_teaching()
+                
+                # 「Pkaisetu」認識
+                if "pkaisetu" in triggers and not self.pkaisetu_processing and self.detect_pkaisetu(frame):
+                    current_time = time.time()
+                    if current_time - self.last_pkaisetu_time > self.pkaisetu_cooldown:
+                        self.last_pkaisetu_time = current_time
+                        threading.Thread(target=self.handle_pkaisetu, args=(frame,), daemon=True).start()
+                
+                # その他コマンド認識
+                for cmd, func in self.commands.items():
+                    if cmd in triggers and self.detect_command(frame, cmd):
+                        func()
+                
+                time.sleep(0.1)
+        finally:
+            # ライブカメラや例外で抜けたときも最後の記録を書き切って閉じる
+            if recorder:
+                recorder.close()
     
     def detect_oshiete(self, frame):
         """「おしえて！」文字認識"""
         try:
-            temp_path = os.path.join(self.tmp_dir, "temp_frame.jpg")
-            cv2.imwrite(temp_path, frame)
-            text = self.yomitoku_model.predict(temp_path)
+            text = self.yomitoku_model.predict_frame(frame)
             return "おしえて" in text or "教えて" in text
         except:
             return False
@@ -351,9 +671,7 @@ class VRSenseiSystem:
     def detect_pkaisetu(self, frame):
         """「Pkaisetu」文字認識"""
         try:
-            temp_path = os.path.join(self.tmp_dir, "temp_frame.jpg")
-            cv2.imwrite(temp_path, frame)
-            text = self.yomitoku_model.predict(temp_path)
+            text = self.yomitoku_model.predict_frame(frame)
             return "pkaisetu" in text.lower() or "ピカイセツ" in text
         except:
             return False
@@ -361,57 +679,83 @@ class VRSenseiSystem:
     def detect_command(self, frame, command):
         """コマンド文字認識"""
         try:
-            temp_path = os.path.join(self.tmp_dir, "temp_frame.jpg")
-            cv2.imwrite(temp_path, frame)
-            text = self.yomitoku_model.predict(temp_path)
+            text = self.yomitoku_model.predict_frame(frame)
             return command in text.lower()
         except:
             return False
     
     def start_teaching(self):
-        """授業開始"""
-        self.log("授業開始！")
-        self.speak("お兄ちゃん、一緒に勉強しよう！")
-        
-        for i, slide_path in enumerate(self.current_slides):
-            if self.genshori_phase != "teaching":
-                break
-            
-            self.send_image_to_vr(slide_path)
-            explanation_part = self.get_slide_explanation(i)
-            self.speak(explanation_part)
-            time.sleep(3)  # 説明時間
+        """授業開始（再生は別スレッド。カメラ監視はその間もコマンドを受け付ける）"""
+        # 再生中は読み上げを優先する（_prefetch_idle）ので、実行中の先読みも譲ってもらう
+        self.prefetcher.preempt()
+        if self.lesson_player.play(self.current_slides, self.current_narrations):
+            self.log("授業開始！")
     
     def handle_pkaisetu(self, frame):
         """Pkaisetu処理"""
         self.pkaisetu_processing = True
-        self.speak("わかった！考えるからPkaisetuを消して待っててね～")
+        token = self.pkaisetu_token = CancelToken()
+        # 先読み中のリクエストがLLMの枠を占めていれば中断して譲ってもらう
+        self.prefetcher.preempt()
+        # 授業中なら今のスライドで一時停止し、答えたら同じスライドから再開
+        paused = self.lesson_player.pause()
         
         try:
+            # 授業の問題なら先読み済みの解説ですぐ答える
+            cached = self.prefetcher.lookup(self.yomitoku_model.predict_frame_structured(frame).text)
+            if cached and cached['audio']:
+                registry.inc("cache_requests", cache="pkaisetu_prefetch", result="hit")
+                self.log(f"先読み済みの解説で回答（ステップ{cached['index'] + 1}）")
+                audio_path, duration = cached['audio']
+                self.send_audio_to_unity(audio_path)
+                token.event.wait(duration)
+                return
+            registry.inc("cache_requests", cache="pkaisetu_prefetch", result="miss")
+            
+            self.speak("わかった！考えるからPkaisetuを消して待っててね～", token=token)
+            
             # フレーム保存
-            temp_path = os.path.join(self.tmp_dir, f"pkaisetu_{uuid.uuid4()}.jpg")
+            temp_path = self.storage.new_path("pkaisetu", ".jpg")
             cv2.imwrite(temp_path, frame)
             
-            # 問題特定・解析
-            problem_analysis = self.analyze_pkaisetu_problem(temp_path)
-            detailed_explanation = self.generate_detailed_explanation(problem_analysis)
+            # 問題特定・解析（Pkaisetu周辺だけをVLMに渡す）
+            problem_analysis = self.analyze_pkaisetu_problem(temp_path, self.find_pkaisetu_roi(frame), token)
+            detailed_explanation = self.generate_detailed_explanation(problem_analysis, token)
+            check(token)
             
-            # 音声で解説
-            self.speak(detailed_explanation)
+            # 音声で解説（話し終わるまで授業は再開しない）
+            token.event.wait(self.speak(detailed_explanation, token=token))
             
             # 必要に応じてスライド更新
             if "詳細解説が必要" in problem_analysis:
                 detail_slide = self.create_detail_slide(detailed_explanation)
-                self.send_image_to_vr(detail_slide)
+                self.send_image_to_vr(detail_slide, token)
+        
+        except CancelledError:
+            self.log("Pkaisetuを中断しました")
             
         except Exception as e:
             self.log(f"Pkaisetu処理エラー: {e}")
-            self.speak("ごめんね、うまく認識できなかったよ")
+            if not token.cancelled:
+                self.speak("ごめんね、うまく認識できなかったよ")
         
         finally:
             self.pkaisetu_processing = False
+            if paused:
+                self.lesson_player.resume()
+    
+    def find_pkaisetu_roi(self, frame):
+        """「Pkaisetu」の前後の行を囲む矩形（見つからなければNone）"""
+        ocr_result = self.yomitoku_model.predict_frame_structured(frame)
+        index = ocr_result.find(["pkaisetu", "ピカイセツ"])
+        if index < 0:
+            return None
+        
+        return ocr_result.region_around(index, frame.shape,
+                                        line_radius=self.config.PKAISETU_CONTEXT_LINES,
+                                        margin=self.config.PKAISETU_CROP_MARGIN)
     
-    def analyze_pkaisetu_problem(self, image_path):
+    def analyze_pkaisetu_problem(self, image_path, roi=None, token=None):
         """Pkaisetu画像の問題解析"""
         prompt = """Analyze this image to identify the specific math problem near "Pkaisetu" text. 
 Also check if there are any student's working steps or answers written, and evaluate their correctness.
@@ -422,9 +766,9 @@ Respond in Japanese with:
 3. Correctness evaluation
 4. What needs detailed explanation"""
         
-        return self.call_vlm("gemma-3-12b-it", prompt, image_path)
+        return self.call_vlm("gemma-3-12b-it", prompt, image_path, roi, token, purpose="pkaisetu_analysis")
     
-    def generate_detailed_explanation(self, problem_analysis):
+    def generate_detailed_explanation(self, problem_analysis, token=None):
         """詳細解説生成"""
         prompt = f"""Based on this analysis, create a detailed explanation as a younger sister character:
 
@@ -436,105 +780,282 @@ Requirements:
 - If student's work is partially correct, praise the correct parts
 - Point out where mistakes occur
 - Give encouraging words
-- Provide step-by-step guidance"""
+- Provide step-by-step guidance
+- It will be read aloud, so keep it within {self._spoken_chars("pkaisetu")} Japanese characters"""
         
-        return self.call_llm("japanese-starling-chatv-7b", prompt)
+        return self.call_llm("japanese-starling-chatv-7b", prompt, token, purpose="pkaisetu")
+    
+    def generate_step_explanation(self, problem_text, step, token=None):
+        """Pkaisetu先読み用：ステップ単位の詳しい解説"""
+        prompt = f"""The student is stuck on one step of this problem. Explain that step in detail as a younger sister character.
+
+Problem: {problem_text}
+Step: {step}
+
+Requirements:
+- Use sister-like speech (妹口調)
+- Call user "お兄ちゃん"
+- Explain why this step works and how to calculate it
+- Give encouraging words
+- It will be read aloud, so keep it within {self._spoken_chars("step")} Japanese characters"""
+
+        return self.call_llm("japanese-starling-chatv-7b", prompt, token, purpose="step")
+    
+    def start_prefetch(self):
+        """授業中のPkaisetuに備えて各ステップの解説を先読み"""
+        lesson = self.current_lesson
+        steps = [f"{step.title} {step.narration}" for step in lesson.steps] if lesson else []
+        self.prefetcher.start(self.current_problem, steps, self._current_step)
     
-    def call_vlm(self, model, prompt, image_path):
-        """VLM API呼び出し"""
+    def _current_step(self):
+        """再生中のスライドに対応するステップ（表紙なら最初、グラフ以降は最後のステップ）"""
+        passed = [i for i in self.current_step_indexes[:self.lesson_player.cursor + 1] if i >= 0]
+        return passed[-1] if passed else 0
+    
+    def _prefetch_idle(self):
+        """宿題処理・Pkaisetu処理・授業の読み上げがLLM/TTSを使っていない間だけ先読みする"""
+        return self.genshori_phase == "teaching" and not self.pkaisetu_processing \
+            and not self.lesson_player.playing
+    
+    def call_vlm(self, model, prompt, image_path, roi=None, token=None, response_format=None, purpose=None):
+        """VLM API呼び出し（image_path はパスまたは複数ページのパスのリスト）"""
         try:
-            with open(image_path, "rb") as img_file:
-                image_data = base64.b64encode(img_file.read()).decode('utf-8')
+            paths = [image_path] if isinstance(image_path, str) else list(image_path)
+            images = []
+            for path in paths:
+                # 切り出し・縮小・再エンコード済みの画像（キャッシュ付き）
+                payload = encode_image_payload(path, roi if len(paths) == 1 else None,
+                                               max_side=self.config.VLM_MAX_IMAGE_SIDE,
+                                               quality=self.config.VLM_JPEG_QUALITY,
+                                               cache_size=self.config.VLM_PAYLOAD_CACHE_SIZE)
+                if payload is None:
+                    self.log(f"VLM画像読み込みエラー: {path}")
+                    continue
+                mime_type, image_data = payload
+                images.append({"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{image_data}"}})
+            if not images:
+                return ""
             
             data = {
                 "model": model,
                 "messages": [
                     {
                         "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}}
-                        ]
+                        "content": [{"type": "text", "text": prompt}] + images
                     }
                 ],
                 "temperature": 0.7,
-                "max_tokens": -1,
-                "stream": False
+                "stream": True,
+                **self._generation_options(purpose)
             }
+            if response_format:
+                data["response_format"] = response_format
             
-            response = requests.post(self.lmstudio_url, headers={"Content-Type": "application/json"}, json=data)
-            if response.status_code == 200:
-                return response.json()["choices"][0]["message"]["content"]
-            else:
-                self.log(f"VLM APIエラー: {response.status_code}")
-                return ""
+            return self._complete(data, "vlm", "VLM", token, purpose)
+        except CancelledError:
+            raise
         except Exception as e:
             self.log(f"VLM呼び出しエラー: {e}")
             return ""
     
-    def call_llm(self, model, prompt):
+    def call_llm(self, model, prompt, token=None, purpose=None):
         """LLM API呼び出し"""
         try:
             data = {
                 "model": model,
                 "messages": [{"role": "user", "content": prompt}],
                 "temperature": 0.7,
-                "max_tokens": -1,
-                "stream": False
+                "stream": True,
+                **self._generation_options(purpose)
             }
             
-            response = requests.post(self.lmstudio_url, headers={"Content-Type": "application/json"}, json=data)
-            if response.status_code == 200:
-                return response.json()["choices"][0]["message"]["content"]
-            else:
-                self.log(f"LLM APIエラー: {response.status_code}")
-                return ""
+            return self._complete(data, "llm", "LLM", token, purpose)
+        except CancelledError:
+            raise
         except Exception as e:
             self.log(f"LLM呼び出しエラー: {e}")
             return ""
     
-    def speak(self, text):
-        """VOICEVOX音声合成"""
+    def _generation_options(self, purpose):
+        """用途ごとの max_tokens と停止文字列"""
+        options = {"max_tokens": self.config.TOKEN_BUDGETS.get(purpose, self.config.MAX_TOKENS)}
+        if purpose in self.config.SPOKEN_STOP_PURPOSES:
+            options["stop"] = self.config.SPOKEN_STOP_SEQUENCES
+        return options
+    
+    def _spoken_chars(self, purpose):
+        """読み上げ用の生成で許す文字数（max_tokens で途中切れしないよう少し短め）"""
+        budget = self.config.TOKEN_BUDGETS.get(purpose, self.config.MAX_TOKENS)
+        return int(budget * self.config.CHARS_PER_TOKEN * 0.8)
+    
+    def _complete(self, data, stage, label, token=None, purpose=None):
+        """チャット補完を受信（キャンセルされたら接続を切ってサーバー側の生成も止める）"""
+        check(token)
+        tried = []
+        while True:
+            endpoint = self.endpoint_pool.acquire(data["model"], exclude=tried)
+            if endpoint is None:
+                self.log(f"{label}: {data['model']} を処理できるサーバーがありません")
+                return ""
+            tried.append(endpoint)
+            try:
+                # 同じモデルへのリクエストをまとめて流す（モデルの入れ替え待ち）
+                return endpoint.scheduler.run(
+                    data["model"], lambda: self._post_completion(endpoint.url, data, stage, label, token, purpose), token)
+            except (EndpointError, requests.ConnectionError, requests.Timeout) as e:
+                # 別のサーバーで最初からやり直す
+                self.endpoint_pool.mark_failed(endpoint, e)
+            finally:
+                self.endpoint_pool.release(endpoint)
+    
+    def _post_completion(self, url, data, stage, label, token=None, purpose=None):
+        check(token)
+        start = time.perf_counter()
+        with span(stage):
+            response = requests.post(url, headers={"Content-Type": "application/json"},
+                                     json=data, stream=True, timeout=(self.config.LLM_CONNECT_TIMEOUT, None))
+            with response:
+                if response.status_code >= 500:
+                    raise EndpointError(f"{label} APIエラー: {response.status_code}")
+                if response.status_code != 200:
+                    self.log(f"{label} APIエラー: {response.status_code}")
+                    if "response_format" in data and response.status_code in (400, 422):
+                        # 構造化出力に未対応のサーバー・モデル
+                        self.structured_output_supported = False
+                    return ""
+                # 読み上げ用は文字数上限を超えたら文の切れ目で受信をやめる（接続を切ると生成も止まる）
+                max_chars = self._spoken_chars(purpose) if purpose in self.config.SPOKEN_PURPOSES else None
+                content, tokens, finish = self._read_completion(response, token, max_chars)
+        self._record_generation(tokens, time.perf_counter() - start, purpose, len(content), finish)
+        return content
+    
+    def _read_completion(self, response, token=None, max_chars=None):
+        """ストリーミング（SSE）または通常のJSON応答から (本文, トークン数, 終了理由) を取り出す"""
+        if "text/event-stream" not in response.headers.get("Content-Type", ""):
+            result = response.json()
+            choice = result["choices"][0]
+            content = choice["message"]["content"]
+            finish = choice.get("finish_reason")
+            if max_chars and len(content) > max_chars:
+                content, finish = trim_to_sentence(content, max_chars), "early_stop"
+            # usageが無いサーバーでは文字数で近似
+            return content, (result.get("usage") or {}).get("completion_tokens") or len(content), finish
+        
+        parts = []
+        length = 0
+        finish = None
+        for line in response.iter_lines():
+            check(token)
+            if not line.startswith(b"data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == b"[DONE]":
+                break
+            choice = json.loads(payload)["choices"][0]
+            finish = choice.get("finish_reason") or finish
+            delta = choice.get("delta", {}).get("content")
+            if delta:
+                parts.append(delta)
+                length += len(delta)
+                if max_chars and length > max_chars:
+                    return trim_to_sentence("".join(parts), max_chars), len(parts), "early_stop"
+        # 1チャンク1トークンとみなす
+        return "".join(parts), len(parts), finish
+    
+    def _record_generation(self, tokens, elapsed, purpose=None, chars=0, finish=None):
+        """生成速度（トークン/秒）と用途ごとの生成量・打ち切りを記録"""
+        registry.mark("llm_tokens", tokens)
+        if elapsed > 0:
+            registry.set_gauge("llm_tokens_per_second", tokens / elapsed)
+        purpose = purpose or "other"
+        registry.inc("llm_generated_tokens", tokens, purpose=purpose)
+        registry.inc("llm_generated_chars", chars, purpose=purpose)
+        if finish in ("length", "early_stop"):
+            # max_tokens に達した・読み上げ上限で打ち切った
+            registry.inc("llm_truncated", purpose=purpose, reason=finish)
+    
+    def speak(self, text, speed=None, token=None):
+        """VOICEVOX音声合成してUnityで再生（音声の秒数を返す）"""
+        audio = self.synthesize(text, speed, token)
+        check(token)
+        if not audio:
+            return 0
+        audio_path, duration = audio
+        
+        # Unityに音声ファイルパス送信
+        self.send_audio_to_unity(audio_path)
+        return duration
+    
+    def synthesize(self, text, speed=None, token=None):
+        """VOICEVOX音声合成して保存（(音声パス, 秒数) または None）"""
         try:
             # 音声クエリ生成
-            response = requests.post(f"{self.voicevox_url}/audio_query", 
-                                   params={"text": text, "speaker": 58})
+            check(token)
+            with span("tts_query"):
+                response = requests.post(f"{self.voicevox_url}/audio_query", 
+                                       params={"text": text, "speaker": 58})
             if response.status_code != 200:
-                return
+                return None
             
             audio_query = response.json()
+            audio_query["speedScale"] = speed or self.lesson_player.speed
+            check(token)
             
             # 音声合成
-            response = requests.post(f"{self.voicevox_url}/synthesis", 
-                                   params={"speaker": 58}, 
-                                   json=audio_query)
+            start = time.perf_counter()
+            with span("tts_synthesis"):
+                response = requests.post(f"{self.voicevox_url}/synthesis", 
+                                       params={"speaker": 58}, 
+                                       json=audio_query)
             if response.status_code != 200:
-                return
+                return None
+            duration = self._record_tts_rtf(response.content, time.perf_counter() - start)
+            registry.inc("tts_spoken_chars", len(text))
+            check(token)
             
-            # 音声ファイル保存・再生
-            audio_path = os.path.join(self.tmp_dir, f"voice_{uuid.uuid4()}.wav")
+            # 音声ファイル保存
+            audio_path = self.storage.new_path("voice", ".wav")
             with open(audio_path, 'wb') as f:
                 f.write(response.content)
+            return audio_path, duration
             
-            # Unityに音声ファイルパス送信
-            self.send_audio_to_unity(audio_path)
-            
+        except CancelledError:
+            return None
         except Exception as e:
             self.log(f"音声合成エラー: {e}")
+            return None
+    
+    def _record_tts_rtf(self, wav_bytes, elapsed):
+        """音声合成の実時間比（合成時間 / 音声長）を記録して音声長を返す"""
+        try:
+            with wave.open(io.BytesIO(wav_bytes)) as wav:
+                duration = wav.getnframes() / wav.getframerate()
+        except (wave.Error, EOFError, ZeroDivisionError):
+            return 0
+        if duration > 0:
+            registry.set_gauge("tts_realtime_factor", elapsed / duration)
+        return duration
     
-    def send_image_to_vr(self, image_path):
+    def send_image_to_vr(self, image_path, token=None):
         """VRに画像送信"""
         try:
+            check(token)
             frame = cv2.imread(image_path)
             if frame is None:
                 return
             
             encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 90]
-            result, encoded_img = cv2.imencode('.jpg', frame, encode_param)
+            with span("encode"):
+                result, encoded_img = cv2.imencode('.jpg', frame, encode_param)
             if result:
                 data = encoded_img.tobytes()
-                self.udp_socket.sendto(data, (self.quest_ip, self.quest_port))
+                check(token)
+                with span("udp_send"):
+                    self.udp_socket.sendto(data, (self.quest_ip, self.quest_port))
+                registry.mark("udp_bytes", len(data))
                 self.log(f"画像送信: {image_path}")
+        except CancelledError:
+            pass
         except Exception as e:
             self.log(f"画像送信エラー: {e}")
     
@@ -546,34 +1067,43 @@ Requirements:
         except Exception as e:
             self.log(f"音声送信エラー: {e}")
     
+    def stop_audio(self):
+        """Unityで再生中の音声を止める"""
+        try:
+            self.udp_socket.sendto(b"AUDIO_STOP", (self.quest_ip, self.quest_port + 1))
+        except Exception as e:
+            self.log(f"音声停止エラー: {e}")
+    
     # コマンド処理メソッド
     def restart_explanation(self):
         self.log("解説リスタート")
         self.genshori_phase = "teaching"
-        threading.Thread(target=self.start_teaching, daemon=True).start()
+        if self.lesson_player.playing:
+            self.lesson_player.restart()
+        else:
+            self.start_teaching()
     
     def skip_current_slide(self):
         self.log("スライドスキップ")
+        self.lesson_player.skip()
     
     def repeat_current_slide(self):
         self.log("スライドリピート")
+        self.lesson_player.repeat()
     
     def speed_up(self):
         self.log("再生速度アップ")
+        self.lesson_player.faster()
     
     def speed_down(self):
         self.log("再生速度ダウン")
+        self.lesson_player.slower()
     
     def stop_explanation(self):
         self.log("解説停止")
         self.genshori_phase = "waiting"
-    
-    def get_slide_explanation(self, slide_index):
-        """スライド説明取得"""
-        parts = self.current_explanation.split('\n\n')
-        if slide_index < len(parts):
-            return parts[slide_index]
-        return "次のステップに進むよ！"
+        self.lesson_player.stop()
+        self.prefetcher.stop()
     
     def create_detail_slide(self, explanation):
         """詳細解説スライド作成（修正版）"""
@@ -596,10 +1126,7 @@ Requirements:
     
     def _get_current_problem(self):
         """現在の問題文を取得"""
-        if self.discord_history:
-            # 最新の問題から抽出
-            return "x² - 5x + 6 = 0"  # 仮の問題
-        return "数学問題"
+        return self.current_problem or "数学問題"
     
     def _create_simple_text_slide(self, text):
         """簡単なテキストスライドを作成"""
@@ -629,7 +1156,7 @@ Requirements:
             ax.set_ylim(0, 1)
             ax.axis('off')
             
-            slide_path = os.path.join(self.config.TMP_DIR, f"simple_slide_{int(time.time())}.png")
+            slide_path = self.storage.new_path("slide", ".png")
             plt.savefig(slide_path, dpi=150, bbox_inches='tight', 
                         facecolor='#f0f8ff', edgecolor='none')
             plt.close()
@@ -644,7 +1171,7 @@ Requirements:
         """GUI管理画面作成"""
         self.gui_root = tk.Tk()
         self.gui_root.title("VR先生システム 管理画面")
-        self.gui_root.geometry("800x600")
+        self.gui_root.geometry("900x800")
         
         # ステータス表示
         status_frame = ttk.Frame(self.gui_root)
@@ -654,6 +1181,37 @@ Requirements:
         self.status_text = ttk.Label(status_frame, text="待機中", foreground="green")
         self.status_text.pack(side=tk.LEFT, padx=10)
         
+        # 処理段階ごとの所要時間
+        metrics_frame = ttk.Frame(self.gui_root)
+        metrics_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        ttk.Label(metrics_frame, text="処理時間:").pack(anchor=tk.W)
+        self.metrics_tree = ttk.Treeview(metrics_frame, columns=("count", "p50", "p95", "total"), height=6)
+        self.metrics_tree.heading("#0", text="段階")
+        for column, title in [("count", "回数"), ("p50", "p50 (ms)"), ("p95", "p95 (ms)"), ("total", "合計 (s)")]:
+            self.metrics_tree.heading(column, text=title)
+            self.metrics_tree.column(column, width=100, anchor=tk.E)
+        self.metrics_tree.pack(fill=tk.X)
+        
+        # 負荷ダッシュボード
+        dashboard_frame = ttk.LabelFrame(self.gui_root, text="負荷状況")
+        dashboard_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        items = [("camera_fps", "カメラFPS"), ("ocr_latency", "OCR遅延 p50"), ("trigger_latency", "検出遅延 p50"),
+                 ("queue", "キュー"), ("llm_tps", "LLM tok/s"), ("tts_rtf", "TTS実時間比"),
+                 ("udp", "UDP送信"), ("cpu", "CPU"), ("ram", "メモリ"),
+                 ("cache_regions", "領域キャッシュ"), ("cache_frame", "フレームキャッシュ"), ("cache_vlm", "VLM画像キャッシュ"),
+                 ("model", "常駐モデル"), ("model_queue", "LLM待ち"), ("model_switches", "モデル切替"),
+                 ("llm_servers", "LLMサーバー"), ("spoken_ratio", "読み上げ/生成"), ("llm_truncated", "生成打ち切り")]
+        for i, (key, title) in enumerate(items):
+            row, column = divmod(i, 3)
+            ttk.Label(dashboard_frame, text=f"{title}:").grid(row=row, column=column * 2, sticky=tk.W, padx=5)
+            self.dashboard_labels[key] = ttk.Label(dashboard_frame, text="-", width=14)
+            self.dashboard_labels[key].grid(row=row, column=column * 2 + 1, sticky=tk.W)
+        
+        self.refresh_metrics()
+        self.refresh_dashboard()
+        
         # ログ表示
         log_frame = ttk.Frame(self.gui_root)
         log_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
@@ -661,6 +1219,8 @@ Requirements:
         ttk.Label(log_frame, text="システムログ:").pack(anchor=tk.W)
         self.log_text = scrolledtext.ScrolledText(log_frame, height=15)
         self.log_text.pack(fill=tk.BOTH, expand=True)
+        # ログ欄ができてから取り出し始める（起動時のログを捨てない）
+        self.drain_log_queue()
         
         # 制御ボタン
         button_frame = ttk.Frame(self.gui_root)
@@ -671,25 +1231,135 @@ Requirements:
         ttk.Button(button_frame, text="履歴再生", command=self.replay_history).pack(side=tk.LEFT, padx=5)
         ttk.Button(button_frame, text="ログクリア", command=self.clear_log).pack(side=tk.LEFT, padx=5)
     
+    def refresh_metrics(self):
+        """処理時間表を1秒ごとに更新"""
+        self.metrics_tree.delete(*self.metrics_tree.get_children())
+        for row in registry.stage_summary():
+            self.metrics_tree.insert("", tk.END, text=row['stage'],
+                                     values=(row['count'], f"{row['p50'] * 1000:.0f}",
+                                             f"{row['p95'] * 1000:.0f}", f"{row['total']:.1f}"))
+        self.gui_root.after(1000, self.refresh_metrics)
+    
+    def refresh_dashboard(self):
+        """負荷ダッシュボードを定期更新"""
+        values = self.collect_dashboard()
+        for key, label in self.dashboard_labels.items():
+            text, warn = values.get(key, ("-", False))
+            label.config(text=text, foreground="red" if warn else "")
+        self.gui_root.after(self.config.DASHBOARD_INTERVAL_MS, self.refresh_dashboard)
+    
+    def collect_dashboard(self):
+        """ダッシュボード表示値 {キー: (表示文字列, 警告か)}"""
+        window = self.config.DASHBOARD_RATE_WINDOW
+        values = {}
+        
+        values['camera_fps'] = (f"{registry.rate('camera_frames', window):.1f}", False)
+        values['ocr_latency'] = (f"{registry.percentile('stage_seconds', 50, stage='ocr') * 1000:.0f} ms", False)
+        values['trigger_latency'] = (f"{registry.percentile('stage_seconds', 50, stage='trigger_detect') * 1000:.0f} ms", False)
+        
+        task_depth = self.job_queue.depth
+        log_depth = self.log_queue.qsize()
+        registry.set_gauge("queue_depth", task_depth, queue="task")
+        registry.set_gauge("queue_depth", log_depth, queue="log")
+        values['queue'] = (f"処理 {task_depth} / ログ {log_depth}",
+                           log_depth > self.config.GUI_LOG_QUEUE_SIZE // 2)
+        
+        tps = registry.gauge("llm_tokens_per_second")
+        values['llm_tps'] = (f"{tps:.1f}" if tps is not None else "-", False)
+        rtf = registry.gauge("tts_realtime_factor")
+        # 実時間比が1を超えると再生より合成が遅い
+        values['tts_rtf'] = (f"{rtf:.2f}" if rtf is not None else "-", rtf is not None and rtf > 1.0)
+        values['udp'] = (f"{registry.rate('udp_bytes', window) / 1024:.1f} KB/s", False)
+        
+        if psutil:
+            cpu = psutil.cpu_percent(interval=None)
+            memory = psutil.virtual_memory().percent
+            registry.set_gauge("cpu_percent", cpu)
+            registry.set_gauge("memory_percent", memory)
+            values['cpu'] = (f"{cpu:.0f}%", cpu >= self.config.DASHBOARD_CPU_WARN)
+            values['ram'] = (f"{memory:.0f}%", memory >= self.config.DASHBOARD_RAM_WARN)
+        else:
+            values['cpu'] = values['ram'] = ("psutil未導入", False)
+        
+        for key, cache in [("cache_regions", "ocr_regions"), ("cache_frame", "ocr_frame"), ("cache_vlm", "vlm_payload")]:
+            ratio = registry.hit_ratio(cache)
+            values[key] = (f"{ratio * 100:.0f}%" if ratio is not None else "-", False)
+        
+        endpoints = self.endpoint_pool.endpoints
+        residents = sorted({e.scheduler.resident for e in endpoints if e.scheduler.resident})
+        values['model'] = ((",".join(residents) or "-")[:14], False)
+        values['model_queue'] = (str(sum(e.scheduler.waiting for e in endpoints)), False)
+        values['model_switches'] = (str(sum(e.scheduler.switches for e in endpoints)), False)
+        healthy = sum(e.healthy for e in endpoints)
+        values['llm_servers'] = (f"{healthy}/{len(endpoints)}", healthy < len(endpoints))
+        
+        # 生成した文字のうち実際に読み上げた割合（低いほど無駄な生成が多い）
+        purposes = list(self.config.TOKEN_BUDGETS) + ["other"]
+        generated = sum(registry.counter("llm_generated_chars", purpose=purpose) for purpose in purposes)
+        spoken = registry.counter("tts_spoken_chars")
+        values['spoken_ratio'] = (f"{spoken / generated * 100:.0f}%" if generated else "-", False)
+        truncated = sum(registry.counter("llm_truncated", purpose=purpose, reason=reason)
+                        for purpose in purposes for reason in ("length", "early_stop"))
+        values['llm_truncated'] = (str(int(truncated)), False)
+        return values
+    
     def update_gui_status(self, status):
-        """GUI状態更新"""
-        if self.status_text:
-            self.status_text.config(text=status)
+        """GUI状態更新（どのスレッドからでも呼べる）"""
+        self._post_gui("status", status)
     
     def log(self, message):
-        """ログ出力"""
+        """ログ出力（どのスレッドからでも呼べる）"""
         timestamp = datetime.now().strftime("%H:%M:%S")
         log_message = f"[{timestamp}] {message}"
         print(log_message)
+        self.file_logger.info(message)
+        self._post_gui("log", log_message)
         
-        if self.log_text:
-            self.log_text.insert(tk.END, log_message + "\n")
+    def _post_gui(self, kind, value):
+        """GUIスレッドへの受け渡し（溢れたら捨てる）"""
+        try:
+            self.log_queue.put_nowait((kind, value))
+        except queue.Full:
+            pass
+    
+    def drain_log_queue(self):
+        """キューをまとめて取り出してGUIに反映（Tkメインスレッドで定期実行）"""
+        lines = []
+        status = None
+        for _ in range(self.config.GUI_LOG_BATCH_SIZE):
+            try:
+                kind, value = self.log_queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "log":
+                lines.append(value)
+            else:
+                status = value
+        
+        if status is not None and self.status_text:
+            self.status_text.config(text=status)
+        
+        if lines and self.log_text:
+            self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+            # 古い行を削除して一定行数に保つ
+            line_count = int(self.log_text.index('end-1c').split('.')[0])
+            excess = line_count - self.config.GUI_LOG_MAX_LINES
+            if excess > 0:
+                self.log_text.delete("1.0", f"{excess + 1}.0")
             self.log_text.see(tk.END)
+        
+        self.gui_root.after(self.config.GUI_LOG_INTERVAL_MS, self.drain_log_queue)
     
     def emergency_stop(self):
         """緊急停止"""
         self.genshori_phase = "waiting"
         self.pkaisetu_processing = False
+        for token in (self.job_token, self.pkaisetu_token):
+            if token:
+                token.cancel("緊急停止")
+        self.lesson_player.stop()
+        self.prefetcher.stop()
+        self.stop_audio()
         self.log("緊急停止実行")
     
     def manual_pkaisetu(self):
@@ -700,10 +1370,50 @@ Requirements:
                 threading.Thread(target=self.handle_pkaisetu, args=(frame,), daemon=True).start()
     
     def replay_history(self):
-        """履歴再生"""
-        if self.discord_history:
-            latest = self.discord_history[-1]
-            threading.Thread(target=self.process_homework_image, args=(latest['file_path'],), daemon=True).start()
+        """履歴一覧から授業を選んで再生"""
+        lessons = [lesson for lesson in self.history.recent(self.config.HISTORY_LIST_SIZE) if lesson['explanation']]
+        if not lessons:
+            self.log("再生できる履歴がありません")
+            return
+        
+        window = tk.Toplevel(self.gui_root)
+        window.title("授業履歴")
+        listbox = tk.Listbox(window, width=80, height=15)
+        listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        for lesson in lessons:
+            created = datetime.fromtimestamp(lesson['created']).strftime("%m/%d %H:%M")
+            listbox.insert(tk.END, f"#{lesson['id']} {created} {lesson['user']} {lesson['problem_text'] or ''}")
+        listbox.selection_set(0)
+        
+        def play(event=None):
+            selection = listbox.curselection()
+            if selection:
+                self.replay_lesson(lessons[selection[0]]['id'])
+                window.destroy()
+        
+        listbox.bind("<Double-Button-1>", play)
+        ttk.Button(window, text="再生", command=play).pack(pady=5)
+    
+    def replay_lesson(self, lesson_id):
+        """保存済みの解説・スライドで授業を再生（再生成しない）"""
+        lesson = self.history.get(lesson_id)
+        if not lesson or not lesson['lesson']:
+            self.log(f"履歴が見つかりません: #{lesson_id}")
+            return False
+        
+        slides = [slide for slide in lesson['slides'] if os.path.exists(slide['path'])]
+        if not slides:
+            self.log(f"履歴のスライドが見つかりません: #{lesson_id}")
+            return False
+        
+        model = lesson_model.Lesson.from_dict(lesson['lesson'])
+        self._set_current_lesson(model, slides, lesson_id)
+        self.genshori_phase = "teaching"
+        self.teaching_since = time.monotonic()
+        self.start_prefetch()
+        self.update_gui_status("VR準備完了")
+        self.log(f"履歴 #{lesson_id} を読み込みました。VRで「おしえて！」と書いてね")
+        return True
     
     def clear_log(self):
         """ログクリア"""
@@ -717,6 +1427,24 @@ Requirements:
         # GUI起動
         self.create_gui()
         
+        # メトリクス公開（Prometheus形式）
+        if self.config.METRICS_PORT:
+            try:
+                start_metrics_server(self.config.METRICS_PORT)
+                self.log(f"メトリクス公開: http://127.0.0.1:{self.config.METRICS_PORT}/metrics")
+            except OSError as e:
+                self.log(f"メトリクスサーバー起動エラー: {e}")
+        
+        # 一時ファイルの定期整理
+        self.storage.cleanup()
+        self.storage.start_janitor()
+        
+        # LLMサーバーの死活監視
+        self.endpoint_pool.start_health_checks()
+        
+        # Discordからの宿題の順番待ち
+        self.job_queue.start()
+        
         # カメラ監視開始
         self.start_camera_monitoring()
         
@@ -728,7 +1456,21 @@ Requirements:
             self.log("Discord Tokenが設定されていません")
         
         # GUI メインループ
-        self.gui_root.mainloop()
+        try:
+            self.gui_root.mainloop()
+        finally:
+            self.shutdown()
+    
+    def shutdown(self):
+        """終了時にカメラ監視（録画）とワーカープロセスを片付ける"""
+        self.camera_stop.set()
+        if self.camera_thread:
+            self.camera_thread.join(timeout=2)
+        if self.slide_pool is not None:
+            self.slide_pool.shutdown(wait=False, cancel_futures=True)
+            self.slide_pool = None
+        if self.yomitoku_model:
+            self.yomitoku_model.close()
 
 if __name__ == "__main__":
     system = VRSenseiSystem()
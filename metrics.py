@@ -0,0 +1,170 @@
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+# 秒単位のヒストグラム境界
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    """累積バケット＋直近サンプル（パーセンタイル計算用）"""
+    
+    def __init__(self, buckets=DEFAULT_BUCKETS, window=1024):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=window)
+    
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+    
+    def percentile(self, q):
+        if not self.samples:
+            return 0.0
+        return float(np.percentile(self.samples, q))
+
+class MetricsRegistry:
+    """プロセス内のメトリクス（ヒストグラム・カウンタ・ゲージ）"""
+    
+    def __init__(self, prefix="vr_sensei"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}  # (name, labels) -> float
+        self.gauges = {}  # (name, labels) -> float
+        self.events = {}  # (name, labels) -> deque[(時刻, 量)]（直近の速度計算用）
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+    
+    def mark(self, name, amount=1, **labels):
+        """カウンタを進め、速度計算用に時刻も残す"""
+        key = (name, tuple(sorted(labels.items())))
+        now = time.monotonic()
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+            events = self.events.get(key)
+            if events is None:
+                events = self.events[key] = deque(maxlen=4096)
+            events.append((now, amount))
+    
+    def rate(self, name, window=5.0, **labels):
+        """直近window秒の1秒あたりの量"""
+        key = (name, tuple(sorted(labels.items())))
+        since = time.monotonic() - window
+        with self.lock:
+            events = self.events.get(key, ())
+            return sum(amount for t, amount in events if t >= since) / window
+    
+    def counter(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            return self.counters.get(key, 0)
+    
+    def gauge(self, name, default=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            return self.gauges.get(key, default)
+    
+    def percentile(self, name, q, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            return histogram.percentile(q) if histogram else 0.0
+    
+    def hit_ratio(self, cache):
+        """cache_requests{cache=..., result=hit|miss} から求めたヒット率（未使用ならNone）"""
+        hits = self.counter("cache_requests", cache=cache, result="hit")
+        misses = self.counter("cache_requests", cache=cache, result="miss")
+        total = hits + misses
+        return hits / total if total else None
+    
+    def stage_summary(self):
+        """段階ごとの件数・p50・p95（秒）"""
+        with self.lock:
+            items = [(dict(labels).get("stage", ""), histogram)
+                     for (name, labels), histogram in self.histograms.items() if name == "stage_seconds"]
+            return [{'stage': stage, 'count': histogram.count,
+                     'p50': histogram.percentile(50), 'p95': histogram.percentile(95),
+                     'total': histogram.sum}
+                    for stage, histogram in sorted(items)]
+    
+    def render_prometheus(self):
+        """Prometheusテキスト形式で出力"""
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{self.prefix}_{name}_total{self._labels(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"{self.prefix}_{name}{self._labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                    bucket_labels = labels + (("le", str(bound)),)
+                    lines.append(f"{self.prefix}_{name}_bucket{self._labels(bucket_labels)} {count}")
+                inf_labels = labels + (("le", "+Inf"),)
+                lines.append(f"{self.prefix}_{name}_bucket{self._labels(inf_labels)} {histogram.count}")
+                lines.append(f"{self.prefix}_{name}_sum{self._labels(labels)} {histogram.sum}")
+                lines.append(f"{self.prefix}_{name}_count{self._labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+    
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+registry = MetricsRegistry()
+
+@contextmanager
+def span(stage):
+    """処理段階の所要時間を計測して stage_seconds に記録"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe("stage_seconds", time.perf_counter() - start, stage=stage)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+    
+    def do_GET(self):
+        if self.path.rstrip('/') not in ("", "/metrics"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = registry.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """ローカルの /metrics エンドポイントを起動"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
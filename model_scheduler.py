@@ -0,0 +1,92 @@
+import threading
+import time
+from config import Config
+from cancellation import CancelledError
+from metrics import registry
+
+POLICIES = ("resident_first", "fifo")
+
+class _Request:
+    def __init__(self, model):
+        self.model = model
+        self.queued = time.monotonic()
+
+class ModelScheduler:
+    """LM Studioへのリクエストをモデルごとにまとめて流し、モデルの入れ替えを減らす
+    
+    resident_first: 読み込み済み（常駐）モデルの待ちを先に流し、無くなるか max_batch 件続いたら
+                    一番長く待っているモデルに切り替える
+    fifo: 到着順（切り替えを気にしない）
+    """
+    
+    def __init__(self, policy=None, max_batch=None, parallel=None, log=print):
+        self.policy = policy or Config.MODEL_SCHEDULER_POLICY
+        if self.policy not in POLICIES:
+            raise ValueError(f"不明なスケジューラ方針: {self.policy}")
+        self.max_batch = max_batch or Config.MODEL_MAX_BATCH
+        self.parallel = parallel or Config.MODEL_PARALLEL
+        self.log = log
+        
+        self.condition = threading.Condition()
+        self.pending = []  # 到着順の _Request
+        self.resident = None  # 最後に使ったモデル（LM Studioに読み込まれているとみなす）
+        self.running = 0
+        self.batch = 0  # 他モデルを待たせて常駐モデルを続けて流した件数
+        self.switches = 0
+    
+    def run(self, model, fn, token=None):
+        """model が常駐する順番が来たら fn() を実行して結果を返す"""
+        request = _Request(model)
+        with self.condition:
+            self.pending.append(request)
+            while not self._admit(request):
+                if token is not None and token.cancelled:
+                    self.pending.remove(request)
+                    self.condition.notify_all()
+                    raise CancelledError(token.reason)
+                # キャンセルに気づけるよう定期的に起きる
+                self.condition.wait(0.1)
+        registry.observe("stage_seconds", time.monotonic() - request.queued, stage="model_queue")
+        try:
+            return fn()
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.condition.notify_all()
+    
+    @property
+    def waiting(self):
+        with self.condition:
+            return len(self.pending)
+    
+    def _admit(self, request):
+        """request を今実行してよければ実行中に移す（condition を持った状態で呼ぶ）"""
+        if self._next() is not request or self.running >= self.parallel:
+            return False
+        if request.model != self.resident:
+            if self.running:
+                # 実行中のリクエストが終わってから切り替える
+                return False
+            if self.resident is not None:
+                self.switches += 1
+                registry.inc("model_switches", model=request.model)
+                self.log(f"モデル切り替え: {self.resident} → {request.model}")
+            self.resident = request.model
+            self.batch = 0
+        self.pending.remove(request)
+        if any(other.model != self.resident for other in self.pending):
+            self.batch += 1
+        self.running += 1
+        registry.set_gauge("model_queue_depth", len(self.pending))
+        return True
+    
+    def _next(self):
+        """次に流すリクエスト"""
+        if self.policy == "fifo" or self.resident is None:
+            return self.pending[0]
+        same = [request for request in self.pending if request.model == self.resident]
+        others = [request for request in self.pending if request.model != self.resident]
+        if same and (not others or self.batch < self.max_batch):
+            return same[0]
+        # 一番長く待っているモデルに切り替え（待ちが無ければ pending は空にならない）
+        return others[0] if others else self.pending[0]
@@ -1,21 +1,25 @@
 import fitz  # PyMuPDF
 import os
+import cv2
+import numpy as np
 from PIL import Image
 import io
 
 class NougatWrapper:
     """Nougatの代替PDFテキスト抽出"""
     
-    def __init__(self):
+    def __init__(self, ocr=None):
         self.temp_dir = "./tmp"
         os.makedirs(self.temp_dir, exist_ok=True)
+        self.ocr = ocr  # 共有するYomitokuWrapper（未指定なら必要時に生成）
     
     def predict(self, pdf_path):
         """PDFからテキストを抽出"""
         try:
             # PDFを開く
             doc = fitz.open(pdf_path)
-            text_content = []
+            text_content = [""] * len(doc)
+            image_pages = []
             
             for page_num in range(len(doc)):
                 page = doc.load_page(page_num)
@@ -23,41 +27,55 @@ class NougatWrapper:
                 # テキスト抽出を試行
                 text = page.get_text()
                 if text.strip():
-                    text_content.append(text)
+                    text_content[page_num] = text
                 else:
-                    # テキストが抽出できない場合、画像として処理
-                    image_text = self._extract_from_image(page, page_num)
-                    if image_text:
-                        text_content.append(image_text)
+                    # テキストが抽出できない場合、画像として後でまとめて処理
+                    image_pages.append(page_num)
+            
+            if image_pages:
+                page_images = [self._render_page(doc.load_page(page_num)) for page_num in image_pages]
+                for page_num, image_text in zip(image_pages, self._extract_from_images(page_images)):
+                    text_content[page_num] = image_text
             
             doc.close()
-            return '\n'.join(text_content)
+            return '\n'.join(text for text in text_content if text)
             
         except Exception as e:
             print(f"PDF処理エラー: {e}")
             return ""
     
-    def _extract_from_image(self, page, page_num):
-        """PDFページを画像として処理"""
+    def render_first_page(self, pdf_path, output_path):
+        """1ページ目を画像として保存（VLMに渡す用）。失敗したらNone"""
         try:
-            # ページを画像に変換
-            mat = fitz.Matrix(2, 2)  # 2倍解像度
-            pix = page.get_pixmap(matrix=mat)
-            
-            # 画像保存
-            img_path = os.path.join(self.temp_dir, f"page_{page_num}.png")
-            pix.save(img_path)
-            
-            # OCR処理（YomitokuWrapperを使用）
-            from yomitoku_wrapper import YomitokuWrapper
-            ocr = YomitokuWrapper()
-            text = ocr.predict(img_path)
-            
-            # 一時ファイル削除
-            os.remove(img_path)
-            
-            return text
+            doc = fitz.open(pdf_path)
+            try:
+                if len(doc) == 0:
+                    return None
+                image = self._render_page(doc.load_page(0))
+            finally:
+                doc.close()
+            return output_path if cv2.imwrite(output_path, image) else None
+        except Exception as e:
+            print(f"PDF画像化エラー: {e}")
+            return None
+    
+    def _render_page(self, page):
+        """PDFページをBGR配列に変換"""
+        mat = fitz.Matrix(2, 2)  # 2倍解像度
+        pix = page.get_pixmap(matrix=mat)
+        image = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+        if pix.n == 4:
+            return cv2.cvtColor(image, cv2.COLOR_RGBA2BGR)
+        return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    
+    def _extract_from_images(self, page_images):
+        """画像ページを一括OCR（YomitokuWrapperを使用）"""
+        try:
+            if self.ocr is None:
+                from yomitoku_wrapper import YomitokuWrapper
+                self.ocr = YomitokuWrapper()
+            return [result.text for result in self.ocr.predict_batch(page_images, "pdf_page")]
             
         except Exception as e:
             print(f"画像処理エラー: {e}")
-            return ""
+            return [""] * len(page_images)
@@ -0,0 +1,137 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from config import Config
+
+class OCREngineManager:
+    """入力種別ごとにOCRエンジンの速度・信頼度を記録して振り分け"""
+    
+    def __init__(self, engines, mode=None):
+        # input_classは camera, photo, pdf_page のいずれか
+        # engines: {エンジン名: fn(image, input_class) -> [(bbox, text, confidence), ...]}
+        self.engines = engines
+        self.mode = mode or Config.OCR_ENGINE_MODE  # auto, race, またはエンジン名で固定
+        self.stats = {}  # (engine, input_class) -> {'latency', 'confidence', 'count'}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(engines)))
+        self.racing = set()  # 競争に出してまだ終わっていないエンジン（1エンジン1件まで）
+    
+    def run(self, image, input_class):
+        """エンジンを選んで実行し、(エンジン名, 結果)を返す"""
+        # カメラは毎フレーム来るので競争させない（負けたエンジンの処理が溜まる）
+        if self.mode == "race" and len(self.engines) > 1 and input_class != "camera":
+            return self._race(image, input_class)
+        
+        engine = self.choose(input_class)
+        results = self._timed_run(engine, image, input_class)
+        
+        # 自動選択で信頼度が足りなければ、次の候補で一度だけ再試行
+        if self.mode == "auto" and results and \
+                self._mean_confidence(results) < Config.OCR_CONFIDENCE_THRESHOLD:
+            fallback = self._next_candidate(engine, input_class)
+            if fallback:
+                fallback_results = self._timed_run(fallback, image, input_class)
+                if self._mean_confidence(fallback_results) > self._mean_confidence(results):
+                    return fallback, fallback_results
+        return engine, results
+    
+    def choose(self, input_class):
+        """閾値を満たす中で最速のエンジンを選ぶ"""
+        if self.mode in self.engines:
+            return self.mode
+        
+        ranked = self._rank(input_class)
+        return ranked[0] if ranked else next(iter(self.engines))
+    
+    def record(self, engine, input_class, latency, results):
+        """計測値を指数移動平均で記録（文字が無い結果は信頼度に含めない）"""
+        alpha = Config.OCR_ENGINE_EWMA_ALPHA
+        with self.lock:
+            stat = self.stats.setdefault((engine, input_class),
+                                         {'latency': latency, 'confidence': None, 'count': 0})
+            stat['latency'] = latency if stat['count'] == 0 else \
+                (1 - alpha) * stat['latency'] + alpha * latency
+            if results:
+                confidence = self._mean_confidence(results)
+                stat['confidence'] = confidence if stat['confidence'] is None else \
+                    (1 - alpha) * stat['confidence'] + alpha * confidence
+            stat['count'] += 1
+    
+    def summary(self):
+        """GUI表示用の統計一覧"""
+        with self.lock:
+            return [{'engine': engine, 'input_class': input_class, **stat}
+                    for (engine, input_class), stat in sorted(self.stats.items())]
+    
+    def _rank(self, input_class):
+        """優先順にエンジン名を並べる"""
+        with self.lock:
+            stats = {engine: self.stats.get((engine, input_class)) for engine in self.engines}
+        
+        # 計測回数が足りないエンジンを先に試す
+        unexplored = [engine for engine, stat in stats.items()
+                      if stat is None or stat['count'] < Config.OCR_ENGINE_MIN_SAMPLES]
+        if unexplored:
+            unexplored.sort(key=lambda engine: stats[engine]['count'] if stats[engine] else 0)
+            explored = [engine for engine in self.engines if engine not in unexplored]
+            return unexplored + explored
+        
+        threshold = Config.OCR_CONFIDENCE_THRESHOLD
+        confident = [engine for engine, stat in stats.items()
+                     if stat['confidence'] is None or stat['confidence'] >= threshold]
+        others = [engine for engine in self.engines if engine not in confident]
+        confident.sort(key=lambda engine: stats[engine]['latency'])
+        others.sort(key=lambda engine: -(stats[engine]['confidence'] or 0))
+        return confident + others
+    
+    def _next_candidate(self, engine, input_class):
+        for candidate in self._rank(input_class):
+            if candidate != engine:
+                return candidate
+        return None
+    
+    def _timed_run(self, engine, image, input_class):
+        start = time.perf_counter()
+        try:
+            results = self.engines[engine](image, input_class)
+        except Exception as e:
+            print(f"OCRエンジン実行エラー({engine}): {e}")
+            results = []
+        self.record(engine, input_class, time.perf_counter() - start, results)
+        return results
+    
+    def _race(self, image, input_class):
+        """空いている全エンジンを同時に走らせ、最初に信頼度を満たした結果を採用"""
+        with self.lock:
+            engines = [engine for engine in self.engines if engine not in self.racing]
+            self.racing.update(engines)
+        if not engines:
+            # 前の競争の残りがまだ動いていれば、選んだエンジンだけで処理
+            engine = self.choose(input_class)
+            return engine, self._timed_run(engine, image, input_class)
+        
+        futures = {self.executor.submit(self._race_run, engine, image, input_class): engine
+                   for engine in engines}
+        best_engine, best_results = None, []
+        for future in as_completed(futures):
+            engine = futures[future]
+            results = future.result()
+            if results and self._mean_confidence(results) >= Config.OCR_CONFIDENCE_THRESHOLD:
+                # 残りのエンジンはバックグラウンドで計測だけ続ける
+                return engine, results
+            if best_engine is None or self._mean_confidence(results) > self._mean_confidence(best_results):
+                best_engine, best_results = engine, results
+        return best_engine, best_results
+    
+    def _race_run(self, engine, image, input_class):
+        try:
+            return self._timed_run(engine, image, input_class)
+        finally:
+            with self.lock:
+                self.racing.discard(engine)
+    
+    @staticmethod
+    def _mean_confidence(results):
+        if not results:
+            return 0.0
+        return sum(confidence for (bbox, text, confidence) in results) / len(results)
@@ -0,0 +1,137 @@
+import re
+import time
+import threading
+from config import Config
+from cancellation import CancelToken, CancelledError
+from metrics import registry
+from trigger_detector import match_keywords
+
+def problem_signature(problem_text):
+    """問題文から数式部分だけを取り出す（ノートには日本語の指示文は書かれないことが多い）"""
+    math_only = re.sub(r'[^0-9A-Za-z²³=+\-*/^().]', '', problem_text or "")
+    return math_only if len(math_only) >= 4 else (problem_text or "")
+
+class PkaisetuPrefetcher:
+    """授業中の空き時間に、各ステップの詳しい解説と音声を先に作っておく"""
+    
+    def __init__(self, generate, synthesize, is_idle, storage, log=print):
+        # generate(problem_text, step, token) -> 解説文
+        # synthesize(text, speed, token) -> (音声パス, 秒数) または None
+        # is_idle() -> 他の処理がLLM/TTSを使っていなければTrue
+        self.generate = generate
+        self.synthesize = synthesize
+        self.is_idle = is_idle
+        self.storage = storage
+        self.log = log
+        
+        self.lock = threading.Lock()
+        self.token = CancelToken()
+        self.request_token = None  # 先読み中の1ステップ分（preempt() で中断し、後でやり直す）
+        self.problem_text = ""
+        self.steps = []
+        self.entries = {}  # ステップ番号 -> {'step', 'explanation', 'audio'}
+        self.current_step = lambda: 0
+    
+    def start(self, problem_text, steps, current_step=None):
+        """授業の問題とステップを登録し、バックグラウンドで先読みを開始"""
+        self.stop()
+        token = CancelToken()
+        with self.lock:
+            self.token = token
+            self.problem_text = problem_text
+            self.steps = list(steps)
+            self.entries = {}
+            self.current_step = current_step or (lambda: 0)
+        if Config.PREFETCH_ENABLED and steps:
+            threading.Thread(target=self._run, args=(token,), daemon=True).start()
+    
+    def stop(self):
+        """先読みを止めて保持している音声を解放"""
+        with self.lock:
+            self.token.cancel("stop")
+            entries, self.entries = self.entries, {}
+        for entry in entries.values():
+            if entry['audio']:
+                self.storage.unpin(entry['audio'][0])
+    
+    def preempt(self):
+        """実行中・待機中の先読みリクエストを中断してLLM/TTSを空ける（そのステップは空いたらやり直す）"""
+        with self.lock:
+            if self.request_token is not None:
+                self.request_token.cancel("preempt")
+    
+    def lookup(self, frame_text, step_index=None):
+        """フレームの文字から今の授業の問題だと判断できれば、先読み済みの解説を返す"""
+        with self.lock:
+            ready = {i: entry for i, entry in self.entries.items() if entry['explanation']}
+            if not ready or not frame_text:
+                return None
+            signature = problem_signature(self.problem_text)
+            if not match_keywords(frame_text, {"problem": [signature]}, Config.PREFETCH_MATCH_RATIO):
+                return None
+            index = self.current_step() if step_index is None else step_index
+            if index not in ready:
+                # 今のステップが未生成なら一番近いステップで答える
+                index = min(ready, key=lambda i: abs(i - index))
+            return dict(ready[index], index=index)
+    
+    def _order(self):
+        """今のステップに近い順"""
+        current = self.current_step()
+        with self.lock:
+            done = set(self.entries)
+            count = len(self.steps)
+        return sorted((i for i in range(count) if i not in done), key=lambda i: (abs(i - current), i))
+    
+    def _wait_idle(self, token):
+        while not self.is_idle():
+            if token.cancelled:
+                raise CancelledError("stop")
+            time.sleep(Config.PREFETCH_IDLE_POLL)
+        token.raise_if_cancelled()
+    
+    def _run(self, token):
+        try:
+            while True:
+                pending = self._order()
+                if not pending:
+                    return
+                index = pending[0]
+                step = self.steps[index]
+                
+                # 空き待ちの間に preempt() されても気づけるよう、待つ前にリクエスト用のトークンを作る
+                request = token.child()
+                with self.lock:
+                    self.request_token = request
+                try:
+                    self._wait_idle(request)
+                    explanation = self.generate(self.problem_text, step, request)
+                    if not explanation:
+                        # 生成できなかったステップは空で登録して次へ
+                        self._store(token, index, step, "", None)
+                        continue
+                
+                    self._wait_idle(request)
+                    audio = self.synthesize(explanation, None, request)
+                    request.raise_if_cancelled()
+                    self._store(token, index, step, explanation, audio)
+                except CancelledError:
+                    if token.cancelled:
+                        raise
+                    # 割り込まれたステップは空いてから作り直す
+                    registry.inc("prefetch_preempted")
+        except CancelledError:
+            pass
+        except Exception as e:
+            self.log(f"Pkaisetu先読みエラー: {e}")
+    
+    def _store(self, token, index, step, explanation, audio):
+        if audio:
+            self.storage.pin(audio[0])
+        with self.lock:
+            if token is self.token and not token.cancelled:
+                self.entries[index] = {'step': step, 'explanation': explanation, 'audio': audio}
+                return
+        # 差し替え済みの授業の結果は捨てる
+        if audio:
+            self.storage.unpin(audio[0])
@@ -4,6 +4,8 @@ from matplotlib import font_manager
 import numpy as np
 import os
 import sys
+import textwrap
+from utils import compile_expression, find_roots
 
 # 日本語フォント設定
 try:
@@ -18,31 +20,33 @@ try:
 except:
     print("フォント設定エラー、デフォルトフォントを使用")
 
-def create_slide_1():
+DEFAULT_STEPS = [
+    "因数分解を考える",
+    "(x - a)(x - b) = 0 の形にする",
+    "a × b = 6, a + b = 5 となる数を探す",
+    "a = 2, b = 3 なので (x - 2)(x - 3) = 0",
+    "x = 2 または x = 3"
+]
+
+def create_slide_1(problem_text="x² - 5x + 6 = 0 を解いてください", steps=None,
+                   title='二次方程式の解き方', output_path='./tmp/slide_0.png'):
     """メインスライド作成"""
     fig, ax = plt.subplots(figsize=(16, 9))
     fig.patch.set_facecolor('#f0f8ff')
     
     # タイトル
-    ax.text(0.5, 0.95, '二次方程式の解き方', 
+    ax.text(0.5, 0.95, title, 
             ha='center', va='top', fontsize=32, weight='bold', 
             color='#2c3e50', transform=ax.transAxes)
     
     # 問題表示
-    problem_text = "問題: x² - 5x + 6 = 0 を解いてください"
-    ax.text(0.1, 0.85, problem_text, 
+    ax.text(0.1, 0.85, f"問題: {problem_text}", 
             ha='left', va='top', fontsize=24, 
             bbox=dict(boxstyle="round,pad=0.5", facecolor='#e8f4fd', edgecolor='#3498db'),
             transform=ax.transAxes)
     
     # 解法ステップ
-    steps = [
-        "ステップ1: 因数分解を考える",
-        "ステップ2: (x - a)(x - b) = 0 の形にする",
-        "ステップ3: a × b = 6, a + b = 5 となる数を探す",
-        "ステップ4: a = 2, b = 3 なので (x - 2)(x - 3) = 0",
-        "ステップ5: x = 2 または x = 3"
-    ]
+    steps = [f"ステップ{i}: {step}" for i, step in enumerate(DEFAULT_STEPS if steps is None else steps, 1)]
     
     y_pos = 0.7
     for i, step in enumerate(steps):
@@ -66,11 +70,11 @@ def create_slide_1():
     ax.axis('off')
     
     plt.tight_layout()
-    plt.savefig('./tmp/slide_0.png', dpi=150, bbox_inches='tight', 
+    plt.savefig(output_path, dpi=150, bbox_inches='tight', 
                 facecolor='#f0f8ff', edgecolor='none')
     plt.close()
 
-def create_pkaisetu_slide(problem_text, solution_text):
+def create_pkaisetu_slide(problem_text, solution_text, output_path='./tmp/pkaisetu_slide.png'):
     """Pkaisetu用詳細スライド"""
     fig, ax = plt.subplots(figsize=(16, 9))
     fig.patch.set_facecolor('#fff5f5')
@@ -113,12 +117,16 @@ def create_pkaisetu_slide(problem_text, solution_text):
     ax.axis('off')
     
     plt.tight_layout()
-    plt.savefig('./tmp/pkaisetu_slide.png', dpi=150, bbox_inches='tight', 
+    plt.savefig(output_path, dpi=150, bbox_inches='tight', 
                 facecolor='#fff5f5', edgecolor='none')
     plt.close()
 
-def create_math_graph_slide(equation, x_range=(-10, 10)):
-    """数学グラフスライド"""
+def create_math_graph_slide(equation, x_range=(-10, 10), output_path='./tmp/graph_slide.png'):
+    """数学グラフスライド（式を描けなければFalse）"""
+    f = compile_expression(equation)
+    if f is None:
+        return False
+    
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(16, 9))
     fig.patch.set_facecolor('#f8f9fa')
     
@@ -147,8 +155,8 @@ def create_math_graph_slide(equation, x_range=(-10, 10)):
     # 右側：グラフ
     x = np.linspace(x_range[0], x_range[1], 1000)
     
-    # 例：x² - 5x + 6 のグラフ
-    y = x**2 - 5*x + 6
+    with np.errstate(all='ignore'):
+        y = np.asarray(f(x), dtype=float) * np.ones_like(x)
     
     ax2.plot(x, y, 'b-', linewidth=3, label=equation)
     ax2.axhline(y=0, color='k', linestyle='-', alpha=0.3)
@@ -156,8 +164,8 @@ def create_math_graph_slide(equation, x_range=(-10, 10)):
     ax2.grid(True, alpha=0.3)
     
     # 解の点をハイライト
-    solutions = [2, 3]  # x² - 5x + 6 = 0 の解
-    for sol in solutions:
+    solutions = find_roots(f, x_range)
+    for sol in solutions[:5]:
         ax2.plot(sol, 0, 'ro', markersize=12, label=f'x = {sol}')
         ax2.annotate(f'x = {sol}', (sol, 0), xytext=(sol, 2),
                     arrowprops=dict(arrowstyle='->', color='red', lw=2),
@@ -169,11 +177,12 @@ def create_math_graph_slide(equation, x_range=(-10, 10)):
     ax2.legend(fontsize=14)
     
     plt.tight_layout()
-    plt.savefig('./tmp/graph_slide.png', dpi=150, bbox_inches='tight', 
+    plt.savefig(output_path, dpi=150, bbox_inches='tight', 
                 facecolor='#f8f9fa', edgecolor='none')
     plt.close()
+    return True
 
-def create_step_by_step_slide(step_number, step_content, is_current=True):
+def create_step_by_step_slide(step_number, step_content, is_current=True, total_steps=5, output_path=None):
     """ステップ別スライド"""
     fig, ax = plt.subplots(figsize=(16, 9))
     bg_color = '#e8f5e8' if is_current else '#f5f5f5'
@@ -196,7 +205,8 @@ def create_step_by_step_slide(step_number, step_content, is_current=True):
             color=title_color, transform=ax.transAxes)
     
     # ステップ内容
-    ax.text(0.1, 0.6, step_content, 
+    wrapped = '\n'.join(textwrap.fill(line, 36) for line in step_content.split('\n'))
+    ax.text(0.1, 0.6, wrapped, 
             ha='left', va='top', fontsize=22, 
             bbox=dict(boxstyle="round,pad=0.8", facecolor='white', edgecolor=circle_color, linewidth=2),
             transform=ax.transAxes)
@@ -212,13 +222,13 @@ def create_step_by_step_slide(step_number, step_content, is_current=True):
                                facecolor='#e0e0e0', transform=ax.transAxes)
     ax.add_patch(bg_rect)
     
-    # 進捗バー（例：5ステップ中のstep_number）
-    progress_fill = (step_number / 5) * progress_width
+    # 進捗バー（total_stepsステップ中のstep_number）
+    progress_fill = (step_number / max(total_steps, 1)) * progress_width
     fill_rect = patches.Rectangle((progress_x, progress_y), progress_fill, progress_height,
                                  facecolor='#4caf50', transform=ax.transAxes)
     ax.add_patch(fill_rect)
     
-    ax.text(0.5, 0.05, f'進捗: {step_number}/5', 
+    ax.text(0.5, 0.05, f'進捗: {step_number}/{total_steps}', 
             ha='center', va='center', fontsize=16, 
             transform=ax.transAxes)
     
@@ -227,11 +237,11 @@ def create_step_by_step_slide(step_number, step_content, is_current=True):
     ax.axis('off')
     
     plt.tight_layout()
-    plt.savefig(f'./tmp/step_{step_number}_slide.png', dpi=150, bbox_inches='tight', 
+    plt.savefig(output_path or f'./tmp/step_{step_number}_slide.png', dpi=150, bbox_inches='tight', 
                 facecolor=bg_color, edgecolor='none')
     plt.close()
 
-def create_celebration_slide():
+def create_celebration_slide(output_path='./tmp/celebration_slide.png'):
     """完了お祝いスライド"""
     fig, ax = plt.subplots(figsize=(16, 9))
     fig.patch.set_facecolor('#fff3e0')
@@ -262,10 +272,24 @@ def create_celebration_slide():
     ax.axis('off')
     
     plt.tight_layout()
-    plt.savefig('./tmp/celebration_slide.png', dpi=150, bbox_inches='tight', 
+    plt.savefig(output_path, dpi=150, bbox_inches='tight', 
                 facecolor='#fff3e0', edgecolor='none')
     plt.close()
 
+SLIDE_RENDERERS = {
+    "title": create_slide_1,
+    "step": create_step_by_step_slide,
+    "graph": create_math_graph_slide,
+    "celebration": create_celebration_slide,
+}
+
+def render_slide(kind, params, output_path):
+    """種類とパラメータからスライドを1枚描画（プロセスプールから呼ぶ。描けなければNone）"""
+    result = SLIDE_RENDERERS[kind](output_path=output_path, **params)
+    if result is False or not os.path.exists(output_path):
+        return None
+    return output_path
+
 # 実行例
 if __name__ == "__main__":
     print("スライド作成開始...")
@@ -0,0 +1,171 @@
+import os
+import time
+import uuid
+import threading
+from config import Config
+from metrics import registry
+
+# ファイル名の接頭辞 -> 管理カテゴリ（それ以外のファイルには触らない）
+CATEGORY_PREFIXES = {
+    "discord_": "discord",
+    "voice_": "voice",
+    "pkaisetu_": "pkaisetu",
+    "simple_slide_": "slide",
+}
+
+class StorageManager:
+    """一時ファイルの置き場所を決め、カテゴリごとの容量・保存期間を超えた分を削除"""
+    
+    def __init__(self, base_dir=None, ram_dir=None):
+        self.base_dir = base_dir or Config.TMP_DIR
+        self.ram_dir = ram_dir if ram_dir is not None else Config.STORAGE_RAM_DIR
+        self.quotas = Config.STORAGE_QUOTAS  # カテゴリ -> 最大バイト数
+        self.max_ages = Config.STORAGE_MAX_AGE  # カテゴリ -> 最大保存秒数
+        self.last_used = {}  # パス -> 最終使用時刻
+        self.pinned = set()  # 使用中で消してはいけないパス
+        self.lock = threading.Lock()
+        self.janitor = None
+        self.stop_event = threading.Event()
+        
+        os.makedirs(self.base_dir, exist_ok=True)
+        if self.ram_dir:
+            try:
+                os.makedirs(self.ram_dir, exist_ok=True)
+            except OSError as e:
+                print(f"RAM領域を使用できません({self.ram_dir}): {e}")
+                self.ram_dir = ""
+    
+    def new_path(self, category, suffix=""):
+        """カテゴリに応じた保存先パスを発行（短命なファイルはRAM領域へ）"""
+        prefix = next(p for p, c in CATEGORY_PREFIXES.items() if c == category)
+        directory = self.ram_dir if self.ram_dir and category in Config.STORAGE_RAM_CATEGORIES else self.base_dir
+        path = os.path.join(directory, f"{prefix}{uuid.uuid4()}{suffix}")
+        self.touch(path)
+        return path
+    
+    def touch(self, path):
+        """使用時刻を更新（LRU削除の順番に使う）"""
+        with self.lock:
+            self.last_used[os.path.abspath(path)] = time.time()
+    
+    def pin(self, path):
+        with self.lock:
+            self.pinned.add(os.path.abspath(path))
+    
+    def unpin(self, path):
+        with self.lock:
+            self.pinned.discard(os.path.abspath(path))
+    
+    def cleanup(self):
+        """期限切れ→容量超過（古い順）の順に削除し、削除数を返す"""
+        now = time.time()
+        by_category = {}
+        entries = self._scan()
+        for entry in entries:
+            by_category.setdefault(entry['category'], []).append(entry)
+        
+        # 外部で消されたファイルの記録を捨てる（発行直後でまだ書かれていないものは残す）
+        existing = {entry['path'] for entry in entries}
+        with self.lock:
+            for path in [p for p, t in self.last_used.items()
+                         if p not in existing and now - t > Config.STORAGE_MIN_AGE]:
+                del self.last_used[path]
+        
+        removed = 0
+        for category, entries in by_category.items():
+            max_age = self.max_ages.get(category)
+            quota = self.quotas.get(category)
+            entries.sort(key=lambda e: e['last_used'])
+            total = sum(e['size'] for e in entries)
+            
+            for entry in entries:
+                # 作成直後のファイルは送信・再生中の可能性があるので残す
+                age = now - entry['last_used']
+                if entry['pinned'] or age < Config.STORAGE_MIN_AGE:
+                    continue
+                expired = max_age is not None and age > max_age
+                over_quota = quota is not None and total > quota
+                if not (expired or over_quota):
+                    continue
+                if self._remove(entry['path']):
+                    total -= entry['size']
+                    removed += 1
+                    registry.inc("storage_evictions", category=category)
+            
+            registry.set_gauge("storage_bytes", total, category=category)
+        return removed
+    
+    def usage(self):
+        """カテゴリごとの使用量（バイト）"""
+        totals = {}
+        for entry in self._scan():
+            totals[entry['category']] = totals.get(entry['category'], 0) + entry['size']
+        return totals
+    
+    def start_janitor(self, interval=None):
+        """定期的に cleanup() するバックグラウンドスレッドを起動"""
+        if self.janitor and self.janitor.is_alive():
+            return
+        interval = interval or Config.STORAGE_JANITOR_INTERVAL
+        
+        def loop():
+            while not self.stop_event.wait(interval):
+                try:
+                    self.cleanup()
+                except Exception as e:
+                    print(f"一時ファイル整理エラー: {e}")
+        
+        self.stop_event.clear()
+        self.janitor = threading.Thread(target=loop, daemon=True)
+        self.janitor.start()
+    
+    def stop_janitor(self):
+        self.stop_event.set()
+    
+    def _scan(self):
+        """管理対象ファイルの一覧"""
+        directories = [self.base_dir] + ([self.ram_dir] if self.ram_dir else [])
+        with self.lock:
+            last_used = dict(self.last_used)
+            pinned = set(self.pinned)
+        
+        entries = []
+        for directory in directories:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                category = self._category(name)
+                if category is None:
+                    continue
+                path = os.path.abspath(os.path.join(directory, name))
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if not os.path.isfile(path):
+                    continue
+                entries.append({'path': path, 'category': category, 'size': stat.st_size,
+                                'last_used': last_used.get(path, stat.st_mtime),
+                                'pinned': path in pinned})
+        return entries
+    
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        with self.lock:
+            self.last_used.pop(path, None)
+        return True
+    
+    @staticmethod
+    def _category(name):
+        # pkaisetu_slide.png など上書きして使う固定名のファイルは対象外
+        if name.endswith("_slide.png") and not name.startswith("simple_slide_"):
+            return None
+        for prefix, category in CATEGORY_PREFIXES.items():
+            if name.startswith(prefix):
+                return category
+        return None
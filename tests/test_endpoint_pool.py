@@ -0,0 +1,97 @@
+import pytest
+from http.server import ThreadingHTTPServer
+import threading
+import benchmark
+from config import Config
+from endpoint_pool import EndpointPool
+
+MODEL = "gemma-3-12b-it"
+
+def start_server(**attributes):
+    return benchmark.start_mock_server(benchmark.MockLMStudioHandler, latency=0, token_rate=10000, **attributes)
+
+def completions_url(base):
+    return f"{base}/v1/chat/completions"
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def servers():
+    started = [start_server(), start_server()]
+    yield started
+    for server, _ in started:
+        stop_server(server)
+
+def test_acquire_picks_least_outstanding_healthy_endpoint(servers):
+    pool = EndpointPool([completions_url(base) for _, base in servers], log=lambda message: None)
+    first = pool.acquire(MODEL)
+    second = pool.acquire(MODEL)
+    assert first is not second
+    
+    pool.release(first)
+    assert pool.acquire(MODEL) is first
+    
+    # 障害中のサーバーは実行中リクエストが少なくても選ばない
+    pool.mark_failed(first, "test")
+    pool.release(first)
+    assert first.outstanding == 0 and second.outstanding == 1
+    assert pool.acquire(MODEL) is second
+
+def test_check_health_marks_dead_server_and_brings_it_back(servers):
+    pool = EndpointPool([completions_url(base) for _, base in servers], log=lambda message: None)
+    (server, base), _ = servers
+    port = server.server_address[1]
+    stop_server(server)
+    
+    healthy = pool.check_health()
+    assert [endpoint.base for endpoint in healthy] == [servers[1][1]]
+    assert pool.acquire(MODEL).base == servers[1][1]
+    
+    # 同じポートで起動し直すと次の確認で復帰する
+    handler = type("Revived", (benchmark.MockLMStudioHandler,), {"latency": 0})
+    revived = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=revived.serve_forever, daemon=True).start()
+    servers[0] = (revived, base)
+    assert len(pool.check_health()) == 2
+    assert pool.endpoints[0].healthy and pool.endpoints[0].models == set(benchmark.MockLMStudioHandler.models)
+
+def make_system(urls):
+    """_complete に必要な部分だけを持つ VRSenseiSystem"""
+    main = pytest.importorskip("main")
+    system = main.VRSenseiSystem.__new__(main.VRSenseiSystem)
+    system.config = Config
+    system.logs = []
+    system.log = system.logs.append
+    system.structured_output_supported = None
+    system.endpoint_pool = EndpointPool(urls, log=system.log)
+    return system
+
+def complete(system):
+    data = {"model": MODEL, "messages": [{"role": "user", "content": "解説して"}], "stream": True}
+    return system._complete(data, "llm", "LLM")
+
+def test_5xx_fails_over_to_another_server():
+    failing, failing_base = start_server(error_status=503)
+    good, good_base = start_server()
+    try:
+        system = make_system([completions_url(failing_base), completions_url(good_base)])
+        assert complete(system) == benchmark.MOCK_EXPLANATION
+        assert failing.RequestHandlerClass.served == 1 and good.RequestHandlerClass.served == 1
+        assert not system.endpoint_pool.endpoints[0].healthy
+    finally:
+        stop_server(failing)
+        stop_server(good)
+
+def test_connection_error_fails_over_to_another_server():
+    dead, dead_base = start_server()
+    stop_server(dead)
+    good, good_base = start_server()
+    try:
+        system = make_system([completions_url(dead_base), completions_url(good_base)])
+        assert complete(system) == benchmark.MOCK_EXPLANATION
+        assert not system.endpoint_pool.endpoints[0].healthy
+        assert system.endpoint_pool.endpoints[1].outstanding == 0
+    finally:
+        stop_server(good)
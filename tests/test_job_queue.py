@@ -0,0 +1,45 @@
+import threading
+from job_queue import FairJobQueue
+
+class Phase:
+    """main の genshori_phase を模した枠（claim は確認と確保を一度に行う）"""
+    
+    def __init__(self, phase="teaching"):
+        self.phase = phase
+        self.lock = threading.Lock()
+        self.released = threading.Event()
+    
+    def claim(self):
+        with self.lock:
+            if self.phase != "waiting":
+                return False
+            self.phase = "processing"
+            return True
+    
+    def release(self):
+        with self.lock:
+            if self.phase == "processing":
+                self.phase = "waiting"
+        self.released.set()
+
+def test_job_runs_only_after_claiming_the_phase():
+    phase = Phase()
+    seen = []
+    started = threading.Event()
+    
+    def job():
+        seen.append(phase.phase)
+        started.set()
+        raise RuntimeError("失敗")
+    
+    queue = FairJobQueue(phase.claim, phase.release, log=lambda message: None)
+    queue.submit("alice", job)
+    queue.start()
+    assert not started.wait(0.5)
+    
+    phase.phase = "waiting"
+    assert started.wait(5)
+    assert phase.released.wait(5)
+    # 確保した枠の中で実行され、失敗したら枠が返る
+    assert seen == ["processing"]
+    assert phase.phase == "waiting" and queue.depth == 0
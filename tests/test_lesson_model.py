@@ -0,0 +1,16 @@
+from config import Config
+from lesson_model import Lesson, MAX_STEPS
+
+def test_from_texts_keeps_every_merged_step():
+    sentence = "あ" * (Config.NARRATION_MAX_CHARS - 1) + "。"
+    steps = [f"ステップ{i}: 式{i}を計算するよ。{sentence}" for i in range(1, MAX_STEPS + 3)]
+    explanation = "\n\n".join(["はじめるよ、お兄ちゃん！"] + steps + ["まとめだよ！"])
+    
+    lesson = Lesson.from_texts("{}", explanation)
+    
+    assert len(lesson.steps) == MAX_STEPS
+    last = lesson.steps[-1].narration
+    for i in range(MAX_STEPS, MAX_STEPS + 3):
+        assert f"式{i}を計算するよ" in last
+    assert lesson.steps[0].title == "式1を計算するよ"
+    assert lesson.summary == "まとめだよ！"
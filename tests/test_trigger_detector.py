@@ -0,0 +1,66 @@
+import numpy as np
+from config import Config
+from trigger_detector import TriggerDetector, match_keywords
+
+class FakeOCR:
+    """predict_keywords に渡された切り出し画像を記録して決まった文字を返す"""
+    
+    def __init__(self, text):
+        self.text = text
+        self.crops = []
+    
+    def predict_keywords(self, image, allowlist):
+        self.crops.append(image)
+        return self.text
+
+def blank(width=640, height=480):
+    return np.full((height, width, 3), 255, np.uint8)
+
+def with_ink(frame, x0=200, y0=150, x1=320, y1=200):
+    frame = frame.copy()
+    frame[y0:y1, x0:x1] = 0
+    return frame
+
+def feed(detector, frame, count):
+    hits = set()
+    for _ in range(count):
+        hits |= detector.detect(frame)
+    return hits
+
+def test_detects_new_ink_after_settling():
+    ocr = FakeOCR("skip")
+    detector = TriggerDetector(ocr)
+    feed(detector, blank(), 2)
+    
+    # 書いた直後（手が動いている間）はOCRしない
+    assert detector.detect(with_ink(blank())) == set()
+    assert ocr.crops == []
+    
+    # 静止して TRIGGER_SETTLE_FRAMES 枚目で一度だけ、書き込み部分を切り出して認識
+    hits = feed(detector, with_ink(blank()), Config.TRIGGER_SETTLE_FRAMES)
+    assert hits == {"skip"}
+    assert len(ocr.crops) == 1
+    height, width = ocr.crops[0].shape[:2]
+    assert 120 <= width < 640 and 50 <= height < 480
+
+def test_still_page_does_not_trigger_again():
+    ocr = FakeOCR("skip")
+    detector = TriggerDetector(ocr)
+    feed(detector, blank(), 2)
+    feed(detector, with_ink(blank()), Config.TRIGGER_SETTLE_FRAMES + 1)
+    assert feed(detector, with_ink(blank()), 10) == set()
+    assert len(ocr.crops) == 1
+
+def test_frame_size_change_resets_instead_of_raising():
+    detector = TriggerDetector(FakeOCR("skip"))
+    feed(detector, blank(640, 480), 3)
+    assert detector.detect(blank(1280, 720)) == set()
+    assert detector.background.shape == detector.previous.shape
+    # 新しい解像度で書き込みを検出できる
+    feed(detector, blank(1280, 720), 2)
+    assert feed(detector, with_ink(blank(1280, 720), 400, 300, 640, 400), Config.TRIGGER_SETTLE_FRAMES + 1) == {"skip"}
+
+def test_match_keywords_tolerates_ocr_noise():
+    assert match_keywords("ＰＫａｉｓｅｔｕ") == {"pkaisetu"}
+    assert "pkaisetu" in match_keywords("pkaisctu")
+    assert match_keywords("hello") == set()
@@ -0,0 +1,38 @@
+import threading
+import numpy as np
+from utils import compile_expression, find_roots
+
+def compile_with_timeout(text, seconds=5):
+    """compile_expression が返ってくるまで待つ（返ってこなければ失敗）"""
+    result = []
+    thread = threading.Thread(target=lambda: result.append(compile_expression(text)), daemon=True)
+    thread.start()
+    thread.join(seconds)
+    assert not thread.is_alive(), f"compile_expression({text!r}) did not return"
+    return result[0]
+
+def test_compiles_homework_expressions():
+    f = compile_expression("y = x^2 - 5x + 6")
+    assert f is not None
+    assert find_roots(f) == [2.0, 3.0]
+    assert compile_expression("x² - 5x + 6 = 0")(np.array([2.0]))[0] == 0
+    assert compile_expression("y = x^-1") is not None
+    assert compile_expression("y = sqrt(x)^0.5") is not None
+
+def test_rejects_huge_powers_without_evaluating():
+    # 定数の畳み込みで止まらないこと（以前はこの式で戻ってこなかった）
+    assert compile_with_timeout("y = x + 9^9^9") is None
+    assert compile_with_timeout("y = x^(9^9)") is None
+    assert compile_with_timeout("y = (x^2)^3") is None
+    assert compile_with_timeout("y = x^x") is None
+    assert compile_with_timeout("y = x^11") is None
+
+def test_rejects_oversized_constants():
+    assert compile_with_timeout("y = x + 99999999999999999999") is None
+    assert compile_with_timeout("y = x + " + "9" * 5000) is None
+    assert compile_with_timeout("y = x" + "+1" * 200) is None
+
+def test_rejects_non_math():
+    assert compile_expression("y = __import__('os')") is None
+    assert compile_expression("y = 3") is None
+    assert compile_expression("") is None
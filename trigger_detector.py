@@ -0,0 +1,148 @@
+import os
+import sys
+import unicodedata
+from difflib import SequenceMatcher
+import cv2
+import numpy as np
+from config import Config
+
+# トリガー名 -> 認識する書き方
+TRIGGER_KEYWORDS = {
+    "oshiete": ["おしえて", "教えて"],
+    "pkaisetu": ["pkaisetu", "ピカイセツ"],
+    "restart": ["restart"],
+    "skip": ["skip"],
+    "repeat": ["repeat"],
+    "faster": ["faster"],
+    "slower": ["slower"],
+    "stop": ["stop"],
+}
+
+def normalize_text(text):
+    """全角半角・大文字小文字・空白の違いをなくす"""
+    return ''.join(unicodedata.normalize('NFKC', text).lower().split())
+
+def match_keywords(text, keywords=TRIGGER_KEYWORDS, ratio=None):
+    """OCR文字列に含まれるトリガー名の集合（多少の誤認識は許容）"""
+    if ratio is None:
+        ratio = Config.TRIGGER_MATCH_RATIO
+    normalized = normalize_text(text)
+    hits = set()
+    for name, variants in keywords.items():
+        for variant in variants:
+            target = normalize_text(variant)
+            if target in normalized:
+                hits.add(name)
+                break
+            # 同じ長さの窓をずらしながら類似度を見る
+            width = len(target)
+            if any(SequenceMatcher(None, normalized[i:i + width], target).ratio() >= ratio
+                   for i in range(max(1, len(normalized) - width + 1))):
+                hits.add(name)
+                break
+    return hits
+
+class TriggerDetector:
+    """新しく書かれた文字の部分だけを見てトリガー語を検出する軽量検出器"""
+    
+    def __init__(self, ocr, keywords=TRIGGER_KEYWORDS):
+        self.ocr = ocr  # YomitokuWrapper
+        self.keywords = keywords
+        self.allowlist = self._build_allowlist(keywords)
+        self.background = None  # 最後に確定した紙面（縮小グレー）
+        self.previous = None
+        self.still_frames = 0
+        self.last_text = ""
+    
+    def detect(self, frame):
+        """フレームを1枚受け取り、反応したトリガー名の集合を返す"""
+        small, scale = self._analysis_image(frame)
+        if self.background is not None and small.shape != self.background.shape:
+            # 録画の再生やカメラの切り替えで解像度が変わったら新しい紙面として扱う
+            self.reset()
+        if self.background is None:
+            self.background = small
+            self.previous = small
+            return set()
+        
+        # 手が動いている間は書いている途中とみなす
+        motion = self._changed_ratio(small, self.previous)
+        self.previous = small
+        if motion > Config.TRIGGER_MOTION_RATIO:
+            self.still_frames = 0
+            return set()
+        
+        # 静止してから一度だけ、前回の紙面との差分（新しい書き込み）を調べる
+        self.still_frames += 1
+        if self.still_frames != Config.TRIGGER_SETTLE_FRAMES:
+            return set()
+        
+        rect = self._ink_rect(small)
+        self.background = small
+        if rect is None:
+            return set()
+        
+        x0, y0, x1, y1 = [int(v / scale) for v in rect]
+        crop = frame[y0:y1, x0:x1]
+        self.last_text = self.ocr.predict_keywords(crop, self.allowlist)
+        return match_keywords(self.last_text, self.keywords)
+    
+    def reset(self):
+        """次のフレームを新しい紙面として扱う"""
+        self.background = None
+        self.previous = None
+        self.still_frames = 0
+    
+    def _analysis_image(self, frame):
+        """解析用の縮小グレー画像と縮小率"""
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        scale = min(1.0, Config.TRIGGER_ANALYSIS_WIDTH / gray.shape[1])
+        if scale < 1.0:
+            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return cv2.GaussianBlur(gray, (3, 3), 0), scale
+    
+    def _changed_ratio(self, a, b):
+        diff = cv2.absdiff(a, b)
+        return np.count_nonzero(diff > Config.TRIGGER_MOTION_DELTA) / diff.size
+    
+    def _ink_rect(self, small):
+        """前回の紙面から増えた部分を囲む矩形（解析画像の座標）"""
+        diff = cv2.absdiff(small, self.background)
+        mask = (diff > Config.TRIGGER_MOTION_DELTA).astype(np.uint8) * 255
+        mask = cv2.dilate(mask, np.ones((5, 5), np.uint8))
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        boxes = [cv2.boundingRect(c) for c in contours if cv2.contourArea(c) >= Config.TRIGGER_MIN_INK_AREA]
+        if not boxes:
+            return None
+        
+        height, width = small.shape[:2]
+        margin = Config.TRIGGER_CROP_MARGIN
+        x0 = max(0, min(x for x, y, w, h in boxes) - margin)
+        y0 = max(0, min(y for x, y, w, h in boxes) - margin)
+        x1 = min(width, max(x + w for x, y, w, h in boxes) + margin)
+        y1 = min(height, max(y + h for x, y, w, h in boxes) + margin)
+        return (x0, y0, x1, y1)
+    
+    @staticmethod
+    def _build_allowlist(keywords):
+        """認識対象をトリガー語に使われる文字だけに絞る"""
+        chars = set()
+        for variants in keywords.values():
+            for variant in variants:
+                chars.update(variant)
+                chars.update(variant.upper())
+        return ''.join(sorted(chars))
+
+if __name__ == "__main__":
+    # 保存済みフレーム画像のディレクトリに対してオフラインで検出を確認
+    from yomitoku_wrapper import YomitokuWrapper
+    
+    frame_dir = sys.argv[1] if len(sys.argv) > 1 else "./tmp/frames"
+    detector = TriggerDetector(YomitokuWrapper())
+    for name in sorted(os.listdir(frame_dir)):
+        frame = cv2.imread(os.path.join(frame_dir, name))
+        if frame is None:
+            continue
+        hits = detector.detect(frame)
+        if hits:
+            print(f"{name}: {sorted(hits)} ({detector.last_text})")
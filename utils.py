@@ -1,10 +1,16 @@
 import os
+import io
 import json
 import cv2
 import numpy as np
 from datetime import datetime
 import re
 import uuid
+import ast
+import base64
+import threading
+from collections import OrderedDict
+from metrics import registry
 
 def clean_filename(filename):
     """ファイル名をクリーンアップ"""
@@ -27,6 +33,19 @@ def save_json(data, filepath):
         print(f"JSON保存エラー: {e}")
         return False
 
+def parse_json_response(text):
+    """LLMの応答から最初のJSONオブジェクトを取り出す（コードブロック等を許容）"""
+    if not text:
+        return None
+    start = text.find('{')
+    end = text.rfind('}')
+    if start < 0 or end <= start:
+        return None
+    try:
+        return json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+
 def load_json(filepath):
     """JSONファイル読み込み"""
     try:
@@ -36,26 +55,126 @@ def load_json(filepath):
         print(f"JSON読み込みエラー: {e}")
         return None
 
+def fit_image(image, max_size=(1920, 1080)):
+    """アスペクト比を保って max_size に収まるよう縮小（収まっていれば同じ配列を返す）"""
+    height, width = image.shape[:2]
+    max_width, max_height = max_size
+    if width <= max_width and height <= max_height:
+        return image
+    scale = min(max_width/width, max_height/height)
+    return cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+
+MAX_IMAGE_BYTES = 10 * 1024 * 1024  # 10MB制限
+
+# JPEGの縮小デコード（libjpegがDCTの段階で1/2・1/4・1/8にするので全画素のデコードより速い）
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+def _jpeg_size(data):
+    """JPEGのヘッダーだけを読んで (幅, 高さ)"""
+    try:
+        from PIL import Image
+        return Image.open(io.BytesIO(data)).size
+    except Exception:
+        return None
+
+def _decode_flag(data, max_size):
+    """max_size を下回らない範囲で一番小さく縮小デコードする (倍率, imdecodeのフラグ)"""
+    size = _jpeg_size(data) if max_size and data[:2] == b'\xff\xd8' else None
+    if size:
+        # EXIFの向きで縦横が入れ替わっても小さくしすぎないよう長辺・短辺で比べる
+        scale = min(max(max_size) / max(size), min(max_size) / min(size))
+        for factor, flag in _REDUCED_FLAGS:
+            if factor * scale <= 1:
+                return factor, flag
+    return 1, cv2.IMREAD_COLOR
+
+class LoadedImage:
+    """1回だけデコードした画像。検証・縮小・サムネイル・保存をメモリ上でつなぎ、配列は後段（OCR等）にそのまま渡す"""
+    
+    def __init__(self, array, data=None, path=None, error=None):
+        self.array = array  # BGR配列（読めなければNone）
+        self.data = data  # 元のバイト列（配列を変えていなければ保存にそのまま使う）
+        self.path = path
+        self.error = error
+        self.modified = False
+    
+    @classmethod
+    def open(cls, path, max_size=None):
+        """ファイルから読み込む（max_size を渡すとJPEGはその大きさに近い解像度でデコード）"""
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            return cls(None, path=path, error=f"画像読み込みエラー: {e}")
+        return cls.from_bytes(data, path, max_size)
+    
+    @classmethod
+    def from_bytes(cls, data, path=None, max_size=None):
+        factor, flag = _decode_flag(data, max_size)
+        try:
+            array = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+        except Exception as e:
+            return cls(None, data, path, f"画像読み込みエラー: {e}")
+        registry.inc("image_decodes", factor=str(factor))
+        image = cls(array, data, path, None if array is not None else "画像ファイルとして読み込めません")
+        # 縮小デコードした配列は元のバイト列と一致しない
+        image.modified = factor > 1
+        return image
+    
+    @property
+    def ok(self):
+        return self.array is not None
+    
+    def validate(self, max_bytes=MAX_IMAGE_BYTES):
+        """(検証OKか, メッセージ)"""
+        if self.data is not None and len(self.data) > max_bytes:
+            return False, "ファイルサイズが大きすぎます"
+        if self.array is None:
+            return False, self.error or "画像ファイルとして読み込めません"
+        return True, "OK"
+    
+    def resize(self, max_size=(1920, 1080)):
+        """max_size に収まるよう縮小（つなげて書けるよう self を返す）"""
+        if self.array is not None:
+            resized = fit_image(self.array, max_size)
+            if resized is not self.array:
+                self.array = resized
+                self.modified = True
+        return self
+    
+    def thumbnail(self, size=(300, 300)):
+        """縮小したコピー（元の画像はそのまま）"""
+        thumb = LoadedImage(fit_image(self.array, size) if self.array is not None else None)
+        thumb.modified = True
+        return thumb
+    
+    def encode(self, extension=".jpg", quality=85):
+        """エンコードしたバイト列（失敗時None）"""
+        params = [int(cv2.IMWRITE_JPEG_QUALITY), quality] if extension.lower() in (".jpg", ".jpeg") else []
+        result, encoded = cv2.imencode(extension, self.array, params)
+        return encoded.tobytes() if result else None
+    
+    def save(self, path=None):
+        """保存してパスを返す（変更が無ければ元のバイト列を書くので再エンコードしない）"""
+        path = path or self.path
+        if not self.modified and self.data is not None:
+            with open(path, 'wb') as f:
+                f.write(self.data)
+        elif not cv2.imwrite(path, self.array):
+            return None
+        self.path = path
+        return path
+
 def resize_image(image_path, max_size=(1920, 1080)):
     """画像リサイズ"""
     try:
-        image = cv2.imread(image_path)
-        if image is None:
+        image = LoadedImage.open(image_path, max_size)
+        if not image.ok:
             return None
         
-        height, width = image.shape[:2]
-        max_width, max_height = max_size
-        
-        # アスペクト比を保持してリサイズ
-        if width > max_width or height > max_height:
-            scale = min(max_width/width, max_height/height)
-            new_width = int(width * scale)
-            new_height = int(height * scale)
-            
-            resized = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_AREA)
-            
+        if image.resize(max_size).modified:
             # 元ファイルを上書き
-            cv2.imwrite(image_path, resized)
+            image.save()
             
         return image_path
     except Exception as e:
@@ -86,6 +205,101 @@ def extract_math_expressions(text):
     
     return list(set(expressions))  # 重複除去
 
+_SUPERSCRIPTS = {'²': '^2', '³': '^3', '⁴': '^4', '⁵': '^5'}
+_ALLOWED_FUNCTIONS = {'sin': np.sin, 'cos': np.cos, 'tan': np.tan, 'sqrt': np.sqrt,
+                      'exp': np.exp, 'log': np.log, 'abs': np.abs}
+_ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.Name, ast.Load, ast.Call,
+                  ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd)
+# compile() は定数を畳み込むので、9^9^9 のような式は評価する前に止める
+MAX_EXPRESSION_LENGTH = 200
+MAX_CONSTANT = 10 ** 9
+MAX_EXPONENT = 10
+
+def _small_exponent(node):
+    """べき指数として許す形（絶対値が MAX_EXPONENT 以下の数値定数。符号付き可）"""
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        node = node.operand
+    return isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) \
+        and abs(node.value) <= MAX_EXPONENT
+
+def _is_pow(node):
+    return isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow)
+
+def compile_expression(text):
+    """「y = x^2 - 5x + 6」「x² - 5x + 6 = 0」などを f(x) に変換（eval は使わない。失敗時None）"""
+    if not text:
+        return None
+    expression = text.replace('−', '-').replace('×', '*').replace('÷', '/').replace(' ', '')
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        return None
+    for superscript, power in _SUPERSCRIPTS.items():
+        expression = expression.replace(superscript, power)
+    
+    # 「y=」は外し、「左辺=右辺」は 左辺-(右辺) にする
+    if expression.count('=') > 1:
+        return None
+    if '=' in expression:
+        left, right = expression.split('=')
+        if left in ('y', 'f(x)'):
+            expression = right
+        elif right in ('y', 'f(x)'):
+            expression = left
+        else:
+            expression = f"({left})-({right})"
+    
+    expression = expression.replace('^', '**')
+    # 暗黙の掛け算: 5x, 2(, )(, x(, )x
+    expression = re.sub(r'(\d)([a-z(])', r'\1*\2', expression)
+    expression = re.sub(r'\)([\da-z(])', r')*\1', expression)
+    expression = re.sub(r'\bx\(', 'x*(', expression)
+    
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except (SyntaxError, ValueError):
+        return None
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            return None
+        if isinstance(node, ast.Name) and node.id != 'x' and node.id not in _ALLOWED_FUNCTIONS:
+            return None
+        if isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and node.func.id in _ALLOWED_FUNCTIONS):
+            return None
+        if isinstance(node, ast.Constant) and not (isinstance(node.value, (int, float))
+                                                   and abs(node.value) <= MAX_CONSTANT):
+            return None
+        if _is_pow(node) and not (_small_exponent(node.right)
+                                  and not any(_is_pow(child) for child in ast.walk(node.left))):
+            return None
+    if not any(isinstance(node, ast.Name) and node.id == 'x' for node in ast.walk(tree)):
+        return None
+    
+    code = compile(tree, '<expression>', 'eval')
+    
+    def f(x):
+        return eval(code, {'__builtins__': {}}, dict(_ALLOWED_FUNCTIONS, x=x))
+    
+    try:
+        with np.errstate(all='ignore'):
+            f(np.linspace(-1, 1, 5))
+    except Exception:
+        return None
+    return f
+
+def find_roots(f, x_range=(-10, 10), samples=2001):
+    """f(x) = 0 となる x を符号変化から求める（グラフの強調表示用）"""
+    x = np.linspace(x_range[0], x_range[1], samples)
+    with np.errstate(all='ignore'):
+        y = np.asarray(f(x), dtype=float) * np.ones_like(x)
+    roots = []
+    for i in range(len(x) - 1):
+        if not (np.isfinite(y[i]) and np.isfinite(y[i + 1])):
+            continue
+        if y[i] == 0:
+            roots.append(x[i])
+        elif y[i] * y[i + 1] < 0:
+            roots.append(x[i] - y[i] * (x[i + 1] - x[i]) / (y[i + 1] - y[i]))
+    return [round(float(r), 3) for r in roots]
+
 def format_math_problem(problem_text):
     """数学問題を整形"""
     # 改行を適切に処理
@@ -100,48 +314,96 @@ def format_math_problem(problem_text):
     
     return formatted
 
+def trim_to_sentence(text, max_chars):
+    """max_chars 以内に収まる最後の文末（。！？♪ 改行）まで切り詰める（文末が無ければ文字数で切る）"""
+    if len(text) <= max_chars:
+        return text
+    head = text[:max_chars]
+    end = max(head.rfind(mark) for mark in "。！？!?♪\n")
+    return head[:end + 1].rstrip() if end > 0 else head
+
+def strip_markdown(text):
+    """見出し記号・区切り線・太字記号を除く（読み上げやスライドに記号が出ないように）"""
+    lines = []
+    for line in (text or "").splitlines():
+        if re.fullmatch(r'\s*([-*_])\1{2,}\s*', line):
+            continue
+        line = re.sub(r'^\s*#{1,6}\s*', '', line)
+        lines.append(re.sub(r'(\*\*|__)(.+?)\1', r'\2', line))
+    return "\n".join(lines)
+
 def validate_image_file(filepath):
     """画像ファイルの検証"""
     if not os.path.exists(filepath):
         return False, "ファイルが存在しません"
     
-    # ファイルサイズチェック
+    # ファイルサイズチェック（読み込む前に）
     file_size = os.path.getsize(filepath)
-    if file_size > 10 * 1024 * 1024:  # 10MB制限
+    if file_size > MAX_IMAGE_BYTES:
         return False, "ファイルサイズが大きすぎます"
     
     # 画像として読み込み可能かチェック
-    try:
-        image = cv2.imread(filepath)
-        if image is None:
-            return False, "画像ファイルとして読み込めません"
-    except Exception as e:
-        return False, f"画像読み込みエラー: {e}"
-    
-    return True, "OK"
+    return LoadedImage.open(filepath).validate()
 
 def create_thumbnail(image_path, size=(300, 300)):
     """サムネイル作成"""
     try:
-        image = cv2.imread(image_path)
-        if image is None:
+        image = LoadedImage.open(image_path, size)
+        if not image.ok:
             return None
         
-        # アスペクト比を保持してリサイズ
-        height, width = image.shape[:2]
-        scale = min(size[0]/width, size[1]/height)
-        new_width = int(width * scale)
-        new_height = int(height * scale)
-        
-        thumbnail = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_AREA)
-        
         # サムネイルファイル名
         base_name = os.path.splitext(os.path.basename(image_path))[0]
         thumb_path = os.path.join(os.path.dirname(image_path), f"{base_name}_thumb.jpg")
         
-        cv2.imwrite(thumb_path, thumbnail)
-        return thumb_path
+        return image.thumbnail(size).save(thumb_path)
         
     except Exception as e:
         print(f"サムネイル作成エラー: {e}")
         return None
+
+_payload_cache = OrderedDict()
+_payload_cache_lock = threading.Lock()
+
+def encode_image_payload(image_path, roi=None, max_side=896, quality=85, cache_size=32):
+    """VLM送信用に切り出し・縮小・JPEG再エンコードしてbase64化（画像ごとにキャッシュ）"""
+    try:
+        stat = os.stat(image_path)
+        key = (os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size, roi, max_side, quality)
+        with _payload_cache_lock:
+            if key in _payload_cache:
+                _payload_cache.move_to_end(key)
+                registry.inc("cache_requests", cache="vlm_payload", result="hit")
+                return _payload_cache[key]
+        registry.inc("cache_requests", cache="vlm_payload", result="miss")
+        
+        # 切り出さないならVLMの解像度近くまで縮小デコード（ROIは元画像の座標なので全体をデコード）
+        image = LoadedImage.open(image_path, None if roi is not None else (max_side, max_side)).array
+        if image is None:
+            return None
+        
+        # 関心領域で切り出し
+        if roi is not None:
+            x0, y0, x1, y1 = roi
+            image = image[y0:y1, x0:x1]
+        
+        # VLMの入力解像度まで縮小
+        height, width = image.shape[:2]
+        scale = max_side / max(height, width)
+        if scale < 1:
+            image = cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        
+        result, encoded = cv2.imencode('.jpg', image, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+        if not result:
+            return None
+        
+        payload = ("image/jpeg", base64.b64encode(encoded.tobytes()).decode('utf-8'))
+        with _payload_cache_lock:
+            _payload_cache[key] = payload
+            while len(_payload_cache) > cache_size:
+                _payload_cache.popitem(last=False)
+        return payload
+    
+    except Exception as e:
+        print(f"画像ペイロード作成エラー: {e}")
+        return None
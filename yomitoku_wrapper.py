@@ -4,6 +4,128 @@ import easyocr
 import pytesseract
 from PIL import Image
 import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from config import Config
+from ocr_engine_manager import OCREngineManager
+from metrics import registry
+
+def _tesseract_worker(image):
+    """Tesseractプロセスプール用（行単位のボックスと信頼度付き）"""
+    rgb = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    try:
+        data = pytesseract.image_to_data(rgb, lang='jpn+eng', output_type=pytesseract.Output.DICT)
+    except Exception as e:
+        # pytesseractの例外はプロセス間で復元できずプールが壊れるため包み直す
+        raise RuntimeError(str(e))
+    lines = {}
+    for i, word in enumerate(data['text']):
+        confidence = float(data['conf'][i])
+        if not word.strip() or confidence < 0:
+            continue
+        key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        x, y, w, h = data['left'][i], data['top'][i], data['width'][i], data['height'][i]
+        line = lines.setdefault(key, {'text': "", 'conf': [], 'box': [x, y, x + w, y + h]})
+        # 日本語は文字ごとに分割されるので、英数字同士の間だけ空白を入れる
+        if line['text'] and line['text'][-1].isascii() and word[0].isascii():
+            line['text'] += ' '
+        line['text'] += word
+        line['conf'].append(confidence)
+        box = line['box']
+        line['box'] = [min(box[0], x), min(box[1], y), max(box[2], x + w), max(box[3], y + h)]
+    
+    results = []
+    for line in lines.values():
+        x0, y0, x1, y1 = line['box']
+        bbox = [[x0, y0], [x1, y0], [x1, y1], [x0, y1]]
+        results.append((bbox, line['text'], sum(line['conf']) / len(line['conf']) / 100.0))
+    return results
+
+class OCRResult:
+    """構造化OCR結果（ボックス・テキスト・信頼度・行番号を配列で保持）"""
+    
+    def __init__(self, boxes, texts, confidences, line_ids):
+        self.boxes = boxes  # (N, 4, 2) float32
+        self.texts = texts  # N個の文字列
+        self.confidences = confidences  # (N,) float32
+        self.line_ids = line_ids  # (N,) int32 上から順の行番号
+    
+    @classmethod
+    def from_results(cls, results, threshold=None):
+        """EasyOCR形式の(bbox, text, confidence)リストから作成"""
+        if threshold is None:
+            threshold = Config.OCR_CONFIDENCE_THRESHOLD
+        kept = [(bbox, text, confidence) for (bbox, text, confidence) in results
+                if confidence > threshold]
+        if not kept:
+            return cls.empty()
+        
+        boxes = np.array([bbox for (bbox, text, confidence) in kept], dtype=np.float32).reshape(-1, 4, 2)
+        texts = [text for (bbox, text, confidence) in kept]
+        confidences = np.array([confidence for (bbox, text, confidence) in kept], dtype=np.float32)
+        return cls(boxes, texts, confidences, cls._group_lines(boxes))
+    
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros((0, 4, 2), dtype=np.float32), [],
+                   np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int32))
+    
+    @staticmethod
+    def _group_lines(boxes):
+        """縦方向の中心が近いボックスを同じ行にまとめる"""
+        centers = boxes[:, :, 1].mean(axis=1)
+        heights = boxes[:, :, 1].max(axis=1) - boxes[:, :, 1].min(axis=1)
+        tolerance = max(float(np.median(heights)) * 0.5, 1.0)
+        
+        line_ids = np.zeros(len(boxes), dtype=np.int32)
+        current_line = 0
+        line_center = None
+        for i in np.argsort(centers, kind='stable'):
+            if line_center is not None and centers[i] - line_center > tolerance:
+                current_line += 1
+                line_center = None
+            line_center = centers[i] if line_center is None else (line_center + centers[i]) / 2
+            line_ids[i] = current_line
+        return line_ids
+    
+    def __len__(self):
+        return len(self.texts)
+    
+    @property
+    def text(self):
+        """従来の結合文字列"""
+        return ' '.join(self.texts)
+    
+    def lines(self):
+        """行ごとに左から並べた文字列"""
+        lines = []
+        for line_id in np.unique(self.line_ids):
+            indices = np.flatnonzero(self.line_ids == line_id)
+            indices = indices[np.argsort(self.boxes[indices, :, 0].min(axis=1))]
+            lines.append(' '.join(self.texts[i] for i in indices))
+        return lines
+    
+    def find(self, keywords):
+        """キーワードを含む最初の要素の番号（無ければ-1）"""
+        for i, text in enumerate(self.texts):
+            lowered = text.lower()
+            if any(keyword.lower() in lowered for keyword in keywords):
+                return i
+        return -1
+    
+    def region_around(self, index, image_shape, line_radius=3, margin=40):
+        """指定要素の前後の行を含む矩形 (x0, y0, x1, y1)"""
+        height, width = image_shape[:2]
+        line_id = self.line_ids[index]
+        mask = np.abs(self.line_ids - line_id) <= line_radius
+        points = self.boxes[mask].reshape(-1, 2)
+        x0 = max(0, int(points[:, 0].min()) - margin)
+        y0 = max(0, int(points[:, 1].min()) - margin)
+        x1 = min(width, int(points[:, 0].max()) + margin)
+        y1 = min(height, int(points[:, 1].max()) + margin)
+        return (x0, y0, x1, y1)
 
 class YomitokuWrapper:
     """Yomitokuの代替OCRラッパー"""
@@ -15,40 +137,271 @@ class YomitokuWrapper:
         except Exception as e:
             print(f"EasyOCR初期化失敗: {e}")
             self.use_easyocr = False
-            
-    def predict(self, image_path):
-        """画像からテキストを抽出"""
+        
+        self.use_tesseract = True
         try:
+            pytesseract.get_tesseract_version()
+        except Exception as e:
+            print(f"Tesseract利用不可: {e}")
+            self.use_tesseract = False
+        
+        # 2段階OCR（検出→切り出し認識）用のキャッシュ
+        self.region_lock = threading.Lock()
+        self.scene_signature = None
+        self.cached_regions = None  # (horizontal_list, free_list)
+        self.frame_roi = None  # (x0, y0, x1, y1) 前回の紙・黒板の位置
+        self.frames_since_full_detect = 0
+        self.last_frame_entry = (None, OCRResult.empty())  # (frame, OCRResult)
+        self.tesseract_pool = None
+    
+        # 入力種別ごとに速いエンジンを選ぶ
+        engines = {}
+        if self.use_easyocr:
+            engines["easyocr"] = self._run_easyocr
+        if self.use_tesseract or not engines:
+            engines["tesseract"] = self._run_tesseract
+        self.engine_manager = OCREngineManager(engines)
+    
+    def predict(self, image_path, input_class="photo"):
+        """画像からテキストを抽出（パスまたはndarray）"""
+        return self.predict_structured(image_path, input_class).text
+    
+    def predict_structured(self, image, input_class="photo"):
+        """画像から構造化OCR結果を取得（パスまたはndarray）"""
+        try:
+            image = self._load_image(image)
+            if image is None:
+                return OCRResult.empty()
+            engine, results = self.engine_manager.run(image, input_class)
+            return OCRResult.from_results(results)
+        except Exception as e:
+            print(f"OCR処理エラー: {e}")
+            return OCRResult.empty()
+    
+    def predict_batch(self, images, input_class="pdf_page"):
+        """複数画像を一括OCR（サイズの近い画像ごとにまとめて認識）"""
+        arrays = [self._load_image(image) for image in images]
+        outputs = [[] for _ in arrays]
+        valid = [i for i, image in enumerate(arrays) if image is not None]
+        if not valid:
+            return [OCRResult.empty() for _ in arrays]
+        
+        engine = self.engine_manager.choose(input_class)
+        start = time.perf_counter()
+        try:
+            if engine == "easyocr":
+                for indices in self._group_by_size(arrays, valid):
+                    batch_results = self._readtext_group([arrays[i] for i in indices])
+                    for i, results in zip(indices, batch_results):
+                        outputs[i] = results
+            else:
+                if self.tesseract_pool is None:
+                    # スレッドが動いているプロセスをforkするとロックを持ったまま複製されて固まることがあるのでspawn
+                    self.tesseract_pool = ProcessPoolExecutor(max_workers=Config.OCR_BATCH_WORKERS,
+                                                              mp_context=multiprocessing.get_context("spawn"))
+                batch_results = self.tesseract_pool.map(_tesseract_worker, [arrays[i] for i in valid])
+                for i, results in zip(valid, batch_results):
+                    outputs[i] = results
+        except Exception as e:
+            print(f"一括OCR処理エラー: {e}")
+        
+        # 1枚あたりの処理時間として記録
+        latency = (time.perf_counter() - start) / len(valid)
+        for i in valid:
+            self.engine_manager.record(engine, input_class, latency, outputs[i])
+        
+        return [OCRResult.from_results(results) for results in outputs]
+    
+    def close(self):
+        """Tesseractのプロセスプールを終了"""
+        if self.tesseract_pool is not None:
+            self.tesseract_pool.shutdown(wait=False, cancel_futures=True)
+            self.tesseract_pool = None
+    
+    def _group_by_size(self, arrays, indices):
+        """縦横サイズを丸めて近いもの同士をグループ化"""
+        step = Config.OCR_BATCH_SIZE_STEP
+        groups = {}
+        for i in indices:
+            height, width = arrays[i].shape[:2]
+            key = (max(1, round(width / step)), max(1, round(height / step)))
+            groups.setdefault(key, []).append(i)
+        return list(groups.values())
+    
+    def _readtext_group(self, images):
+        """同じサイズにそろえてreadtext_batchedで一括処理し、座標を元に戻す"""
+        n_width = max(image.shape[1] for image in images)
+        n_height = max(image.shape[0] for image in images)
+        batch_results = self.easyocr_reader.readtext_batched(
+            images, n_width=n_width, n_height=n_height, batch_size=Config.OCR_BATCH_SIZE)
+        
+        scaled = []
+        for image, results in zip(images, batch_results):
+            scale_x = image.shape[1] / n_width
+            scale_y = image.shape[0] / n_height
+            scaled.append([([[x * scale_x, y * scale_y] for x, y in bbox], text, confidence)
+                           for (bbox, text, confidence) in results])
+        return scaled
+    
+    def predict_regions(self, image):
+        """文字領域の検出結果を静止シーンで使い回し、切り出し部分だけ認識"""
+        return self.predict(image, "photo")
+    
+    def predict_frame(self, frame):
+        """カメラフレーム用OCR（前回の紙・黒板の位置周辺だけを検出・認識）"""
+        return self.predict_frame_structured(frame).text
+    
+    def predict_frame_structured(self, frame):
+        """カメラフレーム用の構造化OCR結果（同じフレームは再計算しない）"""
+        last_frame, last_result = self.last_frame_entry
+        if frame is last_frame:
+            registry.inc("cache_requests", cache="ocr_frame", result="hit")
+            return last_result
+        
+        registry.inc("cache_requests", cache="ocr_frame", result="miss")
+        result = self.predict_structured(frame, "camera")
+        self.last_frame_entry = (frame, result)
+        return result
+    
+    def predict_keywords(self, image, allowlist):
+        """小さな切り出し画像を、指定文字だけに絞って認識"""
+        try:
+            if image is None or image.size == 0:
+                return ""
             if self.use_easyocr:
-                return self._extract_with_easyocr(image_path)
+                results = self.easyocr_reader.readtext(image, allowlist=allowlist)
             else:
-                return self._extract_with_tesseract(image_path)
+                results = _tesseract_worker(image)
+            return OCRResult.from_results(results).text
         except Exception as e:
             print(f"OCR処理エラー: {e}")
             return ""
     
-    def _extract_with_easyocr(self, image_path):
-        """EasyOCRでテキスト抽出"""
-        results = self.easyocr_reader.readtext(image_path)
-        text_parts = []
-        for (bbox, text, confidence) in results:
-            if confidence > 0.5:
-                text_parts.append(text)
-        return ' '.join(text_parts)
-    
-    def _extract_with_tesseract(self, image_path):
-        """Tesseractでテキスト抽出"""
-        image = Image.open(image_path)
-        # 日本語+英語でOCR
-        text = pytesseract.image_to_string(image, lang='jpn+eng')
-        return text.strip()
+    def _run_easyocr(self, image, input_class):
+        """EasyOCRエンジン（入力種別に合わせて検出範囲を絞る）"""
+        if input_class == "camera":
+            return self._recognize_frame(image)
+        if input_class == "photo":
+            return self._recognize_cached(image)
+        return self.easyocr_reader.readtext(image)
+    
+    def _run_tesseract(self, image, input_class):
+        """Tesseractエンジン"""
+        return _tesseract_worker(image)
+    
+    def _recognize_cached(self, image):
+        """静止シーンでは前回検出した文字領域を使い回して認識"""
+        with self.region_lock:
+            if Config.OCR_REGION_CACHE and self.cached_regions is not None \
+                    and not self._scene_changed(image):
+                horizontal_list, free_list = self.cached_regions
+                registry.inc("cache_requests", cache="ocr_regions", result="hit")
+            else:
+                registry.inc("cache_requests", cache="ocr_regions", result="miss")
+                horizontal_list, free_list = self._detect_regions(image)
+                self.cached_regions = (horizontal_list, free_list)
+                self.scene_signature = self._make_signature(image)
+        
+        return self._recognize_regions(image, horizontal_list, free_list)
+    
+    def _recognize_frame(self, frame):
+        """ROI内で検出・認識し、座標をフレーム基準に戻す"""
+        height, width = frame.shape[:2]
+        
+        with self.region_lock:
+            roi = self.frame_roi
+            self.frames_since_full_detect += 1
+            if self.frames_since_full_detect >= Config.OCR_ROI_REFRESH_FRAMES:
+                roi = None
+        
+        if roi is not None:
+            x0, y0, x1, y1 = roi
+            crop = frame[y0:y1, x0:x1]
+            horizontal_list, free_list = self._detect_regions(crop)
+            if horizontal_list or free_list:
+                results = self._recognize_regions(crop, horizontal_list, free_list)
+                return self._offset_results(results, x0, y0)
+            # ROI内に文字が無い場合は紙が動いたとみなして全体を再検出
+        
+        horizontal_list, free_list = self._detect_regions(frame)
+        results = self._recognize_regions(frame, horizontal_list, free_list)
+        
+        with self.region_lock:
+            self.frame_roi = self._compute_roi(horizontal_list, free_list, width, height)
+            self.frames_since_full_detect = 0
+        
+        return results
+    
+    def _detect_regions(self, image):
+        """EasyOCRの検出ステージのみ実行"""
+        horizontal_list, free_list = self.easyocr_reader.detect(image)
+        return horizontal_list[0], free_list[0]
+    
+    def _recognize_regions(self, image, horizontal_list, free_list):
+        """検出済み領域の切り出しだけを認識"""
+        if not horizontal_list and not free_list:
+            return []
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        return self.easyocr_reader.recognize(gray, horizontal_list=horizontal_list, free_list=free_list)
+    
+    def _offset_results(self, results, dx, dy):
+        """切り出し座標を元画像の座標に変換"""
+        return [([[x + dx, y + dy] for x, y in bbox], text, confidence)
+                for (bbox, text, confidence) in results]
+    
+    def _compute_roi(self, horizontal_list, free_list, width, height):
+        """検出された文字領域を囲む余白付きの矩形"""
+        xs, ys = [], []
+        for x_min, x_max, y_min, y_max in horizontal_list:
+            xs.extend([x_min, x_max])
+            ys.extend([y_min, y_max])
+        for polygon in free_list:
+            for x, y in polygon:
+                xs.append(x)
+                ys.append(y)
+        if not xs:
+            return None
+        
+        margin_x = int(width * Config.OCR_ROI_MARGIN)
+        margin_y = int(height * Config.OCR_ROI_MARGIN)
+        x0 = max(0, int(min(xs)) - margin_x)
+        y0 = max(0, int(min(ys)) - margin_y)
+        x1 = min(width, int(max(xs)) + margin_x)
+        y1 = min(height, int(max(ys)) + margin_y)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return (x0, y0, x1, y1)
+    
+    def _make_signature(self, image):
+        """シーン変化判定用の (画像サイズ, 縮小グレー画像)"""
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        return image.shape[:2], cv2.resize(gray, (64, 36), interpolation=cv2.INTER_AREA)
+    
+    def _scene_changed(self, image):
+        """前回検出時からシーンが変わったか"""
+        if self.scene_signature is None:
+            return True
+        # サイズが違えば（縮小した再アップロード等）見た目が似ていても領域の座標は使えない
+        cached_shape, cached_thumbnail = self.scene_signature
+        if image.shape[:2] != cached_shape:
+            return True
+        _, thumbnail = self._make_signature(image)
+        diff = cv2.absdiff(thumbnail, cached_thumbnail)
+        changed_ratio = np.count_nonzero(diff > Config.OCR_SCENE_PIXEL_DELTA) / diff.size
+        return changed_ratio > Config.OCR_SCENE_CHANGE_RATIO
+    
+    def _load_image(self, image):
+        """パスならBGR配列として読み込む"""
+        if isinstance(image, np.ndarray):
+            return image
+        return cv2.imread(image)
     
     def preprocess_image(self, image_path):
         """画像前処理"""
         image = cv2.imread(image_path)
         if image is None:
             return None
-            
+        
         # グレースケール変換
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         